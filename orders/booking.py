@@ -0,0 +1,90 @@
+"""
+Booking with provider conflict detection.
+
+A booking takes a row lock on the provider before checking for overlapping
+active orders, so concurrent bookings of one provider are serialized and
+the overlap check and the insert happen as one step. The check is a range
+scan of order_provider_interval_idx (provider, scheduled_date,
+scheduled_end). Bookings of different providers never wait on each other.
+"""
+from datetime import datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+
+from services.availability import BLOCKING_STATUSES
+from .models import Order
+
+
+class BookingConflict(Exception):
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super().__init__("The provider is already booked for that time")
+
+
+def parse_schedule(date_value, time_value=None):
+    """
+    Parse the booking form's date and optional time (or a single ISO 8601
+    datetime) into an aware datetime; None when no date is given
+    """
+    if not date_value:
+        return None
+    try:
+        if time_value:
+            day, at = parse_date(str(date_value)), parse_time(str(time_value))
+            scheduled = datetime.combine(day, at) if day and at else None
+        else:
+            # A bare date books from midnight
+            scheduled = parse_datetime(str(date_value))
+        if scheduled is None:
+            raise ValueError
+    except ValueError:
+        raise ValueError("scheduled_date must be a date (YYYY-MM-DD) or an ISO 8601 date and time")
+    if timezone.is_naive(scheduled):
+        scheduled = timezone.make_aware(scheduled)
+    return scheduled
+
+
+def booking_interval(scheduled_date, duration_hours):
+    return scheduled_date, scheduled_date + timedelta(hours=max(duration_hours, 1))
+
+
+def find_conflicts(provider_id, start, end, exclude_id=None):
+    """
+    Active orders of provider_id overlapping [start, end)
+    """
+    conflicts = Order.objects.filter(
+        provider_id=provider_id,
+        status__in=BLOCKING_STATUSES,
+        scheduled_date__lt=end,
+        scheduled_end__gt=start,
+    )
+    if exclude_id is not None:
+        conflicts = conflicts.exclude(id=exclude_id)
+    return conflicts
+
+
+def book(client, service, scheduled_date=None, duration_hours=1, **fields):
+    """
+    Create an order for service, raising BookingConflict if its provider
+    already has an active order overlapping the requested time
+    """
+    with transaction.atomic():
+        if scheduled_date is not None:
+            # Serialize bookings per provider until this transaction ends
+            list(get_user_model().objects.select_for_update().filter(pk=service.provider_id).values_list('pk'))
+            start, end = booking_interval(scheduled_date, duration_hours)
+            conflicts = list(find_conflicts(service.provider_id, start, end).values_list('id', flat=True)[:5])
+            if conflicts:
+                raise BookingConflict(conflicts)
+
+        return Order.objects.create(
+            client=client,
+            service=service,
+            provider=service.provider,
+            scheduled_date=scheduled_date,
+            duration_hours=duration_hours,
+            **fields
+        )
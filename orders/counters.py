@@ -0,0 +1,74 @@
+"""
+Per-user unread notification counters.
+
+The count lives in the cache and is moved with incr/decr when a
+notification is created or read, and dropped when notifications are
+deleted, so the polling endpoint never counts rows. Notifications are created by Celery workers and the count is
+read by the web workers, so this needs the shared cache configured outside
+DEBUG; a per-process cache would serve each worker its own stale count.
+A missing or corrupt value is recounted from the database.
+Entries expire after COUNTER_TIMEOUT, which bounds the drift left by a lost
+update (a cache outage, a bulk write that skipped the hooks, notifications
+deleted by a cascade from their user, order or service).
+"""
+from django.core.cache import caches
+from django.db import transaction
+
+CACHE_ALIAS = 'default'
+COUNTER_TIMEOUT = 60 * 60
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def recount(user_id):
+    from .models import Notification
+
+    count = Notification.objects.filter(recipient_id=user_id, is_read=False).count()
+    _cache().set(_key(user_id), count, COUNTER_TIMEOUT)
+    return count
+
+
+def unread_count(user_id):
+    """
+    Return the user's unread count, from the cache when it holds a sane value
+    """
+    value = _cache().get(_key(user_id))
+    if type(value) is int and value >= 0:
+        return value
+    return recount(user_id)
+
+
+def _apply(user_id, delta):
+    cache = _cache()
+    key = _key(user_id)
+    try:
+        value = cache.incr(key, delta)
+    except ValueError:
+        # Not cached; the next read recounts
+        return
+    except TypeError:
+        cache.delete(key)
+        return
+    if value < 0:
+        cache.delete(key)
+
+
+def adjust(user_id, delta):
+    """
+    Move a user's counter by delta once the current transaction commits
+    """
+    if delta:
+        transaction.on_commit(lambda: _apply(user_id, delta))
+
+
+def invalidate(user_id):
+    """
+    Drop a user's counter after commit so the next read recounts it
+    """
+    transaction.on_commit(lambda: _cache().delete(_key(user_id)))
@@ -0,0 +1,368 @@
+"""
+Live notification and message events over server-sent events.
+
+stream_application is a bare ASGI app mounted in service_app/asgi.py in
+front of Django. A connection costs one coroutine and one small queue: the
+request never enters the Django middleware stack, whose sync middleware
+would pin a thread to every open stream. Users are authenticated once per
+connection, by a JWT (Authorization header or ?token=, since EventSource
+cannot set headers) or the session cookie.
+
+Events are published after commit on a per-user pub/sub channel. With
+EVENT_STREAM_REDIS_URL set (by default the shared cache's Redis), every
+worker keeps one Redis connection and subscribes to the channels of the
+users connected to it; without it events only reach streams served by the
+same process, which is enough for tests and a single-process server.
+"""
+import asyncio
+import json
+import logging
+import weakref
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from importlib import import_module
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections, transaction
+from django.http import HttpRequest
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATHS = ('/orders/events/', '/api/orders/events/')
+# Comment lines keep proxies from closing idle streams
+HEARTBEAT_SECONDS = 15
+# Client reconnect delay announced to EventSource
+RETRY_MILLISECONDS = 5000
+# Events buffered per connection; a slower reader is told to resync
+QUEUE_SIZE = 100
+CHANNEL_PREFIX = 'events:user:'
+
+RESYNC = json.dumps({'event': 'resync', 'data': {}})
+
+
+def _channel(user_id):
+    return f'{CHANNEL_PREFIX}{user_id}'
+
+
+def _offer(queue, message):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        # Drop the backlog; the client refetches when it sees resync
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(RESYNC)
+
+
+class Hub:
+    """
+    The connected streams of one event loop, by user
+    """
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)
+
+    async def subscribe(self, user_id):
+        queue = asyncio.Queue(QUEUE_SIZE)
+        first = not self.subscribers[user_id]
+        self.subscribers[user_id].add(queue)
+        if first:
+            await self.listen(user_id)
+        return queue
+
+    async def unsubscribe(self, user_id, queue):
+        queues = self.subscribers.get(user_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+            await self.unlisten(user_id)
+
+    def dispatch(self, user_id, message):
+        for queue in self.subscribers.get(user_id, ()):
+            _offer(queue, message)
+
+    @property
+    def connections(self):
+        return sum(len(queues) for queues in self.subscribers.values())
+
+    async def listen(self, user_id):
+        pass
+
+    async def unlisten(self, user_id):
+        pass
+
+
+class MemoryHub(Hub):
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def publish(self, user_id, message):
+        # publish() runs in request threads, dispatch() on the loop
+        if user_id in self.subscribers:
+            self.loop.call_soon_threadsafe(self.dispatch, user_id, message)
+
+
+class RedisHub(Hub):
+    def __init__(self, url):
+        super().__init__()
+        self.url = url
+        self.pubsub = None
+        self.reader = None
+
+    async def listen(self, user_id):
+        if self.pubsub is None:
+            import redis.asyncio as redis
+
+            self.pubsub = redis.Redis.from_url(self.url).pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(_channel(user_id))
+        if self.reader is None:
+            self.reader = asyncio.ensure_future(self.read())
+
+    async def unlisten(self, user_id):
+        await self.pubsub.unsubscribe(_channel(user_id))
+
+    async def read(self):
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # redis-py resubscribes every channel when it reconnects
+                logger.warning("Event stream lost its Redis connection", exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            if message is None:
+                continue
+            channel = message['channel'].decode()
+            data = message['data']
+            self.dispatch(int(channel[len(CHANNEL_PREFIX):]), data.decode() if isinstance(data, bytes) else data)
+
+
+_hubs = weakref.WeakKeyDictionary()
+_redis_client = None
+
+
+def get_hub():
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        url = settings.EVENT_STREAM_REDIS_URL
+        hub = _hubs[loop] = RedisHub(url) if url else MemoryHub(loop)
+    return hub
+
+
+def _encode(event_type, data):
+    return json.dumps({'event': event_type, 'data': data}, cls=DjangoJSONEncoder)
+
+
+def _send(messages):
+    """
+    Deliver (user_id, encoded event) pairs. Never raises: live events are
+    best effort and clients resync on reconnect.
+    """
+    global _redis_client
+
+    try:
+        url = settings.EVENT_STREAM_REDIS_URL
+        if url:
+            if _redis_client is None:
+                import redis
+
+                _redis_client = redis.Redis.from_url(url)
+            pipeline = _redis_client.pipeline(transaction=False)
+            for user_id, message in messages:
+                pipeline.publish(_channel(user_id), message)
+            pipeline.execute()
+        else:
+            for hub in list(_hubs.values()):
+                for user_id, message in messages:
+                    hub.publish(user_id, message)
+    except Exception:
+        logger.warning("Could not publish %s events", len(messages), exc_info=True)
+
+
+def publish(user_ids, event_type, data):
+    """
+    Send an event to every open stream of the given users
+    """
+    message = _encode(event_type, data)
+    _send([(user_id, message) for user_id in user_ids])
+
+
+def publish_on_commit(user_ids, event_type, data):
+    user_ids = list(user_ids)
+    if user_ids:
+        transaction.on_commit(lambda: publish(user_ids, event_type, data))
+
+
+def publish_notifications(notifications):
+    """
+    Queue one event per notification, sent together after commit
+    """
+    messages = [
+        (notification.recipient_id, _encode('notification', notification_data(notification)))
+        for notification in notifications
+    ]
+    if messages:
+        transaction.on_commit(lambda: _send(messages))
+
+
+def notification_data(notification):
+    return {
+        'id': notification.id,
+        'notification_type': notification.notification_type,
+        'title': notification.title,
+        'message': notification.message,
+        'related_order': notification.related_order_id,
+        'related_service': notification.related_service_id,
+        'created_at': notification.created_at,
+    }
+
+
+def message_data(message):
+    return {
+        'id': message.id,
+        'conversation': message.conversation_id,
+        'sender': message.sender_id,
+        'content': message.content,
+        'message_type': message.message_type,
+        'created_at': message.created_at,
+    }
+
+
+def _authenticate(token, session_key):
+    """
+    Return the active user behind a JWT or a session key, or None
+    """
+    try:
+        if token:
+            from rest_framework_simplejwt.authentication import JWTAuthentication
+            from rest_framework_simplejwt.exceptions import AuthenticationFailed, InvalidToken
+
+            authentication = JWTAuthentication()
+            try:
+                user = authentication.get_user(authentication.get_validated_token(token))
+            except (AuthenticationFailed, InvalidToken):
+                return None
+        elif session_key:
+            request = HttpRequest()
+            request.session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+            user = get_user(request)
+        else:
+            return None
+        return user if user.is_authenticated and user.is_active else None
+    finally:
+        close_old_connections()
+
+
+def _credentials(scope):
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', ())}
+    token = None
+    authorization = headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        token = authorization[7:].strip()
+    if not token:
+        token = parse_qs(scope.get('query_string', b'').decode()).get('token', [None])[0]
+    session_key = None
+    if 'cookie' in headers:
+        cookie = SimpleCookie()
+        cookie.load(headers['cookie'])
+        if settings.SESSION_COOKIE_NAME in cookie:
+            session_key = cookie[settings.SESSION_COOKIE_NAME].value
+    return token, session_key
+
+
+def _frame(message):
+    payload = json.loads(message)
+    data = payload['data']
+    lines = []
+    if data.get('id') is not None:
+        lines.append(f"id: {payload['event']}-{data['id']}")
+    lines.append(f"event: {payload['event']}")
+    lines.append(f"data: {json.dumps(data)}")
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def stream_application(scope, receive, send):
+    """
+    ASGI app serving a user's notification and message events as
+    text/event-stream
+    """
+    if scope['method'] != 'GET':
+        await _reject(send, 405, b'{"detail": "Method not allowed."}')
+        return
+
+    # Thread sensitive: auth runs on the one shared sync thread, not a
+    # thread per connection
+    user = await sync_to_async(_authenticate, thread_sensitive=True)(*_credentials(scope))
+    if user is None:
+        await _reject(send, 401, b'{"detail": "Authentication credentials were not provided."}')
+        return
+
+    hub = get_hub()
+    queue = await hub.subscribe(user.id)
+    disconnect = asyncio.ensure_future(_wait_for_disconnect(receive))
+    pending = None
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                # Keep nginx from buffering the stream
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        # Clients (re)load their lists on ready; nothing is replayed
+        await send({
+            'type': 'http.response.body',
+            'body': f'retry: {RETRY_MILLISECONDS}\nevent: ready\ndata: {{}}\n\n'.encode(),
+            'more_body': True,
+        })
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {pending, disconnect}, timeout=HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED
+            )
+            if disconnect in done:
+                break
+            if pending in done:
+                body = _frame(pending.result())
+                pending = None
+            else:
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    except OSError:
+        # The client went away mid-send
+        pass
+    finally:
+        disconnect.cancel()
+        if pending is not None:
+            pending.cancel()
+        await hub.unsubscribe(user.id, queue)
+
+
+async def _reject(send, status, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')],
+    })
+    await send({'type': 'http.response.body', 'body': body})
@@ -0,0 +1,35 @@
+"""
+Order export columns and scope (see service_app.exports)
+"""
+from .models import Order
+
+# (column, values_list lookup)
+COLUMNS = (
+    ('id', 'id'),
+    ('created_at', 'created_at'),
+    ('status', 'status'),
+    ('service_id', 'service_id'),
+    ('service', 'service__name'),
+    ('client_id', 'client_id'),
+    ('client', 'client__username'),
+    ('provider_id', 'provider_id'),
+    ('provider', 'provider__username'),
+    ('quantity', 'quantity'),
+    ('total_amount', 'total_amount'),
+    ('scheduled_date', 'scheduled_date'),
+    ('confirmed_at', 'confirmed_at'),
+    ('started_at', 'started_at'),
+    ('completed_at', 'completed_at'),
+)
+
+
+def exportable(user):
+    """
+    Orders user may export: staff (finance) get every order, providers the
+    orders they received, clients the orders they placed
+    """
+    if user.is_staff:
+        return Order.objects.all()
+    if user.account_type in ['provider', 'business']:
+        return Order.objects.filter(provider=user)
+    return Order.objects.filter(client=user)
@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from orders.models import Order
+
+
+class Command(BaseCommand):
+    help = "Populate Order.scheduled_end for orders saved before the column existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        orders = Order.objects.filter(
+            scheduled_date__isnull=False, scheduled_end__isnull=True
+        ).only('id', 'scheduled_date', 'duration_hours', 'scheduled_end').order_by('id')
+
+        batch = []
+        updated = 0
+        for order in orders.iterator(chunk_size=batch_size):
+            order.scheduled_end = order.scheduled_date + timedelta(hours=max(order.duration_hours, 1))
+            batch.append(order)
+            if len(batch) >= batch_size:
+                updated += len(batch)
+                Order.objects.bulk_update(batch, ['scheduled_end'])
+                batch = []
+        if batch:
+            updated += len(batch)
+            Order.objects.bulk_update(batch, ['scheduled_end'])
+
+        self.stdout.write(self.style.SUCCESS(f"Updated scheduled_end on {updated} orders"))
@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+import tracemalloc
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework_simplejwt.tokens import AccessToken
+
+from orders import events
+
+User = get_user_model()
+
+
+class SimulatedSubscriber:
+    """An EventSource client held open against the ASGI application"""
+
+    def __init__(self, application, token):
+        self.ready = asyncio.Event()
+        self.closed = asyncio.Event()
+        self.status = None
+        self.received_at = []
+        scope = {
+            'type': 'http',
+            'method': 'GET',
+            'path': events.STREAM_PATHS[-1],
+            'query_string': f'token={token}'.encode(),
+            'headers': [],
+        }
+        self.task = asyncio.ensure_future(application(scope, self.receive, self.send))
+
+    async def receive(self):
+        await self.closed.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        if message['type'] == 'http.response.start':
+            self.status = message['status']
+            if self.status != 200:
+                self.ready.set()
+        elif b'event: ready' in message.get('body', b''):
+            self.ready.set()
+        elif b'event: notification' in message.get('body', b''):
+            self.received_at.append(time.perf_counter())
+
+
+class Command(BaseCommand):
+    help = (
+        "Open many simulated event stream subscribers in this process, fan a "
+        "notification out to all of them and report connect time, threads, "
+        "memory and delivery latency. Creates temporary users and deletes them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=5000)
+        parser.add_argument('--rounds', type=int, default=3, help="Fan-out rounds to time")
+        # tracemalloc roughly triples the connect time
+        parser.add_argument('--trace-memory', action='store_true', help="Report memory per connection")
+
+    def handle(self, *args, **options):
+        count = options['subscribers']
+        users = User.objects.bulk_create([
+            User(username=f'loadtest-sse-{i}', email=f'loadtest-sse-{i}@example.com', account_type='client')
+            for i in range(count)
+        ], batch_size=1000)
+        try:
+            # Tokens are signed locally; only connecting looks the user up
+            tokens = [str(AccessToken.for_user(user)) for user in users]
+            asyncio.run(self._run([user.id for user in users], tokens, options['rounds'], options['trace_memory']))
+        finally:
+            User.objects.filter(username__startswith='loadtest-sse-').delete()
+
+    async def _run(self, user_ids, tokens, rounds, trace_memory):
+        from service_app.asgi import application
+
+        threads_before = threading.active_count()
+        if trace_memory:
+            tracemalloc.start()
+
+        started = time.perf_counter()
+        subscribers = [SimulatedSubscriber(application, token) for token in tokens]
+        await asyncio.gather(*(subscriber.ready.wait() for subscriber in subscribers))
+        connect = time.perf_counter() - started
+        failed = sum(1 for subscriber in subscribers if subscriber.status != 200)
+
+        threads = threading.active_count() - threads_before
+        self.stdout.write(
+            f"{len(subscribers)} subscribers connected in {connect:.2f}s ({failed} failed); {threads} extra threads"
+        )
+        if trace_memory:
+            memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.stdout.write(f"{memory / len(subscribers) / 1024:.1f} KiB traced per connection")
+
+        for round_number in range(1, rounds + 1):
+            # Published from a worker thread, as a request handler would
+            started = time.perf_counter()
+            await asyncio.to_thread(
+                events.publish, user_ids, 'notification', {'id': round_number, 'title': 'Load test'}
+            )
+            published = time.perf_counter() - started
+            while any(len(subscriber.received_at) < round_number for subscriber in subscribers):
+                await asyncio.sleep(0.01)
+            latencies = sorted(subscriber.received_at[-1] - started for subscriber in subscribers)
+            total = latencies[-1]
+            self.stdout.write(
+                f"round {round_number}: published in {published * 1000:.0f}ms, all delivered in "
+                f"{total * 1000:.0f}ms ({len(latencies) / total:.0f} events/sec); latency "
+                f"p50={latencies[len(latencies) // 2] * 1000:.0f}ms "
+                f"p99={latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms"
+            )
+
+        started = time.perf_counter()
+        for subscriber in subscribers:
+            subscriber.closed.set()
+        await asyncio.gather(*(subscriber.task for subscriber in subscribers))
+        self.stdout.write(self.style.SUCCESS(
+            f"Closed every stream in {time.perf_counter() - started:.2f}s; "
+            f"{events.get_hub().connections} still registered"
+        ))
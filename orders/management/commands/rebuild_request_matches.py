@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from orders.matching import match_request
+from orders.models import RequestMatch, ServiceRequest
+
+
+class Command(BaseCommand):
+    help = "Rescore every open service request against providers"
+
+    def handle(self, *args, **options):
+        # Matches of requests that closed without a save
+        RequestMatch.objects.exclude(request__status='open').delete()
+        requests = 0
+        matches = 0
+        for request_id in ServiceRequest.objects.filter(status='open').values_list('id', flat=True).iterator():
+            matches += match_request(request_id)
+            requests += 1
+        self.stdout.write(self.style.SUCCESS(f"Stored {matches} matches for {requests} open requests"))
@@ -0,0 +1,29 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from orders.utils import REMINDER_CHUNK_SIZE, send_reminder_notifications
+
+
+class Command(BaseCommand):
+    help = "Send reminders for services scheduled tomorrow (or on --date)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', type=date.fromisoformat, help="Day of the services, YYYY-MM-DD")
+        parser.add_argument('--chunk-size', type=int, default=REMINDER_CHUNK_SIZE)
+        parser.add_argument('--inline', action='store_true', help="Process every chunk in this process")
+
+    def handle(self, *args, **options):
+        totals = send_reminder_notifications(
+            day=options['date'], chunk_size=options['chunk_size'], inline=options['inline']
+        )
+        rate = totals['orders'] / totals['seconds'] if totals['seconds'] else 0
+        if options['inline']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Sent {totals['notifications']} reminders for {totals['orders']} orders "
+                f"in {totals['seconds']:.1f}s ({rate:.0f} orders/sec)"
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Queued {totals['chunks']} chunks covering {totals['orders']} orders"
+            ))
@@ -0,0 +1,219 @@
+"""
+Routing of open service requests to providers.
+
+Each open ServiceRequest is scored against the available services in its
+category and the best MATCHES_PER_REQUEST providers are stored as
+RequestMatch rows. A provider's feed is then one indexed read of their
+matches by score. Matching is incremental: a request is (re)scored when it
+is saved and a provider when one of their services changes, each in its
+own Celery task.
+
+A match score is a weighted sum of components in [0, 1]:
+distance (or a location name match when coordinates are missing), budget
+fit against Service.price, the request's urgency, the provider's rating and
+their current load of active orders.
+"""
+import heapq
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, Q
+
+from services.geo import haversine_km, proximity_filter
+
+WEIGHTS = {
+    'distance': 0.30,
+    'budget': 0.25,
+    'rating': 0.20,
+    'load': 0.15,
+    'urgency': 0.10,
+}
+URGENCY_SCORES = {'low': 0.25, 'medium': 0.5, 'high': 0.75, 'urgent': 1.0}
+MAX_DISTANCE_KM = 50
+# Distance component when either side has no coordinates
+SAME_LOCATION_SCORE = 0.6
+OTHER_LOCATION_SCORE = 0.1
+# Rating component of providers nobody has reviewed yet
+UNRATED_SCORE = 0.6
+# Active orders at which the load component halves
+LOAD_HALF = 5
+ACTIVE_STATUSES = ('pending', 'confirmed', 'in_progress')
+
+MATCHES_PER_REQUEST = 20
+MIN_SCORE = 0.3
+
+
+def distance_score(request, latitude, longitude, location):
+    """
+    Return (score, distance_km); score is None when the service is out of
+    range
+    """
+    if None not in (request.latitude, request.longitude, latitude, longitude):
+        distance = haversine_km(float(request.latitude), float(request.longitude), float(latitude), float(longitude))
+        if distance > MAX_DISTANCE_KM:
+            return None, distance
+        return 1 - distance / MAX_DISTANCE_KM, distance
+    wanted = request.location.strip().lower()
+    offered = (location or '').strip().lower()
+    if wanted and offered and (wanted in offered or offered in wanted):
+        return SAME_LOCATION_SCORE, None
+    return OTHER_LOCATION_SCORE, None
+
+
+def budget_score(request, price):
+    """
+    1 inside the budget, decaying with the relative distance outside it
+    """
+    low, high = request.budget_min, request.budget_max
+    if low is None and high is None:
+        return 0.5
+    price = Decimal(price)
+    if low is not None and price < low:
+        gap = (low - price) / low
+    elif high is not None and price > high:
+        gap = (price - high) / high if high else Decimal(1)
+    else:
+        return 1.0
+    return max(0.0, 1 - float(gap))
+
+
+def provider_scores(provider_ids):
+    """
+    Return {provider_id: (rating score, load score)}
+    """
+    from .models import Order
+
+    loads = dict(
+        Order.objects.filter(provider_id__in=provider_ids, status__in=ACTIVE_STATUSES)
+        .order_by().values_list('provider_id').annotate(total=Count('id'))
+    )
+    scores = {}
+    for provider_id, average, count in get_user_model().objects.filter(id__in=provider_ids).values_list(
+            'id', 'average_rating', 'rating_count'):
+        rating = float(average) / 5 if count else UNRATED_SCORE
+        scores[provider_id] = (rating, 1 / (1 + loads.get(provider_id, 0) / LOAD_HALF))
+    return scores
+
+
+def score_services(request, services, stats=None):
+    """
+    Score (service_id, provider_id, price, latitude, longitude, location)
+    rows for request. Returns {provider_id: (score, service_id, distance)}
+    holding each provider's best service. stats is provider_scores() of
+    the providers, when already known.
+    """
+    partial = {}
+    for service_id, provider_id, price, latitude, longitude, location in services:
+        distance_part, distance = distance_score(request, latitude, longitude, location)
+        if distance_part is None:
+            continue
+        value = WEIGHTS['distance'] * distance_part + WEIGHTS['budget'] * budget_score(request, price)
+        if provider_id not in partial or value > partial[provider_id][0]:
+            partial[provider_id] = (value, service_id, distance)
+
+    urgency = WEIGHTS['urgency'] * URGENCY_SCORES.get(request.urgency, 0.5)
+    results = {}
+    if stats is None:
+        stats = provider_scores(list(partial))
+    for provider_id, (value, service_id, distance) in partial.items():
+        rating, load = stats.get(provider_id, (UNRATED_SCORE, 1.0))
+        score = value + urgency + WEIGHTS['rating'] * rating + WEIGHTS['load'] * load
+        results[provider_id] = (score, service_id, distance)
+    return results
+
+
+def candidate_services(request):
+    """
+    Available services in the request's category that could be in range
+    """
+    from services.models import Service
+
+    services = Service.objects.filter(category_id=request.category_id, is_available=True).exclude(
+        provider_id=request.client_id)
+    if request.latitude is not None and request.longitude is not None:
+        # Services without coordinates are still matched by location name
+        services = services.filter(
+            proximity_filter(float(request.latitude), float(request.longitude), MAX_DISTANCE_KM)
+            | Q(latitude__isnull=True) | Q(longitude__isnull=True)
+        )
+    return services.values_list('id', 'provider_id', 'price', 'latitude', 'longitude', 'location')
+
+
+def match_request(request_id):
+    """
+    Replace the stored matches of one request. Requests that are no longer
+    open lose their matches. Returns the number stored.
+    """
+    from .models import RequestMatch, ServiceRequest
+
+    request = ServiceRequest.objects.filter(pk=request_id).first()
+    if request is None or request.status != 'open':
+        RequestMatch.objects.filter(request_id=request_id).delete()
+        return 0
+
+    scores = score_services(request, candidate_services(request))
+    best = heapq.nlargest(
+        MATCHES_PER_REQUEST,
+        ((score, provider_id, service_id, distance)
+         for provider_id, (score, service_id, distance) in scores.items() if score >= MIN_SCORE)
+    )
+    with transaction.atomic():
+        RequestMatch.objects.filter(request_id=request_id).delete()
+        RequestMatch.objects.bulk_create([
+            RequestMatch(request_id=request_id, provider_id=provider_id, service_id=service_id,
+                         score=score, distance_km=distance)
+            for score, provider_id, service_id, distance in best
+        ])
+    return len(best)
+
+
+def match_provider(provider_id):
+    """
+    Rescore one provider against the open requests in the categories they
+    serve, after their services changed. Returns the number of matches kept.
+    Matches above MIN_SCORE are kept even if the request already has
+    MATCHES_PER_REQUEST better ones; the next match_request trims them.
+    """
+    from services.models import Service
+    from .models import RequestMatch, ServiceRequest
+
+    services = list(Service.objects.filter(provider_id=provider_id, is_available=True).values_list(
+        'category_id', 'id', 'provider_id', 'price', 'latitude', 'longitude', 'location'))
+    stats = provider_scores([provider_id])
+    open_requests = ServiceRequest.objects.filter(
+        status='open', category_id__in={row[0] for row in services}
+    ).exclude(client_id=provider_id)
+
+    matches = []
+    for request in open_requests.iterator(chunk_size=500):
+        rows = [row[1:] for row in services if row[0] == request.category_id]
+        scores = score_services(request, rows, stats)
+        if provider_id in scores and scores[provider_id][0] >= MIN_SCORE:
+            score, service_id, distance = scores[provider_id]
+            matches.append(RequestMatch(
+                request_id=request.id, provider_id=provider_id, service_id=service_id,
+                score=score, distance_km=distance
+            ))
+
+    with transaction.atomic():
+        RequestMatch.objects.filter(provider_id=provider_id).exclude(
+            request_id__in=[match.request_id for match in matches]).delete()
+        RequestMatch.objects.bulk_create(
+            matches,
+            update_conflicts=True,
+            unique_fields=['request', 'provider'],
+            update_fields=['service', 'score', 'distance_km'],
+        )
+    return len(matches)
+
+
+def provider_feed(provider):
+    """
+    The provider's matched open requests, best first
+    """
+    from .models import RequestMatch
+
+    return RequestMatch.objects.filter(provider=provider).select_related(
+        'request__client', 'request__category', 'service'
+    ).order_by('-score', '-id')
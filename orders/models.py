@@ -1,8 +1,14 @@
-from django.db import models
+from datetime import timedelta
+
+from django.db import models, transaction
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery, Window
+from django.db.models.functions import Coalesce, RowNumber
 from django.conf import settings
 from django.utils import timezone
 from services.models import Service
 
+from . import counters
+
 class Order(models.Model):
     STATUS_CHOICES = (
         ('pending', 'Pending'),
@@ -12,6 +18,15 @@ class Order(models.Model):
         ('cancelled', 'Cancelled'),
         ('refunded', 'Refunded'),
     )
+    # Allowed status changes (see orders.transitions)
+    TRANSITIONS = {
+        'pending': ('confirmed', 'cancelled'),
+        'confirmed': ('in_progress', 'completed', 'cancelled', 'refunded'),
+        'in_progress': ('completed', 'cancelled'),
+        'completed': ('refunded',),
+        'cancelled': ('refunded',),
+        'refunded': (),
+    }
 
     client = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='orders')
     service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='orders')
@@ -20,10 +35,14 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     quantity = models.PositiveIntegerField(default=1)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # Bumped on every status change; guards concurrent transitions
+    version = models.PositiveIntegerField(default=1)
 
     # Scheduling information
     scheduled_date = models.DateTimeField(null=True, blank=True)
     duration_hours = models.PositiveIntegerField(default=1, help_text="Duration in hours")
+    # scheduled_date + duration_hours, kept so overlap checks are an index range scan
+    scheduled_end = models.DateTimeField(null=True, blank=True, editable=False)
     is_flexible_timing = models.BooleanField(default=False)
 
     # Location and delivery
@@ -49,17 +68,50 @@ class Order(models.Model):
         ordering = ['-created_at']
         verbose_name = 'Order'
         verbose_name_plural = 'Orders'
+        indexes = [
+            # Interval index for booking conflict checks (see orders.booking)
+            models.Index(fields=['provider', 'scheduled_date', 'scheduled_end'], name='order_provider_interval_idx'),
+        ]
 
     def __str__(self):
         return f"Order #{self.id} by {self.client.username}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember loaded values so signal handlers can see what changed
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
     def save(self, *args, **kwargs):
         # Set provider from service if not already set
         if not self.provider_id:
             self.provider = self.service.provider
 
-        # Calculate total amount
-        self.total_amount = self.service.price * self.quantity
+        # Calculate total amount, only when it can have changed
+        loaded = getattr(self, '_loaded_values', {})
+        update_fields = kwargs.get('update_fields')
+        if (self._state.adding or self.total_amount is None
+                or loaded.get('service_id') != self.service_id or loaded.get('quantity') != self.quantity):
+            self.total_amount = self.service.price * self.quantity
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = set(update_fields) | {'total_amount'}
+
+        # Status changes made through save() still invalidate readers' versions
+        if not self._state.adding and 'status' in loaded and loaded['status'] != self.status:
+            self.version += 1
+            if update_fields is not None:
+                update_fields = kwargs['update_fields'] = set(update_fields) | {'version'}
+
+        # Keep the end of the booked interval in sync
+        if self.scheduled_date:
+            self.scheduled_end = self.scheduled_date + timedelta(hours=max(self.duration_hours or 1, 1))
+        else:
+            self.scheduled_end = None
+        if update_fields is not None and {'scheduled_date', 'duration_hours'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'scheduled_end'}
 
         # Update status timestamps
         if self.status == 'confirmed' and not self.confirmed_at:
@@ -70,16 +122,23 @@ class Order(models.Model):
             self.completed_at = timezone.now()
 
         super().save(*args, **kwargs)
+        self._loaded_values = {
+            **getattr(self, '_loaded_values', {}),
+            'service_id': self.service_id, 'quantity': self.quantity,
+            'status': self.status, 'version': self.version,
+        }
 
     def get_total_amount(self):
         return self.service.price * self.quantity
 
     def update_status(self, new_status):
-        if new_status in dict(self.STATUS_CHOICES):
-            self.status = new_status
-            self.save()
-            return True
-        return False
+        from .transitions import InvalidTransition, transition
+
+        try:
+            transition(self, new_status)
+        except InvalidTransition:
+            return False
+        return True
 
     def can_be_cancelled(self):
         """Check if order can still be cancelled"""
@@ -95,10 +154,14 @@ class Order(models.Model):
 
 class Notification(models.Model):
     NOTIFICATION_TYPES = (
+        ('new_order', 'New Order'),
         ('order_confirmed', 'Order Confirmed'),
+        ('order_in_progress', 'Order In Progress'),
         ('order_cancelled', 'Order Cancelled'),
         ('order_completed', 'Order Completed'),
         ('payment_received', 'Payment Received'),
+        ('payment_failed', 'Payment Failed'),
+        ('new_review', 'New Review'),
         ('new_message', 'New Message'),
         ('reminder', 'Reminder'),
         ('promotion', 'Promotion'),
@@ -115,23 +178,79 @@ class Notification(models.Model):
     is_read = models.BooleanField(default=False)
     is_sent = models.BooleanField(default=False)  # For push notifications
     data = models.JSONField(null=True, blank=True, help_text="Additional data for the notification")
+    # Identifies repeats of the same event for dedup windows (see orders.notifications)
+    dedup_key = models.CharField(max_length=200, blank=True, default='')
 
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['dedup_key', 'recipient', 'created_at'], name='notification_dedup_idx'),
+        ]
+        constraints = [
+            # Reminder dedup keys name the order and the day (see orders.utils)
+            models.UniqueConstraint(
+                fields=['recipient', 'dedup_key'],
+                condition=models.Q(notification_type='reminder'),
+                name='notification_reminder_unique',
+            ),
+        ]
 
     def __str__(self):
         return f"{self.notification_type}: {self.title}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Lets the unread counter see is_read changes made through save()
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        counters.invalidate(self.recipient_id)
+        return result
+
     def mark_as_read(self):
+        # Conditional update so concurrent requests decrement the counter once
+        updated = Notification.objects.filter(pk=self.pk, is_read=False).update(is_read=True)
         self.is_read = True
-        self.save()
+        if hasattr(self, '_loaded_values'):
+            self._loaded_values['is_read'] = True
+        if updated:
+            counters.adjust(self.recipient_id, -1)
 
     def mark_as_sent(self):
         self.is_sent = True
         self.save()
 
+class ConversationQuerySet(models.QuerySet):
+    def for_inbox(self, user):
+        """
+        Prefetch participants and each conversation's latest message and
+        annotate the user's unread count, so ConversationSerializer renders
+        a page of conversations in a fixed number of queries
+        """
+        unread = Message.objects.filter(
+            conversation=OuterRef('pk'), is_read=False
+        ).exclude(sender=user).order_by().values('conversation').annotate(total=Count('id')).values('total')
+        latest = Message.objects.annotate(
+            position=Window(
+                RowNumber(),
+                partition_by=F('conversation'),
+                order_by=[F('created_at').desc(), F('id').desc()]
+            )
+        ).filter(position=1).select_related('sender')
+        return self.annotate(
+            unread_count=Coalesce(Subquery(unread), 0)
+        ).prefetch_related(
+            'participants',
+            Prefetch('messages', queryset=latest, to_attr='latest_messages'),
+        )
+
 class Conversation(models.Model):
     participants = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='conversations')
     related_order = models.ForeignKey('Order', on_delete=models.CASCADE, null=True, blank=True)
@@ -140,8 +259,13 @@ class Conversation(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ConversationQuerySet.as_manager()
+
     class Meta:
         ordering = ['-updated_at']
+        indexes = [
+            models.Index(fields=['-updated_at', '-id'], name='conversation_inbox_idx'),
+        ]
 
     def __str__(self):
         return f"Conversation: {self.subject}"
@@ -165,15 +289,38 @@ class Message(models.Model):
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['conversation', 'created_at', 'id'], name='message_history_idx'),
+            models.Index(fields=['conversation', 'is_read'], name='message_unread_idx'),
+        ]
 
     def __str__(self):
         return f"Message from {self.sender.username}: {self.content[:50]}"
 
     def save(self, *args, **kwargs):
-        super().save(*args, **kwargs)
-        # Update conversation timestamp
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Move the conversation to the top of the inbox without
+            # rewriting the whole row
+            Conversation.objects.filter(pk=self.conversation_id).update(updated_at=self.created_at)
         self.conversation.updated_at = self.created_at
-        self.conversation.save()
+
+    @classmethod
+    def mark_read(cls, conversation, user, up_to=None):
+        """
+        Mark the messages other participants sent to user in conversation
+        as read, up to and including message id up_to (default: all), in
+        one UPDATE. Returns the number marked.
+        """
+        messages = cls.objects.filter(conversation=conversation, is_read=False).exclude(sender=user)
+        if up_to is not None:
+            position = cls.objects.filter(pk=up_to, conversation=conversation).values('created_at')
+            messages = messages.filter(
+                Q(created_at__lt=Subquery(position)) | Q(created_at=Subquery(position), id__lte=up_to)
+            )
+        return messages.update(is_read=True)
 
 class ServiceRequest(models.Model):
     client = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='service_requests')
@@ -183,6 +330,9 @@ class ServiceRequest(models.Model):
     budget_min = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     budget_max = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
     location = models.CharField(max_length=255)
+    # Optional; used to match providers by distance (see orders.matching)
+    latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     preferred_date = models.DateTimeField(null=True, blank=True)
     urgency = models.CharField(max_length=20, choices=[
         ('low', 'Low'),
@@ -217,3 +367,24 @@ class ServiceRequest(models.Model):
         elif self.budget_max:
             return f"Up to KES {self.budget_max}"
         return "Budget not specified"
+
+class RequestMatch(models.Model):
+    """A provider's precomputed candidacy for an open service request"""
+    request = models.ForeignKey(ServiceRequest, on_delete=models.CASCADE, related_name='matches')
+    provider = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='request_matches')
+    # The provider's best fitting service for the request
+    service = models.ForeignKey('services.Service', on_delete=models.CASCADE, related_name='request_matches')
+    score = models.FloatField()
+    distance_km = models.FloatField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['request', 'provider'], name='unique_request_match'),
+        ]
+        indexes = [
+            models.Index(fields=['provider', '-score', '-id'], name='request_match_feed_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} for {self.request} ({self.score:.2f})"
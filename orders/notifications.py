@@ -0,0 +1,164 @@
+"""
+Notification dispatch.
+
+Request handlers describe notifications as events (plain dicts of ids) and
+hand them to dispatch(), which queues a single Celery task once the
+transaction commits. The worker coalesces the batch, drops events already
+delivered to the same recipient within their dedup window, and writes the
+rest with one bulk_create. Reminders are also unique in the database, so
+two runs racing past the window check still write each reminder once.
+"""
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from service_app.queue import enqueue
+from . import counters
+from .events import publish_notifications
+
+logger = logging.getLogger(__name__)
+
+# Repeats of an event (same recipient and dedup key) inside the window are
+# dropped. The default catches double submits and retried webhooks.
+DEFAULT_DEDUP_WINDOW = timedelta(minutes=1)
+DEDUP_WINDOWS = {
+    'new_message': timedelta(minutes=5),
+    # Reminder keys carry the order and day, so this only has to outlast
+    # reruns of the daily job
+    'reminder': timedelta(days=2),
+}
+
+# Types with a unique constraint on (recipient, dedup_key); their inserts
+# ignore conflicts
+UNIQUE_TYPES = ('reminder',)
+
+BULK_BATCH_SIZE = 500
+
+
+def _pk(value):
+    return getattr(value, 'pk', value)
+
+
+def event(recipient, notification_type, title, message, sender=None, related_order=None,
+          related_service=None, data=None, dedup_key=None):
+    """
+    Describe a notification; model instances or ids are accepted
+    """
+    related_order_id = _pk(related_order)
+    related_service_id = _pk(related_service)
+    if dedup_key is None:
+        dedup_key = f"{notification_type}:{related_order_id or ''}:{related_service_id or ''}"
+    return {
+        'recipient_id': _pk(recipient),
+        'sender_id': _pk(sender),
+        'notification_type': notification_type,
+        'title': title,
+        'message': message,
+        'related_order_id': related_order_id,
+        'related_service_id': related_service_id,
+        'data': data,
+        'dedup_key': dedup_key,
+    }
+
+
+def dispatch(events):
+    """
+    Queue events for delivery after the current transaction commits
+    """
+    from .tasks import deliver_notifications
+
+    events = [item for item in events if item['recipient_id']]
+    if events:
+        enqueue(deliver_notifications, events)
+
+
+def notify(recipient, notification_type, title, message, **kwargs):
+    dispatch([event(recipient, notification_type, title, message, **kwargs)])
+
+
+def deliver(events, now=None):
+    """
+    Write a batch of events as notifications, skipping duplicates within the
+    batch and within each type's dedup window. Returns the number created.
+    """
+    from .models import Notification
+
+    now = now or timezone.now()
+
+    batch = {}
+    for item in events:
+        batch.setdefault((item['recipient_id'], item['dedup_key']), item)
+    if not batch:
+        return 0
+
+    # One query finds everything that could still be inside a window, and
+    # any stored notification of a unique type. It filters on the keys
+    # alone: an IN list on both indexed columns makes the database probe
+    # every recipient/key combination.
+    longest = max(DEDUP_WINDOWS.get(item['notification_type'], DEFAULT_DEDUP_WINDOW) for item in batch.values())
+    recent = {}
+    stored = set()
+    for recipient_id, dedup_key, notification_type, created_at in Notification.objects.filter(
+            Q(created_at__gte=now - longest) | Q(notification_type__in=UNIQUE_TYPES),
+            dedup_key__in={dedup_key for _, dedup_key in batch},
+    ).values_list('recipient_id', 'dedup_key', 'notification_type', 'created_at'):
+        key = (recipient_id, dedup_key)
+        if key in batch:
+            recent[key] = max(created_at, recent.get(key, created_at))
+            if notification_type in UNIQUE_TYPES:
+                stored.add(key)
+
+    notifications = []
+    unique = []
+    for key, item in batch.items():
+        window = DEDUP_WINDOWS.get(item['notification_type'], DEFAULT_DEDUP_WINDOW)
+        if key in recent and recent[key] >= now - window:
+            continue
+        if key in stored and item['notification_type'] in UNIQUE_TYPES:
+            continue
+        (unique if item['notification_type'] in UNIQUE_TYPES else notifications).append(Notification(**item))
+
+    Notification.objects.bulk_create(notifications, batch_size=BULK_BATCH_SIZE)
+    # bulk_create skips post_save, so move the unread counters here
+    created = defaultdict(int)
+    for notification in notifications:
+        created[notification.recipient_id] += 1
+    for recipient_id, count in created.items():
+        counters.adjust(recipient_id, count)
+    if unique:
+        _write_unique(unique)
+        notifications += unique
+    publish_notifications(notifications)
+    skipped = len(events) - len(notifications)
+    if skipped:
+        logger.debug("Dropped %s duplicate notifications", skipped)
+    return len(notifications)
+
+
+def _write_unique(notifications):
+    """
+    Insert notifications of UNIQUE_TYPES, leaving out any a concurrent
+    delivery wrote first, and load their ids
+    """
+    from .models import Notification
+
+    Notification.objects.bulk_create(notifications, batch_size=BULK_BATCH_SIZE, ignore_conflicts=True)
+    # Ids are not returned for ignored conflicts; whichever copy was stored
+    # stands for the notification
+    stored = {
+        (recipient_id, dedup_key): (pk, created_at)
+        for pk, recipient_id, dedup_key, created_at in Notification.objects.filter(
+            dedup_key__in={notification.dedup_key for notification in notifications},
+            notification_type__in=UNIQUE_TYPES,
+        ).values_list('id', 'recipient_id', 'dedup_key', 'created_at')
+    }
+    for notification in notifications:
+        notification.pk, notification.created_at = stored.get(
+            (notification.recipient_id, notification.dedup_key), (None, notification.created_at)
+        )
+    # Which copies were ours is unknown, so the counters recount
+    for recipient_id in {notification.recipient_id for notification in notifications}:
+        counters.invalidate(recipient_id)
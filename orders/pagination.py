@@ -0,0 +1,90 @@
+import base64
+import binascii
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class InboxPagination(CursorPagination):
+    """
+    Most recently active conversations first. Cursors seek on updated_at,
+    so every page costs the same.
+    """
+    ordering = ('-updated_at', '-id')
+    page_size = 20
+    page_size_query_param = 'per_page'
+    max_page_size = 100
+
+
+class MessageHistoryPagination(BasePagination):
+    """
+    Keyset pagination over (created_at, id) for a conversation's messages.
+
+    Without a cursor the newest page is returned; ?before=<cursor> pages
+    back through older messages and ?after=<cursor> fetches newer ones.
+    Results are always oldest first. Cursors are opaque tokens naming a
+    message's position, so a page costs the same however deep it is.
+    """
+    page_size = 50
+    page_size_query_param = 'per_page'
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+
+        if after:
+            created_at, pk = self.decode_cursor(after)
+            queryset = queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=pk))
+            rows = list(queryset.order_by('created_at', 'id')[:self.page_size + 1])
+            self.has_older = True
+            rows = rows[:self.page_size]
+        else:
+            if before:
+                created_at, pk = self.decode_cursor(before)
+                queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk))
+            rows = list(queryset.order_by('-created_at', '-id')[:self.page_size + 1])
+            self.has_older = len(rows) > self.page_size
+            rows = rows[:self.page_size][::-1]
+        self.rows = rows
+        return rows
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            return self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def encode_cursor(self, message):
+        payload = json.dumps([message.created_at.isoformat(), message.id], separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            created_at, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            created_at = parse_datetime(created_at)
+            if created_at is None:
+                raise ValueError(cursor)
+            return created_at, int(pk)
+        except (binascii.Error, ValueError, TypeError):
+            raise NotFound('Invalid cursor')
+
+    def get_paginated_response(self, data):
+        # previous pages back to older messages, next forward to newer ones
+        url = self.request.build_absolute_uri()
+        previous = next = None
+        if self.rows and self.has_older:
+            previous = replace_query_param(remove_query_param(url, 'after'), 'before', self.encode_cursor(self.rows[0]))
+        if self.rows:
+            # Always offered so clients can poll for new messages
+            next = replace_query_param(remove_query_param(url, 'before'), 'after', self.encode_cursor(self.rows[-1]))
+        return Response({'previous': previous, 'next': next, 'results': data})
@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from .models import Order, Notification, Conversation, Message, ServiceRequest
+from .models import Order, Notification, Conversation, Message, RequestMatch, ServiceRequest
 
 class OrderSerializer(serializers.ModelSerializer):
     service_name = serializers.CharField(source='service.name', read_only=True)
@@ -11,7 +11,7 @@ class OrderSerializer(serializers.ModelSerializer):
     class Meta:
         model = Order
         fields = [
-            'id', 'client', 'service', 'provider', 'status', 'quantity',
+            'id', 'client', 'service', 'provider', 'status', 'version', 'quantity',
             'total_amount', 'scheduled_date', 'duration_hours', 'is_flexible_timing',
             'delivery_address', 'service_location', 'notes', 'special_requirements',
             'provider_notes', 'estimated_completion',
@@ -19,7 +19,7 @@ class OrderSerializer(serializers.ModelSerializer):
             'can_cancel', 'is_overdue',
             'created_at', 'updated_at', 'confirmed_at', 'started_at', 'completed_at'
         ]
-        read_only_fields = ['client', 'provider', 'total_amount', 'created_at', 'updated_at',
+        read_only_fields = ['client', 'provider', 'version', 'total_amount', 'created_at', 'updated_at',
                            'confirmed_at', 'started_at', 'completed_at']
 
     def get_can_cancel(self, obj):
@@ -45,7 +45,11 @@ class ConversationSerializer(serializers.ModelSerializer):
         return [user.get_full_name() or user.username for user in obj.participants.all()]
 
     def get_last_message(self, obj):
-        last_msg = obj.messages.last()
+        # Prefetched by Conversation.objects.for_inbox
+        if hasattr(obj, 'latest_messages'):
+            last_msg = obj.latest_messages[0] if obj.latest_messages else None
+        else:
+            last_msg = obj.messages.last()
         if last_msg:
             return {
                 'content': last_msg.content[:100],
@@ -55,6 +59,8 @@ class ConversationSerializer(serializers.ModelSerializer):
         return None
 
     def get_unread_count(self, obj):
+        if hasattr(obj, 'unread_count'):
+            return obj.unread_count
         request = self.context.get('request')
         if request and request.user.is_authenticated:
             return obj.messages.filter(is_read=False).exclude(sender=request.user).count()
@@ -80,14 +86,22 @@ class ServiceRequestSerializer(serializers.ModelSerializer):
         model = ServiceRequest
         fields = [
             'id', 'client', 'client_name', 'category', 'category_name', 'title', 'description',
-            'budget_min', 'budget_max', 'budget_range', 'location', 'preferred_date',
-            'urgency', 'status', 'assigned_provider', 'created_at', 'updated_at'
+            'budget_min', 'budget_max', 'budget_range', 'location', 'latitude', 'longitude',
+            'preferred_date', 'urgency', 'status', 'assigned_provider', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'client', 'client_name', 'created_at', 'updated_at']
 
     def get_budget_range(self, obj):
         return obj.get_budget_range()
 
+class RequestMatchSerializer(serializers.ModelSerializer):
+    request = ServiceRequestSerializer(read_only=True)
+    service_name = serializers.CharField(source='service.name', read_only=True)
+
+    class Meta:
+        model = RequestMatch
+        fields = ['id', 'request', 'service', 'service_name', 'score', 'distance_km', 'created_at']
+
 class NotificationSerializer(serializers.ModelSerializer):
     sender_name = serializers.CharField(source='sender.get_full_name', read_only=True)
     related_order_id = serializers.IntegerField(source='related_order.id', read_only=True)
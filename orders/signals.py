@@ -0,0 +1,53 @@
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from service_app.queue import enqueue
+from services.models import Service
+from . import counters, events
+from .models import Message, Notification, ServiceRequest
+from .tasks import match_provider_requests, match_service_request
+
+# Service columns that feed request matching
+MATCHING_FIELDS = {'category_id', 'price', 'latitude', 'longitude', 'location', 'is_available'}
+
+
+@receiver(post_save, sender=Notification)
+def count_unread_notification(sender, instance, created, **kwargs):
+    if created:
+        if not instance.is_read:
+            counters.adjust(instance.recipient_id, 1)
+        events.publish_notifications([instance])
+        return
+    previous = getattr(instance, '_loaded_values', {})
+    if 'is_read' in previous and previous['is_read'] != instance.is_read:
+        counters.adjust(instance.recipient_id, -1 if instance.is_read else 1)
+    instance._loaded_values = dict(previous, is_read=instance.is_read)
+
+
+@receiver(post_save, sender=Message)
+def publish_message(sender, instance, created, **kwargs):
+    if created:
+        recipients = instance.conversation.participants.exclude(id=instance.sender_id).values_list('id', flat=True)
+        events.publish_on_commit(recipients, 'message', events.message_data(instance))
+
+
+@receiver(post_save, sender=ServiceRequest)
+def match_saved_request(sender, instance, **kwargs):
+    # Also clears the matches of requests that were closed
+    enqueue(match_service_request, instance.id)
+
+
+# Decided before saving: post_save receivers in services replace
+# _loaded_values with the saved state
+@receiver(pre_save, sender=Service)
+def detect_matching_change(sender, instance, **kwargs):
+    previous = getattr(instance, '_loaded_values', {})
+    instance._matching_changed = instance._state.adding or any(
+        previous[field] != getattr(instance, field) for field in MATCHING_FIELDS if field in previous
+    )
+
+
+@receiver(post_save, sender=Service)
+def match_provider_on_service_change(sender, instance, **kwargs):
+    if getattr(instance, '_matching_changed', False):
+        enqueue(match_provider_requests, instance.provider_id)
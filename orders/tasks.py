@@ -0,0 +1,34 @@
+from celery import shared_task
+
+from . import matching, notifications, utils
+
+
+@shared_task
+def deliver_notifications(events):
+    """Write a batch of queued notification events"""
+    return notifications.deliver(events)
+
+
+@shared_task
+def send_reminder_notifications():
+    """Queue tomorrow's service reminders in chunks"""
+    totals = utils.send_reminder_notifications()
+    return {'orders': totals['orders'], 'chunks': totals['chunks']}
+
+
+@shared_task
+def send_reminder_chunk(day, first_id, last_id):
+    """Send the reminders of one id range of orders"""
+    return utils.send_reminders_for_range(day, first_id, last_id)
+
+
+@shared_task
+def match_service_request(request_id):
+    """Score an open service request against providers"""
+    return matching.match_request(request_id)
+
+
+@shared_task
+def match_provider_requests(provider_id):
+    """Rescore a provider against open requests after their services changed"""
+    return matching.match_provider(provider_id)
@@ -1,10 +1,27 @@
-from django.test import TestCase
+import asyncio
+import json
+import threading
+from io import StringIO
+from datetime import datetime, time, timedelta
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase
+from asgiref.sync import sync_to_async
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.cache import cache
 from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken
 from rest_framework import status
 from django.urls import reverse
 from django.utils import timezone
-from .models import Order, Notification
+from .booking import BookingConflict, book
+from . import events, notifications
+from .models import Order, Notification, Conversation, Message, RequestMatch, ServiceRequest
+from .notifications import deliver, event
+from .transitions import InvalidTransition, TransitionConflict, transition
+from .utils import notify_order_status_change, send_reminder_notifications
 from services.models import Service, Category
 
 User = get_user_model()
@@ -156,3 +173,745 @@ class OrderAPITest(APITestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(len(response.data), 1)
+
+class BookingConflictTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.clients = [
+            User.objects.create_user(
+                username=f'client{i}', email=f'client{i}@test.com', password='testpass123', account_type='client'
+            )
+            for i in range(2)
+        ]
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name='Test Service',
+            description='Test service',
+            price=50.00,
+            base_price=50.00,
+            image='services/test.jpg',
+            location='Nairobi'
+        )
+        self.start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+
+    def test_overlapping_bookings_conflict(self):
+        book(self.clients[0], self.service, scheduled_date=self.start, duration_hours=2)
+
+        with self.assertRaises(BookingConflict):
+            book(self.clients[1], self.service, scheduled_date=self.start + timedelta(hours=1))
+
+        # Back-to-back bookings do not overlap
+        book(self.clients[1], self.service, scheduled_date=self.start + timedelta(hours=2))
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_cancelled_orders_free_their_slot(self):
+        order = book(self.clients[0], self.service, scheduled_date=self.start, duration_hours=2)
+        order.status = 'cancelled'
+        order.save()
+        book(self.clients[1], self.service, scheduled_date=self.start)
+        self.assertEqual(Order.objects.filter(status='pending').count(), 1)
+
+    def test_booking_view_returns_conflict(self):
+        book(self.clients[0], self.service, scheduled_date=self.start, duration_hours=3)
+        self.client.force_authenticate(user=self.clients[1])
+        url = reverse('orders:order-booking', kwargs={'service_id': self.service.id})
+
+        local = timezone.localtime(self.start + timedelta(hours=1))
+        response = self.client.post(url, {
+            'scheduled_date': local.date().isoformat(),
+            'scheduled_time': local.strftime('%H:%M'),
+        })
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.client.post(url, {'scheduled_date': 'tomorrow'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_order_api_checks_conflicts(self):
+        book(self.clients[0], self.service, scheduled_date=self.start, duration_hours=3)
+        self.client.force_authenticate(user=self.clients[1])
+        url = reverse('orders:order-list-create')
+
+        response = self.client.post(url, {
+            'service': self.service.id,
+            'scheduled_date': (self.start + timedelta(hours=1)).isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.client.post(url, {
+            'service': self.service.id,
+            'scheduled_date': (self.start + timedelta(hours=3)).isoformat(),
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['provider'], self.provider.id)
+        self.assertEqual(Order.objects.count(), 2)
+
+
+class ConcurrentBookingTest(TransactionTestCase):
+    workers = 8
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest("Concurrent bookings need a database shared between connections")
+        self.provider = User.objects.create_user(
+            username='provider', email='provider@test.com', password='testpass123', account_type='provider'
+        )
+        self.clients = [
+            User.objects.create_user(
+                username=f'client{i}', email=f'client{i}@test.com', password='testpass123', account_type='client'
+            )
+            for i in range(self.workers)
+        ]
+        category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider,
+            category=category,
+            name='Test Service',
+            description='Test service',
+            price=50.00,
+            base_price=50.00,
+            image='services/test.jpg',
+            location='Nairobi'
+        )
+
+    def test_parallel_bookings_of_one_slot(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        barrier = threading.Barrier(self.workers)
+        outcomes = []
+
+        def attempt(client, offset):
+            try:
+                barrier.wait()
+                book(client, self.service, scheduled_date=start + timedelta(minutes=offset), duration_hours=1)
+                outcomes.append('booked')
+            except BookingConflict:
+                outcomes.append('conflict')
+            finally:
+                connection.close()
+
+        # Every start lies within an hour of the others, so all of them overlap
+        threads = [
+            threading.Thread(target=attempt, args=(client, 5 * i))
+            for i, client in enumerate(self.clients)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes.count('booked'), 1)
+        self.assertEqual(outcomes.count('conflict'), self.workers - 1)
+        self.assertEqual(Order.objects.filter(provider=self.provider).count(), 1)
+
+
+class NotificationDispatchTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.client_user = User.objects.create_user(
+            username='client',
+            email='client@test.com',
+            password='testpass123',
+            account_type='client'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name='Test Service',
+            description='Test service',
+            price=50.00,
+            base_price=50.00,
+            image='services/test.jpg',
+            location='Nairobi'
+        )
+        self.order = Order.objects.create(client=self.client_user, service=self.service, provider=self.provider)
+
+    def reminder(self, recipient):
+        return event(recipient, 'reminder', 'Reminder', 'Tomorrow', related_order=self.order)
+
+    def message(self, recipient):
+        return event(recipient, 'new_message', 'Message', 'Hello', related_order=self.order)
+
+    def test_batch_is_written_in_one_insert(self):
+        events = [self.message(self.client_user), self.message(self.provider)]
+        with self.assertNumQueries(2):
+            self.assertEqual(deliver(events), 2)
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_duplicates_are_dropped(self):
+        self.assertEqual(deliver([self.message(self.client_user), self.message(self.client_user)]), 1)
+        # Still inside the window
+        self.assertEqual(deliver([self.message(self.client_user)]), 0)
+        later = timezone.now() + timedelta(days=3)
+        self.assertEqual(deliver([self.message(self.client_user)], now=later), 1)
+        self.assertEqual(Notification.objects.filter(recipient=self.client_user).count(), 2)
+
+    def test_reminders_are_unique(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(deliver([self.reminder(self.client_user), self.reminder(self.provider)]), 2)
+        self.assertTrue(Notification.objects.filter(recipient=self.client_user, notification_type='reminder').exists())
+        # Past the window as well
+        later = timezone.now() + timedelta(days=3)
+        self.assertEqual(deliver([self.reminder(self.client_user)], now=later), 0)
+
+        # A run that raced past the check loses its copy to the constraint
+        stored = Notification.objects.get(recipient=self.client_user, notification_type='reminder')
+        duplicate = Notification(**self.reminder(self.client_user))
+        notifications._write_unique([duplicate])
+        self.assertEqual(duplicate.pk, stored.pk)
+        self.assertEqual(Notification.objects.filter(notification_type='reminder').count(), 2)
+
+    def test_status_change_is_delivered_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            notify_order_status_change(self.order, 'pending', 'completed')
+            self.assertFalse(Notification.objects.exists())
+        self.assertEqual(
+            set(Notification.objects.values_list('recipient_id', flat=True)),
+            {self.client_user.id, self.provider.id}
+        )
+
+    def test_order_creation_notifies_provider(self):
+        self.client.force_authenticate(user=self.client_user)
+        url = reverse('orders:order-list-create')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(url, {'service': self.service.id, 'quantity': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        notification = Notification.objects.get(recipient=self.provider)
+        self.assertEqual(notification.notification_type, 'new_order')
+        self.assertEqual(notification.related_order_id, response.data['id'])
+
+    def test_reminders_are_sent_once_per_order(self):
+        tomorrow = timezone.localdate() + timedelta(days=1)
+        scheduled = timezone.make_aware(datetime.combine(tomorrow, time(10)))
+        Order.objects.filter(pk=self.order.pk).update(scheduled_date=scheduled)
+        for _ in range(2):
+            Order.objects.create(
+                client=self.client_user, service=self.service, provider=self.provider,
+                scheduled_date=scheduled, status='confirmed'
+            )
+
+        totals = send_reminder_notifications(chunk_size=2, inline=True)
+        self.assertEqual((totals['orders'], totals['chunks'], totals['notifications']), (3, 2, 6))
+        self.assertEqual(Notification.objects.filter(notification_type='reminder').count(), 6)
+
+        # Queued chunks run eagerly here; a rerun sends nothing new
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            send_reminder_notifications(chunk_size=2)
+        self.assertEqual(len(callbacks), 2)
+        self.assertEqual(Notification.objects.filter(notification_type='reminder').count(), 6)
+        self.assertIn('scheduled for tomorrow', Notification.objects.filter(notification_type='reminder')[0].message)
+
+    def test_reminders_for_another_day_name_it(self):
+        day = timezone.localdate() + timedelta(days=3)
+        scheduled = timezone.make_aware(datetime.combine(day, time(10)))
+        Order.objects.filter(pk=self.order.pk).update(scheduled_date=scheduled)
+
+        call_command('send_reminders', date=day, inline=True, stdout=StringIO())
+        notification = Notification.objects.get(recipient=self.client_user, notification_type='reminder')
+        self.assertNotIn('tomorrow', notification.message)
+        self.assertIn(day.strftime('%d %B %Y'), notification.message)
+
+
+class UnreadCounterTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username='client',
+            email='client@test.com',
+            password='testpass123',
+            account_type='client'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('orders:unread-count')
+
+    def notify(self, count=1):
+        with self.captureOnCommitCallbacks(execute=True):
+            for i in range(count):
+                Notification.objects.create(
+                    recipient=self.user, notification_type='promotion', title=f'Offer {i}', message='Offer'
+                )
+
+    def unread(self):
+        return self.client.get(self.url).data['unread_count']
+
+    def test_count_is_served_from_cache(self):
+        self.notify(2)
+        self.assertEqual(self.unread(), 2)
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.data['unread_count'], 2)
+
+        # Unchanged count: 304 with no body
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.notify()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['unread_count'], 3)
+
+    def test_reads_and_clears_update_the_counter(self):
+        self.notify(3)
+        notification = Notification.objects.filter(recipient=self.user).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.mark_as_read()
+            # A second read does not count twice
+            notification.mark_as_read()
+        self.assertEqual(self.unread(), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            notification.is_read = False
+            notification.save()
+        self.assertEqual(self.unread(), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('orders:mark-all-read'))
+        self.assertEqual(response.data['marked_count'], 3)
+        self.assertEqual(self.unread(), 0)
+
+        self.notify()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(reverse('orders:clear-all-notifications'))
+        self.assertEqual(self.unread(), 0)
+
+    def test_missing_or_corrupt_counter_is_recounted(self):
+        self.notify(2)
+        cache.set(f'notifications:unread:{self.user.id}', 'garbage')
+        self.assertEqual(self.unread(), 2)
+        cache.delete(f'notifications:unread:{self.user.id}')
+        self.assertEqual(self.unread(), 2)
+
+    def test_deletes_update_the_counter(self):
+        self.notify(3)
+        with self.captureOnCommitCallbacks(execute=True):
+            Notification.objects.filter(recipient=self.user).first().delete()
+        self.assertEqual(self.unread(), 2)
+
+        # Cleared without loading the rows
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse('orders:clear-all-notifications'))
+        self.assertEqual(response.data['deleted_count'], 2)
+        self.assertEqual(self.unread(), 0)
+
+
+
+class ConversationInboxTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='provider', email='provider@test.com', password='testpass123', account_type='provider'
+        )
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('orders:conversations')
+
+    def add_conversations(self, count):
+        for i in range(count):
+            other = User.objects.create_user(username=f'client{User.objects.count()}', password='testpass123')
+            conversation = Conversation.objects.create(subject=f'Job {i}')
+            conversation.participants.add(self.user, other)
+            Message.objects.create(conversation=conversation, sender=self.user, content='Quote attached')
+            Message.objects.create(conversation=conversation, sender=other, content=f'Reply {i}')
+            Message.objects.create(conversation=conversation, sender=other, content=f'Latest {i}')
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.add_conversations(2)
+        with CaptureQueriesContext(connection) as small:
+            self.client.get(self.url)
+        self.add_conversations(8)
+        with CaptureQueriesContext(connection) as large:
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertEqual(len(small.captured_queries), len(large.captured_queries))
+
+        newest = response.data['results'][0]
+        self.assertEqual(newest['subject'], 'Job 7')
+        self.assertEqual(newest['last_message']['content'], 'Latest 7')
+        self.assertEqual(newest['unread_count'], 2)
+
+    def test_cursor_pages_follow_activity(self):
+        self.add_conversations(3)
+        response = self.client.get(self.url, {'per_page': 2})
+        self.assertEqual([row['subject'] for row in response.data['results']], ['Job 2', 'Job 1'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([row['subject'] for row in response.data['results']], ['Job 0'])
+        self.assertIsNone(response.data['next'])
+
+        # A new message moves its conversation back to the top
+        conversation = Conversation.objects.get(subject='Job 0')
+        Message.objects.create(conversation=conversation, sender=self.user, content='Any update?')
+        response = self.client.get(self.url, {'per_page': 2})
+        self.assertEqual(response.data['results'][0]['subject'], 'Job 0')
+        self.assertEqual(response.data['results'][0]['unread_count'], 2)
+
+
+class MessageHistoryTest(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.other = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.conversation = Conversation.objects.create(subject='Booking')
+        self.conversation.participants.add(self.user, self.other)
+        self.client.force_authenticate(user=self.user)
+        self.url = reverse('orders:conversation-messages', kwargs={'conversation_id': self.conversation.id})
+
+    def test_create_is_one_insert_and_one_column_update(self):
+        with CaptureQueriesContext(connection) as queries:
+            Message.objects.create(conversation=self.conversation, sender=self.user, content='Hello')
+        writes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith(('INSERT', 'UPDATE'))]
+        self.assertEqual(len(writes), 2)
+        self.assertTrue(writes[0].startswith('INSERT INTO "orders_message"'))
+        self.assertTrue(writes[1].startswith('UPDATE "orders_conversation" SET "updated_at" = '))
+        self.assertNotIn('"subject"', writes[1])
+
+    def test_history_pages_with_before_and_after(self):
+        for i in range(5):
+            Message.objects.create(conversation=self.conversation, sender=self.other, content=f'Message {i}')
+        latest = self.client.get(self.url, {'per_page': 2})
+        self.assertEqual([row['content'] for row in latest.data['results']], ['Message 3', 'Message 4'])
+
+        response = self.client.get(latest.data['previous'])
+        self.assertEqual([row['content'] for row in response.data['results']], ['Message 1', 'Message 2'])
+        older = self.client.get(response.data['previous'])
+        self.assertEqual([row['content'] for row in older.data['results']], ['Message 0'])
+        self.assertIsNone(older.data['previous'])
+
+        # Polling forward from the newest message seen
+        Message.objects.create(conversation=self.conversation, sender=self.other, content='Message 5')
+        response = self.client.get(latest.data['next'])
+        self.assertEqual([row['content'] for row in response.data['results']], ['Message 5'])
+
+        self.assertEqual(self.client.get(self.url, {'before': 'nonsense'}).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_history_is_limited_to_participants(self):
+        outsider = User.objects.create_user(username='outsider', password='testpass123')
+        self.client.force_authenticate(user=outsider)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_mark_read_up_to_a_message(self):
+        messages = [
+            Message.objects.create(conversation=self.conversation, sender=self.other, content=f'Message {i}')
+            for i in range(4)
+        ]
+        Message.objects.create(conversation=self.conversation, sender=self.user, content='Mine')
+        url = reverse('orders:conversation-read', kwargs={'conversation_id': self.conversation.id})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(url, {'up_to': messages[1].id}, format='json')
+        self.assertEqual(response.data['marked_count'], 2)
+        self.assertEqual(sum(query['sql'].startswith('UPDATE') for query in queries.captured_queries), 1)
+        self.assertEqual(
+            list(Message.objects.filter(is_read=True).values_list('content', flat=True)), ['Message 0', 'Message 1']
+        )
+
+        response = self.client.post(url, {}, format='json')
+        self.assertEqual(response.data['marked_count'], 2)
+        # The user's own message stays unread for the other participant
+        self.assertEqual(Message.objects.filter(is_read=False).count(), 1)
+
+
+class RequestMatchingTest(APITestCase):
+    def setUp(self):
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        other_category = Category.objects.create(name='BEAUTY', description='Beauty services')
+        self.near = self.add_provider('near', self.category, 100, -1.2921, 36.8219)
+        self.pricey = self.add_provider('pricey', self.category, 1000, -1.30, 36.80)
+        self.far = self.add_provider('far', self.category, 100, -4.0435, 39.6682)
+        self.other = self.add_provider('other', other_category, 100, -1.2921, 36.8219)
+
+    def add_provider(self, username, category, price, latitude, longitude):
+        provider = User.objects.create_user(username=username, password='testpass123', account_type='provider')
+        with self.captureOnCommitCallbacks(execute=True):
+            Service.objects.create(
+                provider=provider, category=category, name=f'{username} service', description='Service',
+                price=price, base_price=price, image='services/test.jpg', location='Nairobi',
+                latitude=latitude, longitude=longitude
+            )
+        return provider
+
+    def open_request(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return ServiceRequest.objects.create(
+                client=self.client_user, category=self.category, title='Fix sink', description='Leaking',
+                budget_min=50, budget_max=150, location='Nairobi', latitude=-1.29, longitude=36.82, urgency='high'
+            )
+
+    def test_new_request_is_matched_to_nearby_providers(self):
+        request = self.open_request()
+        matches = list(RequestMatch.objects.filter(request=request).order_by('-score'))
+        self.assertEqual([match.provider for match in matches], [self.near, self.pricey])
+        self.assertLess(matches[0].distance_km, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            request.status = 'assigned'
+            request.save()
+        self.assertFalse(RequestMatch.objects.exists())
+
+    def test_provider_feed_is_one_query(self):
+        request = self.open_request()
+        self.client.force_authenticate(user=self.near)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('orders:service-request-feed'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([row['request']['id'] for row in response.data], [request.id])
+
+        self.client.force_authenticate(user=self.far)
+        self.assertEqual(self.client.get(reverse('orders:service-request-feed')).data, [])
+
+    def test_matched_providers_can_read_but_not_edit_requests(self):
+        request = self.open_request()
+        url = reverse('orders:service-request-detail', kwargs={'pk': request.pk})
+        self.client.force_authenticate(user=self.near)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+        response = self.client.patch(url, {'status': 'assigned', 'assigned_provider': self.near.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        request.refresh_from_db()
+        self.assertEqual(request.status, 'open')
+        self.assertIsNone(request.assigned_provider)
+
+    def test_new_service_is_matched_against_open_requests(self):
+        request = self.open_request()
+        newcomer = self.add_provider('newcomer', self.category, 120, -1.28, 36.83)
+        self.assertTrue(RequestMatch.objects.filter(request=request, provider=newcomer).exists())
+
+class OrderTransitionTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider, category=self.category, name='Test Service', description='Test service',
+            price=50, base_price=50, image='services/test.jpg', location='Nairobi'
+        )
+
+    def make_orders(self, count):
+        return [Order.objects.create(client=self.client_user, service=self.service) for _ in range(count)]
+
+    def test_transition_is_one_conditional_update(self):
+        order = self.make_orders(1)[0]
+        stale = Order.objects.get(pk=order.pk)
+        with CaptureQueriesContext(connection) as queries:
+            transition(order, 'confirmed', notify=False)
+        updates = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE "orders_order"')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('total_amount', updates[0])
+        self.assertNotIn('notes', updates[0])
+        self.assertEqual((order.status, order.version), ('confirmed', 2))
+        self.assertIsNotNone(Order.objects.get(pk=order.pk).confirmed_at)
+
+        # A writer holding the old version loses
+        with self.assertRaises(TransitionConflict):
+            transition(stale, 'cancelled', notify=False)
+        with self.assertRaises(InvalidTransition):
+            transition(order, 'pending', notify=False)
+        self.assertEqual(Order.objects.get(pk=order.pk).status, 'confirmed')
+
+    def test_save_reuses_total_unless_service_or_quantity_change(self):
+        order = Order.objects.get(pk=self.make_orders(1)[0].pk)
+        order.notes = 'Ring twice'
+        with self.assertNumQueries(1):
+            order.save(update_fields=['notes'])
+        order.quantity = 3
+        order.save()
+        self.assertEqual(Order.objects.get(pk=order.pk).total_amount, 150)
+
+    def test_status_update_view_checks_version(self):
+        order = self.make_orders(1)[0]
+        url = reverse('orders:order-status-update', args=[order.pk])
+        self.client.force_authenticate(user=self.provider)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.patch(url, {'status': 'confirmed', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['version'], 2)
+        self.assertTrue(Notification.objects.filter(recipient=self.client_user, notification_type='order_confirmed').exists())
+
+        response = self.client.patch(url, {'status': 'in_progress', 'version': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual((response.data['status'], response.data['version']), ('confirmed', 2))
+
+        response = self.client.patch(url, {'status': 'pending'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_bulk_transition_reports_each_order(self):
+        pending, stale, done = self.make_orders(3)
+        Order.objects.filter(pk=done.pk).update(status='completed')
+        foreign = Order.objects.create(
+            client=self.client_user,
+            service=Service.objects.create(
+                provider=User.objects.create_user(username='other', password='testpass123', account_type='provider'),
+                category=self.category, name='Other', description='Other', price=10, base_price=10,
+                image='services/test.jpg', location='Nairobi'
+            )
+        )
+
+        self.client.force_authenticate(user=self.provider)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('orders:order-bulk-status'), {
+                'status': 'confirmed',
+                'orders': [pending.pk, {'id': stale.pk, 'version': 7}, done.pk, foreign.pk],
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['updated'], 1)
+        self.assertEqual(
+            [result['result'] for result in response.data['results']],
+            ['ok', 'conflict', 'invalid_transition', 'not_found']
+        )
+        self.assertEqual(Order.objects.get(pk=pending.pk).version, 2)
+        self.assertEqual(Order.objects.get(pk=foreign.pk).status, 'pending')
+        self.assertEqual(Notification.objects.filter(notification_type='order_confirmed').count(), 1)
+
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.post(reverse('orders:order-bulk-status'), {
+            'status': 'confirmed', 'orders': [pending.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class OrderExportTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider, category=self.category, name='Test Service', description='Test service',
+            price=50, base_price=50, image='services/test.jpg', location='Nairobi'
+        )
+        self.orders = [Order.objects.create(client=self.client_user, service=self.service) for _ in range(5)]
+        other = User.objects.create_user(username='other', password='testpass123', account_type='provider')
+        Order.objects.create(client=self.client_user, service=Service.objects.create(
+            provider=other, category=self.category, name='Other', description='Other', price=10, base_price=10,
+            image='services/test.jpg', location='Nairobi'
+        ))
+
+    def download(self, **params):
+        response = self.client.get(reverse('orders:order-export'), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_export_resumes_from_cursor(self):
+        self.client.force_authenticate(user=self.provider)
+        response, body = self.download(limit=3)
+        lines = body.splitlines()
+        self.assertEqual(lines[0].split(',')[:3], ['id', 'created_at', 'status'])
+        self.assertEqual([int(line.split(',')[0]) for line in lines[1:]], [order.pk for order in self.orders[:3]])
+
+        response, body = self.download(limit=3, cursor=response['X-Export-Next-Cursor'])
+        self.assertNotIn('X-Export-Next-Cursor', response)
+        self.assertEqual(
+            [int(line.split(',')[0]) for line in body.splitlines()[1:]], [order.pk for order in self.orders[3:]]
+        )
+
+    def test_jsonl_export_is_scoped_to_the_user(self):
+        self.client.force_authenticate(user=self.client_user)
+        with self.assertNumQueries(1):
+            _, body = self.download(output='jsonl')
+        rows = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0]['service'], 'Test Service')
+        self.assertEqual(rows[0]['total_amount'], '50.00')
+
+        response = self.client.get(reverse('orders:order-export'), {'cursor': 'nonsense'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StreamConnection:
+    """Drives the ASGI app like a client holding an event stream open"""
+
+    def __init__(self, path='/api/orders/events/', headers=(), query_string=b''):
+        from service_app.asgi import application
+
+        self.sent = asyncio.Queue()
+        self.closed = asyncio.Event()
+        scope = {
+            'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string,
+            'headers': list(headers),
+        }
+        self.task = asyncio.ensure_future(application(scope, self.receive, self.send))
+
+    async def receive(self):
+        await self.closed.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(self, message):
+        await self.sent.put(message)
+
+    async def next(self):
+        return await asyncio.wait_for(self.sent.get(), 5)
+
+    async def close(self):
+        self.closed.set()
+        await asyncio.wait_for(self.task, 5)
+
+
+# TransactionTestCase: the stream authenticates through the shared sync
+# thread and closes its connection afterwards, like a finished request
+class EventStreamTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='client', email='client@test.com', password='testpass123', account_type='client'
+        )
+        self.other = User.objects.create_user(
+            username='provider', email='provider@test.com', password='testpass123', account_type='provider'
+        )
+
+    async def open(self, **kwargs):
+        stream = StreamConnection(**kwargs)
+        start = await stream.next()
+        return stream, start
+
+    async def test_requires_authentication(self):
+        stream, start = await self.open(query_string=b'token=invalid')
+        self.assertEqual(start['status'], 401)
+        await stream.task
+
+    async def test_notifications_reach_only_their_recipient(self):
+        token = str(AccessToken.for_user(self.user))
+        stream, start = await self.open(headers=[(b'authorization', f'Bearer {token}'.encode())])
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), start['headers'])
+        self.assertIn(b'event: ready', (await stream.next())['body'])
+
+        def notify():
+            for recipient in (self.other, self.user):
+                Notification.objects.create(
+                    recipient=recipient, notification_type='promotion', title=f'For {recipient.username}', message='Hi'
+                )
+        await sync_to_async(notify)()
+
+        body = (await stream.next())['body'].decode()
+        self.assertIn('event: notification', body)
+        data = json.loads(body.split('data: ', 1)[1])
+        self.assertEqual(data['title'], 'For client')
+
+        await stream.close()
+        self.assertEqual(events.get_hub().connections, 0)
+
+    async def test_messages_reach_other_participants(self):
+        await sync_to_async(self.client.force_login)(self.user)
+        cookie = f'sessionid={self.client.cookies["sessionid"].value}'.encode()
+        stream, start = await self.open(path='/orders/events/', headers=[(b'cookie', cookie)])
+        self.assertEqual(start['status'], 200)
+        await stream.next()
+
+        def send_message():
+            conversation = Conversation.objects.create(subject='Booking')
+            conversation.participants.add(self.user, self.other)
+            Message.objects.create(conversation=conversation, sender=self.other, content='On my way')
+        await sync_to_async(send_message)()
+
+        body = (await stream.next())['body'].decode()
+        self.assertIn('event: message', body)
+        self.assertIn('On my way', body)
+        await stream.close()
@@ -0,0 +1,159 @@
+"""
+Order status transitions.
+
+Order.TRANSITIONS lists the statuses each status may move to. A transition
+is a single conditional UPDATE of the status, version and timestamp columns
+guarded by the status and version the caller read, so two requests acting
+on the same order cannot both succeed and nothing else in the row is
+rewritten. Bulk transitions lock the provider's orders once and move them
+all with one UPDATE.
+"""
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from services import availability
+from services.availability import BLOCKING_STATUSES
+from users import metrics
+from .models import Order
+from .notifications import dispatch
+from .utils import order_status_events
+
+# Set the first time an order reaches the status
+TIMESTAMP_FIELDS = {
+    'confirmed': 'confirmed_at',
+    'in_progress': 'started_at',
+    'completed': 'completed_at',
+}
+# Statuses providers may move many orders to at once
+BULK_STATUSES = ('confirmed', 'in_progress', 'completed', 'cancelled')
+MAX_BULK_ORDERS = 500
+
+
+class InvalidTransition(Exception):
+    def __init__(self, old_status, new_status):
+        self.old_status = old_status
+        self.new_status = new_status
+        super().__init__(f"An order cannot move from {old_status} to {new_status}")
+
+
+class TransitionConflict(Exception):
+    def __init__(self, order):
+        self.order = order
+        super().__init__("The order was changed by someone else; reload it and try again")
+
+
+def can_transition(old_status, new_status):
+    return new_status in Order.TRANSITIONS.get(old_status, ())
+
+
+def _changes(new_status, now):
+    changes = {'status': new_status, 'updated_at': now, 'version': F('version') + 1}
+    field = TIMESTAMP_FIELDS.get(new_status)
+    if field:
+        changes[field] = Coalesce(F(field), now)
+    return changes
+
+
+def transition(order, new_status, version=None, notify=True):
+    """
+    Move order to new_status if it is still at the status and version it
+    was read with (or the version the client sent). Updates order in place
+    and notifies the other party after commit.
+    """
+    old_status = order.status
+    if not can_transition(old_status, new_status):
+        raise InvalidTransition(old_status, new_status)
+    if version is not None and version != order.version:
+        raise TransitionConflict(order)
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Order.objects.filter(pk=order.pk, status=old_status, version=order.version).update(
+            **_changes(new_status, now)
+        )
+        if not updated:
+            raise TransitionConflict(order)
+        metrics.apply(metrics.order_deltas(order, old_status, new_status))
+
+    order.status = new_status
+    order.version += 1
+    order.updated_at = now
+    field = TIMESTAMP_FIELDS.get(new_status)
+    if field and getattr(order, field) is None:
+        setattr(order, field, now)
+    if hasattr(order, '_loaded_values'):
+        order._loaded_values.update(status=order.status, version=order.version)
+
+    # update() skips post_save, which keeps availability in sync
+    if (old_status in BLOCKING_STATUSES) != (new_status in BLOCKING_STATUSES):
+        availability.refresh_order(order)
+    if notify:
+        dispatch(order_status_events(order, old_status, new_status))
+    return order
+
+
+def bulk_transition(provider, items, new_status):
+    """
+    Move many of provider's orders to new_status. items are (id, version)
+    pairs; with a version other than None that order fails with 'conflict'
+    unless it is unchanged. Returns one result dict per order id, in order.
+    """
+    if new_status not in BULK_STATUSES:
+        raise InvalidTransition('any', new_status)
+
+    wanted = {}
+    for order_id, version in items:
+        wanted.setdefault(order_id, version)
+
+    results = {}
+    moved = []
+    now = timezone.now()
+    with transaction.atomic():
+        # Lock the rows so nothing moves them between the checks and the update
+        orders = {
+            order.pk: order
+            for order in Order.objects.select_for_update(of=('self',)).filter(
+                pk__in=wanted, provider=provider
+            ).select_related('client', 'provider', 'service')
+        }
+        for order_id, version in wanted.items():
+            order = orders.get(order_id)
+            if order is None:
+                results[order_id] = {'id': order_id, 'result': 'not_found'}
+            elif version is not None and version != order.version:
+                results[order_id] = {'id': order_id, 'result': 'conflict',
+                                     'status': order.status, 'version': order.version}
+            elif not can_transition(order.status, new_status):
+                results[order_id] = {'id': order_id, 'result': 'invalid_transition',
+                                     'status': order.status, 'version': order.version}
+            else:
+                moved.append((order, order.status))
+
+        if moved:
+            Order.objects.filter(pk__in=[order.pk for order, _ in moved]).update(**_changes(new_status, now))
+            deltas = metrics.new_deltas()
+            for order, old_status in moved:
+                metrics.order_deltas(order, old_status, new_status, deltas)
+            metrics.apply(deltas)
+
+    events = []
+    days = set()
+    field = TIMESTAMP_FIELDS.get(new_status)
+    for order, old_status in moved:
+        if order.scheduled_date and (old_status in BLOCKING_STATUSES) != (new_status in BLOCKING_STATUSES):
+            days.update(availability.booked_masks(order.scheduled_date, order.duration_hours or 1))
+        order.status = new_status
+        order.version += 1
+        order.updated_at = now
+        if field and getattr(order, field) is None:
+            setattr(order, field, now)
+        results[order.pk] = {'id': order.pk, 'result': 'ok', 'status': new_status, 'version': order.version}
+        events.extend(order_status_events(order, old_status, new_status))
+    if days:
+        availability.refresh_provider(provider.pk, days)
+    # One notification task for the whole batch
+    dispatch(events)
+
+    return [results[order_id] for order_id in wanted]
@@ -7,6 +7,8 @@ urlpatterns = [
     path('', views.OrderListCreateView.as_view(), name='order-list-create'),
     path('<int:pk>/', views.OrderDetailView.as_view(), name='order-detail'),
     path('<int:pk>/update-status/', views.OrderStatusUpdateView.as_view(), name='order-status-update'),
+    path('bulk-status/', views.OrderBulkStatusView.as_view(), name='order-bulk-status'),
+    path('export/', views.OrderExportView.as_view(), name='order-export'),
     path('client/', views.ClientOrdersView.as_view(), name='client-orders'),
     path('provider/', views.ProviderOrdersView.as_view(), name='provider-orders'),
     path('book/<int:service_id>/', views.OrderBookingView.as_view(), name='order-booking'),
@@ -14,7 +16,9 @@ urlpatterns = [
     path('conversations/', views.ConversationListCreateView.as_view(), name='conversations'),
     path('conversations/<int:pk>/', views.ConversationDetailView.as_view(), name='conversation-detail'),
     path('conversations/<int:conversation_id>/messages/', views.MessageListCreateView.as_view(), name='conversation-messages'),
+    path('conversations/<int:conversation_id>/read/', views.MarkConversationReadView.as_view(), name='conversation-read'),
     path('service-requests/', views.ServiceRequestListCreateView.as_view(), name='service-requests'),
+    path('service-requests/feed/', views.ProviderRequestFeedView.as_view(), name='service-request-feed'),
     path('service-requests/<int:pk>/', views.ServiceRequestDetailView.as_view(), name='service-request-detail'),
     # Notification endpoints
     path('notifications/', views.NotificationListView.as_view(), name='notifications'),
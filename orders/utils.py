@@ -1,35 +1,53 @@
+import logging
+import time
+from datetime import date, timedelta
+
 from django.contrib.auth import get_user_model
-from .models import Notification
+from django.utils import timezone
+
+from service_app.queue import enqueue
+from .notifications import deliver, dispatch, event, notify
+
+logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# Orders per reminder task
+REMINDER_CHUNK_SIZE = 1000
+
 def create_notification(recipient, notification_type, title, message, sender=None,
                        related_order=None, related_service=None, data=None):
     """
-    Create a notification for a user
+    Queue a notification for a user; it is written by a Celery worker
     """
-    notification = Notification.objects.create(
-        recipient=recipient,
+    notify(
+        recipient,
+        notification_type,
+        title,
+        message,
         sender=sender,
-        notification_type=notification_type,
-        title=title,
-        message=message,
         related_order=related_order,
         related_service=related_service,
         data=data
     )
-    return notification
 
 def notify_order_status_change(order, old_status, new_status):
     """
     Send notifications when order status changes
     """
+    dispatch(order_status_events(order, old_status, new_status))
+
+def order_status_events(order, old_status, new_status):
+    """
+    Notification events for an order status change
+    """
+    events = []
     if new_status == old_status:
-        return
+        return events
 
     if new_status == 'confirmed':
         # Notify client that order was confirmed
-        create_notification(
+        events.append(event(
             recipient=order.client,
             sender=order.provider,
             notification_type='order_confirmed',
@@ -37,11 +55,11 @@ def notify_order_status_change(order, old_status, new_status):
             message=f'Your order for {order.service.name} has been confirmed by {order.provider.get_full_name()}',
             related_order=order,
             related_service=order.service
-        )
+        ))
 
     elif new_status == 'in_progress':
         # Notify client that service is in progress
-        create_notification(
+        events.append(event(
             recipient=order.client,
             sender=order.provider,
             notification_type='order_in_progress',
@@ -49,11 +67,11 @@ def notify_order_status_change(order, old_status, new_status):
             message=f'{order.provider.get_full_name()} has started working on your order for {order.service.name}',
             related_order=order,
             related_service=order.service
-        )
+        ))
 
     elif new_status == 'completed':
         # Notify client that order is completed
-        create_notification(
+        events.append(event(
             recipient=order.client,
             sender=order.provider,
             notification_type='order_completed',
@@ -61,10 +79,10 @@ def notify_order_status_change(order, old_status, new_status):
             message=f'Your order for {order.service.name} has been completed by {order.provider.get_full_name()}',
             related_order=order,
             related_service=order.service
-        )
+        ))
 
         # Notify provider that order is completed
-        create_notification(
+        events.append(event(
             recipient=order.provider,
             sender=order.client,
             notification_type='order_completed',
@@ -72,13 +90,13 @@ def notify_order_status_change(order, old_status, new_status):
             message=f'Order #{order.id} has been marked as completed',
             related_order=order,
             related_service=order.service
-        )
+        ))
 
     elif new_status == 'cancelled':
         # Notify relevant party about cancellation
         if old_status in ['pending', 'confirmed']:
             # Provider cancelled - notify client
-            create_notification(
+            events.append(event(
                 recipient=order.client,
                 sender=order.provider,
                 notification_type='order_cancelled',
@@ -86,10 +104,10 @@ def notify_order_status_change(order, old_status, new_status):
                 message=f'Your order for {order.service.name} has been cancelled by {order.provider.get_full_name()}',
                 related_order=order,
                 related_service=order.service
-            )
+            ))
         else:
             # Client cancelled - notify provider
-            create_notification(
+            events.append(event(
                 recipient=order.provider,
                 sender=order.client,
                 notification_type='order_cancelled',
@@ -97,7 +115,9 @@ def notify_order_status_change(order, old_status, new_status):
                 message=f'Order #{order.id} has been cancelled by the client',
                 related_order=order,
                 related_service=order.service
-            )
+            ))
+
+    return events
 
 def notify_payment_status_change(payment, old_status, new_status):
     """
@@ -106,9 +126,10 @@ def notify_payment_status_change(payment, old_status, new_status):
     if new_status == old_status:
         return
 
+    events = []
     if new_status == 'completed':
         # Notify provider about payment
-        create_notification(
+        events.append(event(
             recipient=payment.order.provider,
             sender=payment.order.client,
             notification_type='payment_received',
@@ -116,11 +137,11 @@ def notify_payment_status_change(payment, old_status, new_status):
             message=f'Payment of {payment.amount} received for order #{payment.order.id}',
             related_order=payment.order,
             related_service=payment.order.service
-        )
+        ))
 
     elif new_status == 'failed':
         # Notify client about payment failure
-        create_notification(
+        events.append(event(
             recipient=payment.order.client,
             sender=payment.order.provider,
             notification_type='payment_failed',
@@ -128,7 +149,9 @@ def notify_payment_status_change(payment, old_status, new_status):
             message=f'Payment for order #{payment.order.id} has failed. Please try again.',
             related_order=payment.order,
             related_service=payment.order.service
-        )
+        ))
+
+    dispatch(events)
 
 def notify_new_review(review):
     """
@@ -144,38 +167,91 @@ def notify_new_review(review):
         related_service=review.service
     )
 
-def send_reminder_notifications():
+def _reminder_orders(day):
+    from .models import Order
+
+    return Order.objects.filter(scheduled_date__date=day, status__in=['confirmed', 'pending'])
+
+
+def send_reminder_notifications(day=None, chunk_size=REMINDER_CHUNK_SIZE, inline=False):
     """
-    Send reminder notifications for upcoming services
-    This function can be called by a scheduled task
+    Send reminder notifications for services scheduled on day (default:
+    tomorrow). Orders are split into id ranges of chunk_size, each queued as
+    its own task so the workers share them; inline=True processes them here.
+    Reruns skip reminders that were already sent.
     """
-    from django.utils import timezone
-    from datetime import timedelta
-
-    # Get orders scheduled for tomorrow
-    tomorrow = timezone.now() + timedelta(days=1)
-    upcoming_orders = Order.objects.filter(
-        scheduled_date__date=tomorrow.date(),
-        status__in=['confirmed', 'pending']
-    )
+    from .tasks import send_reminder_chunk
 
-    for order in upcoming_orders:
-        # Notify client about upcoming service
-        create_notification(
-            recipient=order.client,
-            notification_type='reminder',
-            title='Upcoming Service Reminder',
-            message=f'Reminder: You have a service scheduled for tomorrow - {order.service.name}',
-            related_order=order,
-            related_service=order.service
+    day = day or timezone.localdate() + timedelta(days=1)
+    started = time.perf_counter()
+    totals = {'orders': 0, 'notifications': 0, 'chunks': 0}
+
+    def flush(first_id, last_id):
+        totals['chunks'] += 1
+        if inline:
+            totals['notifications'] += send_reminders_for_range(day, first_id, last_id)['notifications']
+        else:
+            enqueue(send_reminder_chunk, day.isoformat(), first_id, last_id)
+
+    ids = _reminder_orders(day).order_by('id').values_list('id', flat=True)
+    first_id = last_id = None
+    count = 0
+    for order_id in ids.iterator(chunk_size=chunk_size):
+        if first_id is None:
+            first_id = order_id
+        last_id = order_id
+        count += 1
+        totals['orders'] += 1
+        if count == chunk_size:
+            flush(first_id, last_id)
+            first_id, count = None, 0
+    if first_id is not None:
+        flush(first_id, last_id)
+
+    elapsed = time.perf_counter() - started
+    totals['seconds'] = elapsed
+    if inline:
+        logger.info(
+            "Sent %s reminders for %s orders on %s in %.1fs (%.0f orders/sec)",
+            totals['notifications'], totals['orders'], day, elapsed, totals['orders'] / elapsed if elapsed else 0
         )
+    else:
+        logger.info("Queued %s reminder chunks covering %s orders on %s", totals['chunks'], totals['orders'], day)
+    return totals
 
-        # Notify provider about upcoming service
-        create_notification(
-            recipient=order.provider,
-            notification_type='reminder',
-            title='Upcoming Service Reminder',
-            message=f'Reminder: You have a service scheduled for tomorrow - {order.service.name}',
-            related_order=order,
-            related_service=order.service
-        )
\ No newline at end of file
+
+def send_reminders_for_range(day, first_id, last_id):
+    """
+    Remind the client and provider of every order on day with an id in
+    [first_id, last_id]
+    """
+    if isinstance(day, str):
+        day = date.fromisoformat(day)
+    started = time.perf_counter()
+
+    orders = _reminder_orders(day).filter(id__gte=first_id, id__lte=last_id).values_list(
+        'id', 'client_id', 'provider_id', 'service_id', 'service__name')
+    when = 'tomorrow' if day == timezone.localdate() + timedelta(days=1) else f'on {day:%A, %d %B %Y}'
+    events = []
+    count = 0
+    for order_id, client_id, provider_id, service_id, service_name in orders.iterator(chunk_size=REMINDER_CHUNK_SIZE):
+        count += 1
+        for recipient_id in (client_id, provider_id):
+            events.append(event(
+                recipient=recipient_id,
+                notification_type='reminder',
+                title='Upcoming Service Reminder',
+                message=f'Reminder: You have a service scheduled for {when} - {service_name}',
+                related_order=order_id,
+                related_service=service_id,
+                # Stable per order and day so a rerun is dropped by deliver()
+                dedup_key=f'reminder:{order_id}:{day.isoformat()}'
+            ))
+    created = deliver(events)
+
+    elapsed = time.perf_counter() - started
+    logger.info(
+        "Sent %s reminders for orders %s-%s in %.2fs (%.0f orders/sec)",
+        created, first_id, last_id, elapsed, count / elapsed if elapsed else 0
+    )
+    return {'orders': count, 'notifications': created, 'seconds': elapsed}
@@ -1,13 +1,27 @@
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
 from rest_framework import generics, permissions, status
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
+from django.db.models import Q
 from django.utils import timezone
+from django.utils.http import parse_etags
 from rest_framework.renderers import JSONRenderer
+from service_app.exports import ExportView
+from . import counters
+from . import exports as order_exports
+from .booking import BookingConflict, book, parse_schedule
+from .matching import provider_feed
 from .models import Order, Notification, Conversation, Message, ServiceRequest
+from .pagination import InboxPagination, MessageHistoryPagination
 from .serializers import OrderSerializer, ConversationSerializer, MessageSerializer, ServiceRequestSerializer
+from .serializers import RequestMatchSerializer
 from .serializers import OrderSerializer, NotificationSerializer
+from .transitions import (
+    BULK_STATUSES, MAX_BULK_ORDERS, InvalidTransition, TransitionConflict, bulk_transition, transition
+)
+from .utils import create_notification
 from users.permissions import IsClient, IsProvider, CanManageOrder
 
 class OrderListCreateView(generics.ListCreateAPIView):
@@ -39,12 +53,20 @@ class OrderListCreateView(generics.ListCreateAPIView):
             return Order.objects.filter(provider=user)
         return Order.objects.none()
 
+    def create(self, request, *args, **kwargs):
+        try:
+            return super().create(request, *args, **kwargs)
+        except BookingConflict as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+
     def perform_create(self, serializer):
-        service = serializer.validated_data['service']
-        serializer.save(client=self.request.user, provider=service.provider)
+        fields = dict(serializer.validated_data)
+        service = fields.pop('service')
+        # Same provider conflict check as the booking form
+        serializer.instance = book(self.request.user, service, **fields)
 
         # Create notification for provider
-        Notification.objects.create(
+        create_notification(
             recipient=service.provider,
             sender=self.request.user,
             notification_type='new_order',
@@ -74,7 +96,11 @@ class OrderDetailView(generics.RetrieveUpdateDestroyAPIView):
         return Order.objects.none()
 
 class OrderStatusUpdateView(generics.UpdateAPIView):
-    queryset = Order.objects.all()
+    """
+    Change an order's status (and provider fields). Send the order's
+    version to fail with 409 if it changed since it was read.
+    """
+    queryset = Order.objects.select_related('client', 'provider', 'service')
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
 
@@ -84,38 +110,87 @@ class OrderStatusUpdateView(generics.UpdateAPIView):
     def patch(self, request, *args, **kwargs):
         return self.partial_update(request, *args, **kwargs)
 
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except InvalidTransition as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except TransitionConflict as e:
+            return Response({
+                'error': str(e),
+                'status': e.order.status,
+                'version': e.order.version,
+            }, status=status.HTTP_409_CONFLICT)
+
     def perform_update(self, serializer):
-        old_status = self.get_object().status
-        new_status = serializer.validated_data.get('status', old_status)
-
-        serializer.save()
-
-        # Create notifications based on status change
-        order = self.get_object()
-
-        if new_status != old_status:
-            if new_status == 'confirmed':
-                # Notify client
-                Notification.objects.create(
-                    recipient=order.client,
-                    sender=order.provider,
-                    notification_type='order_confirmed',
-                    title='Order Confirmed',
-                    message=f'Your order for {order.service.name} has been confirmed',
-                    related_order=order,
-                    related_service=order.service
-                )
-            elif new_status == 'completed':
-                # Notify client
-                Notification.objects.create(
-                    recipient=order.client,
-                    sender=order.provider,
-                    notification_type='order_completed',
-                    title='Order Completed',
-                    message=f'Your order for {order.service.name} has been completed',
-                    related_order=order,
-                    related_service=order.service
-                )
+        order = serializer.instance
+        changes = dict(serializer.validated_data)
+        new_status = changes.pop('status', order.status)
+        version = self.request.data.get('version')
+        try:
+            version = int(version) if version not in (None, '') else None
+        except (TypeError, ValueError):
+            raise ValidationError({'version': 'A valid integer is required.'})
+
+        if new_status != order.status:
+            try:
+                transition(order, new_status, version=version)
+            except TransitionConflict:
+                # Report the state the client lost to
+                order.refresh_from_db(fields=['status', 'version'])
+                raise
+        elif version is not None and version != order.version:
+            raise TransitionConflict(order)
+
+        if changes:
+            # Write only the fields that were sent
+            for name, value in changes.items():
+                setattr(order, name, value)
+            order.save(update_fields=[*changes, 'updated_at'])
+
+class OrderBulkStatusView(APIView):
+    """
+    Move many of the provider's orders to one status. Body:
+    {"status": "confirmed", "orders": [12, {"id": 13, "version": 2}]}.
+    Each order gets its own result; one failing does not stop the rest.
+    """
+    permission_classes = [IsProvider]
+
+    def post(self, request):
+        new_status = request.data.get('status')
+        if new_status not in BULK_STATUSES:
+            return Response(
+                {'error': f"status must be one of {', '.join(BULK_STATUSES)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        orders = request.data.get('orders')
+        if not isinstance(orders, list) or not orders:
+            return Response({'error': 'orders must be a non-empty list'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(orders) > MAX_BULK_ORDERS:
+            return Response(
+                {'error': f'At most {MAX_BULK_ORDERS} orders can be updated at once'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        items = []
+        try:
+            for item in orders:
+                if isinstance(item, dict):
+                    version = item.get('version')
+                    items.append((int(item['id']), int(version) if version is not None else None))
+                else:
+                    items.append((int(item), None))
+        except (KeyError, TypeError, ValueError):
+            return Response(
+                {'error': 'orders must hold order ids or objects with an id and optional version'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = bulk_transition(request.user, items, new_status)
+        return Response({
+            'updated': sum(1 for result in results if result['result'] == 'ok'),
+            'results': results,
+        })
 
 class ClientOrdersView(generics.ListAPIView):
     """List orders for clients"""
@@ -145,6 +220,14 @@ class ProviderOrdersView(generics.ListAPIView):
     def get_queryset(self):
         return Order.objects.filter(provider=self.request.user)
 
+class OrderExportView(ExportView):
+    """Stream the user's orders as CSV or JSON Lines"""
+    columns = order_exports.COLUMNS
+    filename = 'orders'
+
+    def get_queryset(self):
+        return order_exports.exportable(self.request.user)
+
 class OrderBookingView(APIView):
     """Create a booking for a service"""
     permission_classes = [IsClient]
@@ -187,20 +270,38 @@ class OrderBookingView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Create the order
-        order = Order.objects.create(
-            client=request.user,
-            service=service,
-            provider=service.provider,
-            quantity=request.data.get('quantity', 1),
-            scheduled_date=request.data.get('scheduled_date'),
-            service_location=request.data.get('service_location'),
-            notes=request.data.get('notes'),
-            special_requirements=request.data.get('special_requirements')
-        )
+        try:
+            scheduled_date = parse_schedule(request.data.get('scheduled_date'), request.data.get('scheduled_time'))
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            duration_hours = int(request.data.get('duration_hours', 1))
+        except (TypeError, ValueError):
+            duration_hours = 0
+        if duration_hours < 1:
+            return Response(
+                {'error': 'duration_hours must be a positive integer'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Create the order unless the provider is already booked then
+        try:
+            order = book(
+                request.user,
+                service,
+                scheduled_date=scheduled_date,
+                duration_hours=duration_hours,
+                quantity=request.data.get('quantity', 1),
+                service_location=request.data.get('service_location'),
+                notes=request.data.get('notes'),
+                special_requirements=request.data.get('special_requirements')
+            )
+        except BookingConflict as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
 
         # Create notification for provider
-        Notification.objects.create(
+        create_notification(
             recipient=service.provider,
             sender=request.user,
             notification_type='new_order',
@@ -251,9 +352,10 @@ class ConversationListCreateView(generics.ListCreateAPIView):
     """List and create conversations"""
     serializer_class = ConversationSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = InboxPagination
 
     def get_queryset(self):
-        return Conversation.objects.filter(participants=self.request.user)
+        return Conversation.objects.filter(participants=self.request.user).for_inbox(self.request.user)
 
     def perform_create(self, serializer):
         participants = serializer.validated_data['participants']
@@ -266,21 +368,37 @@ class ConversationDetailView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Conversation.objects.filter(participants=self.request.user)
+        return Conversation.objects.filter(participants=self.request.user).for_inbox(self.request.user)
 
 class MessageListCreateView(generics.ListCreateAPIView):
     """List and create messages in a conversation"""
     serializer_class = MessageSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = MessageHistoryPagination
+
+    def get_conversation(self):
+        return get_object_or_404(Conversation, id=self.kwargs['conversation_id'], participants=self.request.user)
 
     def get_queryset(self):
-        conversation_id = self.kwargs['conversation_id']
-        return Message.objects.filter(conversation_id=conversation_id)
+        return Message.objects.filter(conversation=self.get_conversation()).select_related('sender')
 
     def perform_create(self, serializer):
-        conversation_id = self.kwargs['conversation_id']
-        conversation = Conversation.objects.get(id=conversation_id, participants=self.request.user)
-        serializer.save(conversation=conversation, sender=self.request.user)
+        serializer.save(conversation=self.get_conversation(), sender=self.request.user)
+
+class MarkConversationReadView(APIView):
+    """Mark a conversation's messages read, up to message id up_to if given"""
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        conversation = get_object_or_404(Conversation, id=conversation_id, participants=request.user)
+        up_to = request.data.get('up_to')
+        if up_to is not None:
+            try:
+                up_to = int(up_to)
+            except (TypeError, ValueError):
+                return Response({'error': 'up_to must be a message id'}, status=status.HTTP_400_BAD_REQUEST)
+        count = Message.mark_read(conversation, request.user, up_to)
+        return Response({'status': 'success', 'marked_count': count})
 
 class ServiceRequestListCreateView(generics.ListCreateAPIView):
     """List and create service requests"""
@@ -308,9 +426,25 @@ class ServiceRequestDetailView(generics.RetrieveUpdateAPIView):
         if user.account_type == 'client':
             return ServiceRequest.objects.filter(client=user)
         elif user.account_type in ['provider', 'business']:
-            return ServiceRequest.objects.filter(assigned_provider=user)
+            if self.request.method not in permissions.SAFE_METHODS:
+                return ServiceRequest.objects.filter(assigned_provider=user)
+            # Providers may also read, but not edit, the requests matched to them
+            return ServiceRequest.objects.filter(Q(assigned_provider=user) | Q(matches__provider=user)).distinct()
         return ServiceRequest.objects.none()
 
+class ProviderRequestFeedView(generics.ListAPIView):
+    """Open service requests matched to the current provider, best first"""
+    serializer_class = RequestMatchSerializer
+    permission_classes = [IsProvider]
+    max_limit = 200
+
+    def get_queryset(self):
+        try:
+            limit = max(1, min(int(self.request.query_params.get('limit', 50)), self.max_limit))
+        except ValueError:
+            limit = 50
+        return provider_feed(self.request.user)[:limit]
+
 class NotificationListView(generics.ListAPIView):
     """List notifications for the current user"""
     serializer_class = NotificationSerializer
@@ -350,25 +484,25 @@ class UnreadNotificationCountView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
-        count = Notification.objects.filter(
-            recipient=request.user,
-            is_read=False
-        ).count()
+        count = counters.unread_count(request.user.id)
 
-        return Response({'unread_count': count})
+        # Clients poll this; an unchanged count is answered with a bare 304
+        etag = f'"unread-{request.user.id}-{count}"'
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response({'unread_count': count}, headers=headers)
 
 class MarkAllNotificationsReadView(APIView):
     """Mark all notifications as read"""
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request):
-        notifications = Notification.objects.filter(
+        count = Notification.objects.filter(
             recipient=request.user,
             is_read=False
-        )
-
-        count = notifications.count()
-        notifications.update(is_read=True)
+        ).update(is_read=True)
+        counters.adjust(request.user.id, -count)
 
         return Response({
             'status': 'success',
@@ -380,9 +514,9 @@ class ClearAllNotificationsView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def delete(self, request):
-        notifications = Notification.objects.filter(recipient=request.user)
-        count = notifications.count()
-        notifications.delete()
+        # Nothing cascades from notifications, so this is a single DELETE
+        count, _ = Notification.objects.filter(recipient=request.user).delete()
+        counters.invalidate(request.user.id)
 
         return Response({
             'status': 'success',
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.db.models import Sum
-from .models import Payment
+from .models import LedgerEntry, LedgerSnapshot, Payment, PaymentEvent, Refund
 
 @admin.register(Payment)
 class PaymentAdmin(admin.ModelAdmin):
@@ -16,3 +16,40 @@ class PaymentAdmin(admin.ModelAdmin):
 
     def get_ordering(self, request):
         return ['-created_at']
+
+
+@admin.register(Refund)
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ['id', 'payment', 'amount', 'provider_refund_id', 'created_at']
+    search_fields = ['idempotency_key', 'provider_refund_id']
+    raw_id_fields = ['payment']
+
+
+@admin.register(PaymentEvent)
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ['id', 'provider', 'event_type', 'event_id', 'status', 'attempts', 'received_at', 'processed_at']
+    list_filter = ['provider', 'status', 'event_type']
+    search_fields = ['event_id']
+    readonly_fields = ['received_at', 'processed_at']
+    raw_id_fields = ['payment']
+
+
+@admin.register(LedgerEntry)
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ['id', 'created_at', 'entry_type', 'account', 'provider', 'payment', 'amount', 'reference']
+    list_filter = ['entry_type', 'account']
+    search_fields = ['reference', 'provider__username']
+    raw_id_fields = ['provider', 'payment']
+
+    # Append-only
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(LedgerSnapshot)
+class LedgerSnapshotAdmin(admin.ModelAdmin):
+    list_display = ['provider', 'as_of', 'balance', 'charges', 'refunds', 'fees']
+    raw_id_fields = ['provider']
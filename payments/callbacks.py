@@ -0,0 +1,167 @@
+"""
+Inbound provider callbacks.
+
+MpesaCallbackView and StripeWebhookView only store what the provider sent
+as a PaymentEvent and answer 200; process() applies it from a Celery
+worker. Events are unique per provider and event id, so a provider
+resending a callback stores nothing new. process() locks the event and
+marks it processed in the same transaction as the payment and order
+changes, so each event takes effect exactly once however often it is
+delivered, retried or replayed. Events that fail are kept, with the error,
+for replay_payment_events.
+"""
+import logging
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from orders.events import publish_on_commit
+from orders.transitions import can_transition, transition
+from orders.utils import create_notification
+from .initiation import payment_data
+from .models import Payment, PaymentEvent
+
+logger = logging.getLogger(__name__)
+
+# Statuses a provider's result may still change
+OPEN_STATUSES = ('pending', 'processing')
+STRIPE_EVENT_TYPES = ('payment_intent.succeeded', 'payment_intent.payment_failed')
+
+
+class UnknownPayment(Exception):
+    """No payment matches the event yet; it may not have been saved"""
+
+
+def record(provider, event_id, event_type, payload):
+    """
+    Store an event. Returns (event, created); created is False for a
+    delivery already stored.
+    """
+    try:
+        with transaction.atomic():
+            event = PaymentEvent.objects.create(
+                provider=provider, event_id=event_id, event_type=event_type, payload=payload
+            )
+        return event, True
+    except IntegrityError:
+        return PaymentEvent.objects.get(provider=provider, event_id=event_id), False
+
+
+def mpesa_event(data):
+    """
+    (event_id, event_type) for an STK push callback, or None when it is
+    not one
+    """
+    callback = (data.get('Body') or {}).get('stkCallback') or {}
+    checkout_request_id = callback.get('CheckoutRequestID')
+    if not checkout_request_id:
+        return None
+    return checkout_request_id, 'stk_callback'
+
+
+def _metadata_value(callback, name):
+    for item in (callback.get('CallbackMetadata') or {}).get('Item', []):
+        if item.get('Name') == name:
+            return item.get('Value')
+    return None
+
+
+def complete(payment, transaction_id, metadata=None):
+    """
+    Mark payment completed, confirm its order and tell the provider
+    """
+    payment.status = 'completed'
+    payment.transaction_id = transaction_id
+    payment.error_message = None
+    if metadata is not None:
+        payment.metadata = metadata
+    payment.save()
+
+    order = payment.order
+    if can_transition(order.status, 'confirmed'):
+        transition(order, 'confirmed')
+    create_notification(
+        recipient=order.provider,
+        sender=order.client,
+        notification_type='payment_received',
+        title='Payment Received',
+        message=f'Payment of {payment.amount} received for order #{order.id}',
+        related_order=order,
+        related_service=order.service
+    )
+    publish_on_commit([order.client_id], 'payment', payment_data(payment))
+
+
+def reject(payment, message):
+    payment.status = 'failed'
+    payment.error_message = message
+    payment.save()
+    publish_on_commit([payment.order.client_id], 'payment', payment_data(payment))
+
+
+def _locked_payment(**lookup):
+    payment = Payment.objects.select_for_update(of=('self',)).filter(**lookup).select_related(
+        'order__client', 'order__provider', 'order__service'
+    ).first()
+    if payment is None:
+        raise UnknownPayment(f"No payment with {lookup}")
+    return payment
+
+
+def _apply_mpesa(event):
+    callback = event.payload['Body']['stkCallback']
+    payment = _locked_payment(checkout_request_id=event.event_id)
+    if payment.status not in OPEN_STATUSES:
+        return payment
+    if callback.get('ResultCode') in (0, '0'):
+        complete(payment, _metadata_value(callback, 'MpesaReceiptNumber'))
+    else:
+        reject(payment, callback.get('ResultDesc') or 'M-Pesa payment failed')
+    return payment
+
+
+def _apply_stripe(event):
+    if event.event_type not in STRIPE_EVENT_TYPES:
+        return None
+    intent = event.payload['data']['object']
+    payment = _locked_payment(stripe_payment_intent_id=intent['id'])
+    if event.event_type == 'payment_intent.succeeded':
+        # A card may succeed after an earlier attempt failed
+        if payment.status in OPEN_STATUSES + ('failed',):
+            complete(payment, intent['id'], intent)
+    elif payment.status in OPEN_STATUSES:
+        error = intent.get('last_payment_error') or {}
+        reject(payment, error.get('message') or 'Payment failed')
+    return payment
+
+
+HANDLERS = {
+    'mpesa': _apply_mpesa,
+    'stripe': _apply_stripe,
+}
+
+
+def process(event_id):
+    """
+    Apply a stored event unless it already was. Returns the event. Errors
+    are recorded on the event and raised.
+    """
+    try:
+        with transaction.atomic():
+            event = PaymentEvent.objects.select_for_update().filter(pk=event_id).first()
+            if event is None or event.status == 'processed':
+                return event
+            payment = HANDLERS[event.provider](event)
+            event.payment = payment
+            event.status = 'processed'
+            event.attempts += 1
+            event.error_message = ''
+            event.processed_at = timezone.now()
+            event.save()
+    except Exception as e:
+        PaymentEvent.objects.filter(pk=event_id).exclude(status='processed').update(
+            status='failed', attempts=F('attempts') + 1, error_message=str(e)
+        )
+        raise
+    return event
@@ -0,0 +1,32 @@
+"""
+Payment export columns and scope (see service_app.exports)
+"""
+from .models import Payment
+
+# (column, values_list lookup)
+COLUMNS = (
+    ('id', 'id'),
+    ('created_at', 'created_at'),
+    ('updated_at', 'updated_at'),
+    ('order_id', 'order_id'),
+    ('client_id', 'order__client_id'),
+    ('provider_id', 'order__provider_id'),
+    ('status', 'status'),
+    ('payment_method', 'payment_method'),
+    ('amount', 'amount'),
+    ('refund_amount', 'refund_amount'),
+    ('transaction_id', 'transaction_id'),
+    ('refund_transaction_id', 'refund_transaction_id'),
+)
+
+
+def exportable(user):
+    """
+    Payments user may export: staff (finance) get every payment, providers
+    the payments for their orders, clients their own
+    """
+    if user.is_staff:
+        return Payment.objects.all()
+    if user.account_type in ['provider', 'business']:
+        return Payment.objects.filter(order__provider=user)
+    return Payment.objects.filter(order__client=user)
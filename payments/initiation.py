@@ -0,0 +1,173 @@
+"""
+Payment initiation.
+
+PaymentCreateView records a pending Payment and answers 202 straight away;
+initiate() then calls the provider (an M-Pesa STK push or a Stripe
+PaymentIntent) from a Celery worker, so a slow provider ties up a worker
+process instead of a web worker. The client polls the payment or waits for
+its 'payment' event on the live event stream.
+
+Running initiate() twice for a payment is harmless: it claims the payment
+by moving it from pending to processing with a conditional UPDATE before
+calling out, and only a failure that provably happened before anything was
+sent puts it back to pending for a retry. Stripe requests carry an
+idempotency key derived from the payment's, so even a retried request
+creates one PaymentIntent.
+"""
+import logging
+import uuid
+
+import requests
+import stripe
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from urllib3.exceptions import ConnectTimeoutError
+
+from orders.events import publish_on_commit
+from .models import Payment
+from .services import MpesaError, MpesaService
+
+logger = logging.getLogger(__name__)
+
+STRIPE_CURRENCY = 'usd'
+STRIPE_NETWORK_RETRIES = 2
+
+
+class RetryableError(Exception):
+    """The provider could not be reached; nothing was sent"""
+
+
+def new_idempotency_key():
+    return uuid.uuid4().hex
+
+
+_stripe_client = None
+
+
+def stripe_client():
+    global _stripe_client
+
+    if _stripe_client is None:
+        _stripe_client = stripe.StripeClient(
+            settings.STRIPE_SECRET_KEY,
+            base_addresses={'api': settings.STRIPE_API_BASE},
+            max_network_retries=STRIPE_NETWORK_RETRIES,
+        )
+    return _stripe_client
+
+
+def payment_data(payment):
+    return {
+        'id': payment.id,
+        'order': payment.order_id,
+        'status': payment.status,
+        'payment_method': payment.payment_method,
+        'error_message': payment.error_message,
+    }
+
+
+def _never_sent(error):
+    # Refused connections and connect timeouts; urllib3 reports both as a
+    # ConnectTimeoutError reason
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.ConnectTimeout) or isinstance(reason, ConnectTimeoutError)
+
+
+def _push_mpesa(payment):
+    try:
+        response = MpesaService().stk_push(
+            phone_number=payment.phone_number,
+            amount=payment.amount,
+            order_ref=payment.order_id
+        )
+    except requests.ConnectionError as e:
+        if _never_sent(e):
+            raise RetryableError(str(e))
+        return ['status', 'error_message'], {'status': 'failed', 'error_message': str(e)}
+    except (requests.RequestException, MpesaError) as e:
+        # The push may have reached Safaricom; never send a second one
+        return ['status', 'error_message'], {'status': 'failed', 'error_message': str(e)}
+
+    if response.get('ResponseCode') == '0':
+        return ['merchant_request_id', 'checkout_request_id'], {
+            'merchant_request_id': response.get('MerchantRequestID'),
+            'checkout_request_id': response.get('CheckoutRequestID'),
+        }
+    return ['status', 'error_message'], {
+        'status': 'failed',
+        'error_message': response.get('ResponseDescription') or response.get('errorMessage') or 'M-Pesa rejected the payment',
+    }
+
+
+def _create_intent(payment):
+    try:
+        intent = stripe_client().payment_intents.create(
+            params={
+                'amount': int(payment.amount * 100),  # Convert to cents
+                'currency': STRIPE_CURRENCY,
+                'metadata': {'order_id': payment.order_id, 'payment_id': payment.id},
+            },
+            options={'idempotency_key': f'payment-{payment.idempotency_key}'},
+        )
+    except stripe.APIConnectionError as e:
+        # Safe to repeat with the same idempotency key
+        raise RetryableError(str(e))
+    except stripe.StripeError as e:
+        return ['status', 'error_message'], {'status': 'failed', 'error_message': str(e.user_message or e)}
+
+    return ['stripe_payment_intent_id', 'metadata'], {
+        'stripe_payment_intent_id': intent.id,
+        'metadata': {**(payment.metadata or {}), 'client_secret': intent.client_secret},
+    }
+
+
+def initiate(payment_id):
+    """
+    Call the provider for a pending payment. Returns the payment, or None
+    if it was not pending. Raises RetryableError, with the payment back in
+    pending, when the provider was unreachable.
+    """
+    claimed = Payment.objects.filter(pk=payment_id, status='pending').update(
+        status='processing', updated_at=timezone.now()
+    )
+    if not claimed:
+        return None
+    payment = Payment.objects.get(pk=payment_id)
+
+    try:
+        if payment.payment_method == 'mpesa':
+            fields, values = _push_mpesa(payment)
+        elif payment.payment_method == 'card':
+            fields, values = _create_intent(payment)
+        else:
+            fields, values = ['status', 'error_message'], {
+                'status': 'failed', 'error_message': f'{payment.payment_method} payments are not initiated online',
+            }
+    except RetryableError:
+        Payment.objects.filter(pk=payment_id, status='processing').update(status='pending', updated_at=timezone.now())
+        raise
+
+    with transaction.atomic():
+        for name, value in values.items():
+            setattr(payment, name, value)
+        payment.save(update_fields=[*fields, 'updated_at'])
+        publish_on_commit([payment.order.client_id], 'payment', payment_data(payment))
+    if payment.status == 'failed':
+        logger.info("Payment %s failed to start: %s", payment.pk, payment.error_message)
+    return payment
+
+
+def fail(payment_id, message):
+    """
+    Give up on a payment that could not be initiated
+    """
+    with transaction.atomic():
+        payment = Payment.objects.select_for_update().filter(pk=payment_id, status='pending').first()
+        if payment is None:
+            return None
+        payment.status = 'failed'
+        payment.error_message = message
+        payment.save(update_fields=['status', 'error_message', 'updated_at'])
+        publish_on_commit([payment.order.client_id], 'payment', payment_data(payment))
+    return payment
@@ -0,0 +1,210 @@
+"""
+Payment ledger.
+
+Money movements are posted as double-entry LedgerEntry rows: a charge
+debits cash and credits the provider's payable account, the platform fee
+moves its share from the provider to the platform, and a refund debits the
+provider and credits cash. Entries are only ever appended, so every partial
+refund keeps its own row.
+
+Each hour take_snapshots() stores every provider's running totals as a
+LedgerSnapshot, so balance() reads the latest snapshot and only the entries
+after it, through the (provider, id) index, instead of adding up the
+provider's whole history. Snapshots are cut by entry id at a watermark
+below which every entry has committed, so an entry committing late is
+never left out of both the snapshot and the balance.
+"""
+import logging
+import uuid
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Exists, Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from users.metrics import PAID_STATUSES
+from .models import LedgerEntry, LedgerSnapshot, Payment
+
+logger = logging.getLogger(__name__)
+
+CENT = Decimal('0.01')
+TOTALS = ('balance', 'charges', 'refunds', 'fees')
+
+
+def fee_for(amount):
+    return (Decimal(amount) * Decimal(str(settings.PLATFORM_FEE_RATE))).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def _posting(entry_type, payment, legs, reference='', at=None):
+    posting = uuid.uuid4()
+    at = at or timezone.now()
+    return [
+        LedgerEntry(
+            posting=posting,
+            entry_type=entry_type,
+            account=account,
+            provider_id=payment.order.provider_id,
+            payment=payment,
+            amount=amount,
+            reference=reference or '',
+            created_at=at,
+        )
+        for account, amount in legs
+    ]
+
+
+def charge_entries(payment, sign=1, at=None):
+    """A payment received, and the platform's fee on it. sign=-1 reverses them."""
+    amount = sign * payment.amount
+    entries = _posting('charge', payment, [('cash', amount), ('provider', -amount)], payment.transaction_id, at)
+    fee = sign * fee_for(payment.amount)
+    if fee:
+        entries += _posting('fee', payment, [('provider', fee), ('platform', -fee)], payment.transaction_id, at)
+    return entries
+
+
+def refund_entries(payment, amount, reference='', at=None):
+    return _posting('refund', payment, [('provider', amount), ('cash', -amount)], reference, at)
+
+
+def payment_entries(payment, previous):
+    """
+    Entries for a payment whose (status, refund_amount) was previous, or
+    None when it was just created
+    """
+    old_status, old_refund = previous or (None, Decimal(0))
+    entries = []
+    paid = (payment.status in PAID_STATUSES) - (old_status in PAID_STATUSES)
+    if paid:
+        entries += charge_entries(payment, sign=paid)
+    refunded = Decimal(payment.refund_amount or 0) - Decimal(old_refund or 0)
+    if refunded:
+        entries += refund_entries(payment, refunded, payment.refund_transaction_id)
+    return entries
+
+
+def post(entries):
+    """Append entries; call inside the transaction making the change"""
+    if entries:
+        LedgerEntry.objects.bulk_create(entries)
+    return entries
+
+
+def _aggregates():
+    provider_leg = Q(account='provider')
+    return {
+        'payable': Sum('amount', filter=provider_leg),
+        'charged': Sum('amount', filter=provider_leg & Q(entry_type='charge')),
+        'refunded': Sum('amount', filter=provider_leg & Q(entry_type='refund')),
+        'fees_taken': Sum('amount', filter=provider_leg & Q(entry_type='fee')),
+    }
+
+
+def _totals(row):
+    # The provider's account is a liability: credits raise the balance
+    return {
+        'balance': -(row['payable'] or 0),
+        'charges': -(row['charged'] or 0),
+        'refunds': row['refunded'] or 0,
+        'fees': row['fees_taken'] or 0,
+    }
+
+
+def balance(provider):
+    """
+    The provider's balance (what the platform owes them) and lifetime
+    charges, refunds and fees
+    """
+    snapshot = LedgerSnapshot.objects.filter(provider=provider).order_by('-last_entry_id').first()
+    entries = LedgerEntry.objects.filter(provider=provider)
+    if snapshot is not None:
+        entries = entries.filter(id__gt=snapshot.last_entry_id)
+    recent = _totals(entries.aggregate(**_aggregates()))
+    result = {field: (getattr(snapshot, field) if snapshot else 0) + recent[field] for field in TOTALS}
+    result['snapshot_as_of'] = snapshot.as_of if snapshot else None
+    return result
+
+
+def watermark():
+    """
+    The highest entry id at or below which every entry has committed
+    """
+    with transaction.atomic():
+        if connection.vendor == 'postgresql':
+            # Ids are taken before commit, so a lower id may still be in
+            # flight; SHARE waits for the transactions inserting entries.
+            # SQLite has a single writer, which always holds the newest ids.
+            with connection.cursor() as cursor:
+                cursor.execute(f'LOCK TABLE {LedgerEntry._meta.db_table} IN SHARE MODE')
+        return LedgerEntry.objects.aggregate(last=Max('id'))['last'] or 0
+
+
+def take_snapshots(as_of=None):
+    """
+    Snapshot the totals of every provider with entries since their last
+    snapshot, up to the current watermark(). as_of (default: now) names the
+    snapshot. Returns the number of snapshots written.
+    """
+    as_of = as_of or timezone.now()
+    last_entry_id = watermark()
+    latest = LedgerSnapshot.objects.filter(
+        last_entry_id=Subquery(
+            LedgerSnapshot.objects.filter(provider=OuterRef('provider'))
+            .order_by('-last_entry_id').values('last_entry_id')[:1]
+        ),
+    )
+    previous = {snapshot.provider_id: snapshot for snapshot in latest}
+
+    window = LedgerEntry.objects.filter(id__lte=last_entry_id).order_by()
+    # One aggregate per distinct previous watermark, and one for providers
+    # without a snapshot
+    groups = [window.filter(~Exists(LedgerSnapshot.objects.filter(provider=OuterRef('provider'))))]
+    for since in {snapshot.last_entry_id for snapshot in previous.values()}:
+        groups.append(window.filter(
+            Exists(LedgerSnapshot.objects.filter(provider=OuterRef('provider'), last_entry_id=since)),
+            ~Exists(LedgerSnapshot.objects.filter(provider=OuterRef('provider'), last_entry_id__gt=since)),
+            id__gt=since,
+        ))
+
+    snapshots = []
+    for entries in groups:
+        for row in entries.values('provider_id').annotate(**_aggregates()):
+            prior = previous.get(row['provider_id'])
+            totals = _totals(row)
+            snapshots.append(LedgerSnapshot(
+                provider_id=row['provider_id'],
+                as_of=as_of,
+                last_entry_id=last_entry_id,
+                **{field: (getattr(prior, field) if prior else 0) + totals[field] for field in TOTALS}
+            ))
+    with transaction.atomic():
+        # A rerun for the same as_of keeps the first snapshots
+        LedgerSnapshot.objects.bulk_create(snapshots, ignore_conflicts=True)
+    logger.info("Took %s ledger snapshots up to entry %s", len(snapshots), last_entry_id)
+    return len(snapshots)
+
+
+def backfill(chunk_size=1000):
+    """
+    Post entries for paid payments that have none, such as those paid
+    before the ledger existed. Returns the number of payments posted.
+    """
+    payments = Payment.objects.filter(status__in=PAID_STATUSES).filter(
+        ~Exists(LedgerEntry.objects.filter(payment=OuterRef('pk')))
+    ).select_related('order').order_by('pk')
+    posted = 0
+    last_id = 0
+    while True:
+        chunk = list(payments.filter(pk__gt=last_id)[:chunk_size])
+        if not chunk:
+            return posted
+        entries = []
+        for payment in chunk:
+            entries += charge_entries(payment)
+            if payment.refund_amount:
+                entries += refund_entries(payment, payment.refund_amount, payment.refund_transaction_id)
+        with transaction.atomic():
+            post(entries)
+        posted += len(chunk)
+        last_id = chunk[-1].pk
@@ -0,0 +1,73 @@
+import base64
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from payments import services
+from payments.services import MpesaService
+from payments.stubs import DarajaStub
+
+
+def unpooled_stk_push(base_url):
+    """What every payment used to cost: a new token and two new connections"""
+    auth = base64.b64encode(f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}".encode()).decode()
+    token = requests.get(
+        f"{base_url}/oauth/v1/generate?grant_type=client_credentials", headers={"Authorization": f"Basic {auth}"}
+    ).json()["access_token"]
+    return requests.post(
+        f"{base_url}/mpesa/stkpush/v1/processrequest",
+        json={"Amount": 1, "PhoneNumber": "254700000000"},
+        headers={"Authorization": f"Bearer {token}"},
+    ).json()
+
+
+class Command(BaseCommand):
+    help = (
+        "Time STK pushes against a local stub Daraja server, creating a token and connections per "
+        "payment as before versus the cached token and pooled session"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=1)
+        parser.add_argument('--latency-ms', type=float, default=20, help="Added to every request")
+        parser.add_argument('--handshake-ms', type=float, default=40, help="Added to every new connection")
+
+    def handle(self, *args, **options):
+        stub = DarajaStub(latency=options['latency_ms'] / 1000, handshake=options['handshake_ms'] / 1000)
+        with stub, override_settings(MPESA_API_URL=stub.url):
+            self._run('unpooled', lambda: unpooled_stk_push(stub.url), stub, options)
+
+            cache.delete(services.TOKEN_CACHE_KEY)
+            services.tokens = services.TokenManager()
+            service = MpesaService()
+            self._run(
+                'pooled', lambda: service.stk_push('254700000000', 1, 'benchmark'), stub, options
+            )
+
+    def _run(self, label, push, stub, options):
+        stub.counts.clear()
+        timings = []
+
+        def timed(_):
+            started = time.perf_counter()
+            response = push()
+            timings.append(time.perf_counter() - started)
+            return response
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            failed = sum(1 for response in pool.map(timed, range(options['payments']))
+                         if response.get('ResponseCode') != '0')
+        total = time.perf_counter() - started
+        timings.sort()
+        self.stdout.write(
+            f"{label}: {len(timings)} pushes in {total:.2f}s ({len(timings) / total:.0f}/s), "
+            f"p50={timings[len(timings) // 2] * 1000:.1f}ms p99={timings[int(len(timings) * 0.99)] * 1000:.1f}ms; "
+            f"{stub.counts['connections']} connections, {stub.counts['tokens']} token requests, {failed} failed"
+        )
@@ -0,0 +1,40 @@
+import json
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from payments import reconciliation
+
+
+class Command(BaseCommand):
+    help = ("Check pending and processing payments with M-Pesa and Stripe, apply their results and "
+            "write the discrepancies as JSON Lines")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=int(reconciliation.STALE_AFTER.total_seconds() // 60),
+                            metavar='MINUTES', help="Only payments untouched for this long")
+        parser.add_argument('--chunk-size', type=int, default=reconciliation.CHUNK_SIZE)
+        parser.add_argument('--workers', type=int, default=reconciliation.MAX_WORKERS,
+                            help="Concurrent provider requests")
+        parser.add_argument('--dry-run', action='store_true', help="Report without changing anything")
+        parser.add_argument('--report', metavar='PATH', help="Write the discrepancies here instead of stdout")
+
+    def handle(self, *args, **options):
+        out = open(options['report'], 'w') if options['report'] else self.stdout
+        started = time.perf_counter()
+        try:
+            summary = reconciliation.reconcile(
+                older_than=timedelta(minutes=options['older_than']),
+                chunk_size=options['chunk_size'],
+                workers=options['workers'],
+                dry_run=options['dry_run'],
+                report=lambda discrepancy: out.write(json.dumps(discrepancy) + '\n'),
+            )
+        finally:
+            if options['report']:
+                out.close()
+        counts = ', '.join(f"{name} {count}" for name, count in sorted(summary.items()))
+        self.stderr.write(self.style.SUCCESS(
+            f"Reconciled in {time.perf_counter() - started:.1f}s: {counts or 'nothing to check'}"
+        ))
@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from payments import callbacks
+from payments.models import PaymentEvent
+from payments.tasks import process_payment_event
+
+
+class Command(BaseCommand):
+    help = "Process stored M-Pesa and Stripe callbacks again: failed ones, or named events"
+
+    def add_arguments(self, parser):
+        parser.add_argument('ids', nargs='*', type=int, help="Event ids (default: every failed event)")
+        parser.add_argument('--provider', choices=[value for value, _ in PaymentEvent.PROVIDERS])
+        parser.add_argument('--stuck', type=int, metavar='MINUTES',
+                            help="Also replay events still unprocessed after this many minutes")
+        parser.add_argument('--queue', action='store_true', help="Send them to Celery instead of running inline")
+
+    def handle(self, *args, **options):
+        events = PaymentEvent.objects.exclude(status='processed')
+        if options['ids']:
+            events = events.filter(pk__in=options['ids'])
+        elif options['stuck'] is not None:
+            stuck = events.filter(
+                status='received', received_at__lt=timezone.now() - timedelta(minutes=options['stuck'])
+            )
+            events = events.filter(status='failed') | stuck
+        else:
+            events = events.filter(status='failed')
+        if options['provider']:
+            events = events.filter(provider=options['provider'])
+
+        processed = failed = 0
+        for event_id in events.order_by('received_at').values_list('id', flat=True).iterator():
+            if options['queue']:
+                process_payment_event.delay(event_id)
+                processed += 1
+                continue
+            try:
+                callbacks.process(event_id)
+                processed += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Event {event_id}: {e}")
+
+        verb = "Queued" if options['queue'] else "Processed"
+        self.stdout.write(self.style.SUCCESS(f"{verb} {processed} events, {failed} failed"))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from payments import ledger
+
+
+class Command(BaseCommand):
+    help = "Post ledger entries for paid payments that have none, then snapshot provider balances"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backfill', action='store_true', help="Post entries for payments missing them first")
+
+    def handle(self, *args, **options):
+        if options['backfill']:
+            posted = ledger.backfill()
+            self.stdout.write(f"Posted ledger entries for {posted} payments")
+        snapshots = ledger.take_snapshots()
+        self.stdout.write(self.style.SUCCESS(f"Took {snapshots} balance snapshots"))
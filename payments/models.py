@@ -1,4 +1,9 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.utils import timezone
+
 from orders.models import Order
 
 class Payment(models.Model):
@@ -26,10 +31,11 @@ class Payment(models.Model):
     # M-Pesa specific fields
     phone_number = models.CharField(max_length=15, blank=True)
     merchant_request_id = models.CharField(max_length=100, null=True, blank=True)
-    checkout_request_id = models.CharField(max_length=100, null=True, blank=True)
+    # Callbacks and reconciliation look payments up by their provider ids
+    checkout_request_id = models.CharField(max_length=100, null=True, blank=True, db_index=True)
 
     # Card payment fields
-    stripe_payment_intent_id = models.CharField(max_length=100, null=True, blank=True)
+    stripe_payment_intent_id = models.CharField(max_length=100, null=True, blank=True, db_index=True)
     card_last4 = models.CharField(max_length=4, null=True, blank=True)
     card_brand = models.CharField(max_length=20, null=True, blank=True)
 
@@ -44,6 +50,9 @@ class Payment(models.Model):
 
     # Metadata
     metadata = models.JSONField(null=True, blank=True, help_text="Additional payment data")
+    # One per initiation attempt; repeats of a create request with the same
+    # key return this payment, and Stripe gets it so retries never charge twice
+    idempotency_key = models.CharField(max_length=64, unique=True, null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -53,3 +62,159 @@ class Payment(models.Model):
 
     def __str__(self):
         return f"Payment {self.transaction_id} for Order #{self.order.id}"
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # The ledger and metrics receivers compare the next save with this one
+        self._loaded_values = {
+            **getattr(self, '_loaded_values', {}),
+            'status': self.status, 'refund_amount': self.refund_amount,
+        }
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember loaded values so signal handlers can see what changed
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+
+class Refund(models.Model):
+    """
+    A refund of part or all of a payment. Repeats of a refund request with
+    the same idempotency key return this refund, and Stripe gets the key so
+    retries never refund twice.
+    """
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name='refunds')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    idempotency_key = models.CharField(max_length=64, unique=True)
+    # Stripe's refund id; empty for payments refunded outside the platform
+    provider_refund_id = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Refund of {self.amount} for payment {self.payment_id}"
+
+
+class PaymentEvent(models.Model):
+    """
+    A provider callback or webhook, stored as received and processed once
+    by a Celery worker (see payments.callbacks)
+    """
+    PROVIDERS = (
+        ('mpesa', 'M-Pesa'),
+        ('stripe', 'Stripe'),
+    )
+
+    STATUS_CHOICES = (
+        ('received', 'Received'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    )
+
+    provider = models.CharField(max_length=20, choices=PROVIDERS)
+    # Stripe's event id; the CheckoutRequestID for M-Pesa, which sends one
+    # result per STK push
+    event_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='received')
+    attempts = models.PositiveIntegerField(default=0)
+    error_message = models.TextField(blank=True)
+    payment = models.ForeignKey(Payment, on_delete=models.SET_NULL, null=True, blank=True, related_name='events')
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-received_at']
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'event_id'], name='unique_payment_event'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'received_at'], name='payment_event_status_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_provider_display()} {self.event_type} {self.event_id}"
+
+
+class LedgerEntry(models.Model):
+    """
+    One leg of a double-entry posting (see payments.ledger). Amounts are
+    signed, debits positive and credits negative, and the legs of a posting
+    sum to zero. Entries are never changed or deleted; a correction is a
+    new posting.
+    """
+    ENTRY_TYPES = (
+        ('charge', 'Charge'),
+        ('refund', 'Refund'),
+        ('fee', 'Fee'),
+    )
+
+    ACCOUNTS = (
+        # Money held for the platform by M-Pesa and Stripe
+        ('cash', 'Provider cash'),
+        # What the platform owes the service provider
+        ('provider', 'Provider payable'),
+        ('platform', 'Platform fees'),
+    )
+
+    posting = models.UUIDField(default=uuid.uuid4, editable=False)
+    entry_type = models.CharField(max_length=20, choices=ENTRY_TYPES)
+    account = models.CharField(max_length=20, choices=ACCOUNTS)
+    provider = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name='ledger_entries'
+    )
+    payment = models.ForeignKey(Payment, on_delete=models.PROTECT, null=True, blank=True, related_name='ledger_entries')
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    # Provider transaction or refund id
+    reference = models.CharField(max_length=100, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['created_at', 'id']
+        verbose_name_plural = 'Ledger entries'
+        indexes = [
+            models.Index(fields=['provider', 'id'], name='ledger_provider_entry_idx'),
+            models.Index(fields=['created_at'], name='ledger_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_entry_type_display()} {self.account} {self.amount}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Ledger entries cannot be changed")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Ledger entries cannot be deleted")
+
+
+class LedgerSnapshot(models.Model):
+    """
+    A provider's ledger totals, taken at as_of, over every entry up to
+    last_entry_id
+    """
+    provider = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='ledger_snapshots')
+    as_of = models.DateTimeField()
+    last_entry_id = models.BigIntegerField(default=0)
+    balance = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    charges = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    refunds = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    fees = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-as_of']
+        constraints = [
+            models.UniqueConstraint(fields=['provider', 'as_of'], name='unique_ledger_snapshot'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider} balance {self.balance} as of {self.as_of}"
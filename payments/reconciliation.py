@@ -0,0 +1,225 @@
+"""
+Payment reconciliation.
+
+Payments still pending or processing a while after they were started are
+checked against the provider: an STK push query for M-Pesa, a PaymentIntent
+retrieve for cards. This catches results whose callback never arrived.
+
+Stale payments are read in primary key chunks as plain rows. Each chunk's
+provider calls run on a bounded thread pool, which only does HTTP; the
+database work stays on the calling thread. Outcomes are applied per chunk:
+one locked read, one bulk_update of the payments, one metrics update, one
+insert of ledger entries, one bulk transition of the paid orders per
+provider and one notification task.
+Every payment whose provider status differs from ours, or could not be
+checked, is passed to report() as a discrepancy.
+"""
+import logging
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+import stripe
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from orders.events import publish_on_commit
+from orders.notifications import dispatch, event
+from orders.transitions import bulk_transition, can_transition
+from users import metrics
+from . import ledger
+from .initiation import payment_data, stripe_client
+from .models import Payment
+from .services import MpesaError, MpesaService
+
+logger = logging.getLogger(__name__)
+
+# Payments younger than this are left to their callbacks
+STALE_AFTER = timedelta(minutes=15)
+CHUNK_SIZE = 200
+# Concurrent provider requests
+MAX_WORKERS = 8
+
+OPEN_STATUSES = ('pending', 'processing')
+ROW_FIELDS = ('id', 'status', 'payment_method', 'checkout_request_id', 'stripe_payment_intent_id', 'updated_at')
+# Daraja's answer to a query for a push the customer has not answered
+STK_PENDING_ERROR = '500.001.1001'
+
+
+def stale_payments(older_than=STALE_AFTER, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of open payments with a provider reference, as dicts of
+    ROW_FIELDS, untouched for older_than
+    """
+    queryset = Payment.objects.filter(
+        Q(payment_method='mpesa', checkout_request_id__isnull=False)
+        | Q(payment_method='card', stripe_payment_intent_id__isnull=False),
+        status__in=OPEN_STATUSES,
+        updated_at__lt=timezone.now() - older_than,
+    ).order_by('pk')
+    last_id = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_id).values(*ROW_FIELDS)[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_id = chunk[-1]['id']
+
+
+def unreferenced_count(older_than=STALE_AFTER):
+    """Stale open payments that never got a provider reference"""
+    return Payment.objects.filter(
+        status__in=OPEN_STATUSES,
+        updated_at__lt=timezone.now() - older_than,
+        checkout_request_id__isnull=True,
+        stripe_payment_intent_id__isnull=True,
+    ).count()
+
+
+def mpesa_status(row):
+    """(status, transaction_id or failure message) of an STK push"""
+    response = MpesaService().stk_query(row['checkout_request_id'])
+    if response.get('errorCode') == STK_PENDING_ERROR:
+        return 'pending', None
+    if 'ResultCode' not in response:
+        raise MpesaError(response.get('errorMessage') or 'Unexpected STK query response')
+    if str(response['ResultCode']) == '0':
+        # The query does not carry the receipt number
+        return 'completed', None
+    return 'failed', response.get('ResultDesc') or 'M-Pesa payment failed'
+
+
+def stripe_status(row):
+    """(status, transaction_id or failure message) of a PaymentIntent"""
+    intent = stripe_client().payment_intents.retrieve(row['stripe_payment_intent_id'])
+    if intent.status == 'succeeded':
+        return 'completed', intent.id
+    if intent.status == 'canceled':
+        return 'failed', 'Payment was cancelled'
+    error = intent.get('last_payment_error')
+    if intent.status == 'requires_payment_method' and error:
+        return 'failed', error.get('message') or 'Payment failed'
+    return 'pending', None
+
+
+CHECKS = {
+    'mpesa': mpesa_status,
+    'card': stripe_status,
+}
+
+
+def check(row):
+    """
+    Ask the provider about a payment row. Runs on the pool; no database
+    access.
+    """
+    try:
+        provider_status, detail = CHECKS[row['payment_method']](row)
+    except (requests.RequestException, MpesaError, stripe.StripeError) as e:
+        return row, 'error', str(e)
+    return row, provider_status, detail
+
+
+def _discrepancy(row, provider_status, detail, action):
+    return {
+        'payment_id': row['id'],
+        'payment_method': row['payment_method'],
+        'reference': row['checkout_request_id'] or row['stripe_payment_intent_id'],
+        'status': row['status'],
+        'provider_status': provider_status,
+        'detail': detail,
+        'action': action,
+        'updated_at': row['updated_at'].isoformat(),
+    }
+
+
+def apply(outcomes):
+    """
+    Apply (row, provider_status, detail) outcomes of one chunk. Returns the
+    ids of the payments changed; a payment that moved on since it was read
+    is left alone.
+    """
+    settled = {row['id']: (provider_status, detail) for row, provider_status, detail in outcomes
+               if provider_status in ('completed', 'failed')}
+    if not settled:
+        return set()
+
+    now = timezone.now()
+    with transaction.atomic():
+        payments = list(
+            Payment.objects.select_for_update(of=('self',)).filter(pk__in=settled, status__in=OPEN_STATUSES)
+            .select_related('order__client', 'order__provider', 'order__service')
+        )
+        deltas = metrics.new_deltas()
+        entries = []
+        paid_orders = defaultdict(list)
+        notifications = []
+        for payment in payments:
+            provider_status, detail = settled[payment.pk]
+            previous = (payment.status, payment.refund_amount)
+            payment.status = provider_status
+            payment.updated_at = now
+            if provider_status == 'completed':
+                payment.transaction_id = detail
+                payment.error_message = None
+                metrics.payment_deltas(payment, previous, deltas)
+                entries += ledger.payment_entries(payment, previous)
+                order = payment.order
+                if can_transition(order.status, 'confirmed'):
+                    paid_orders[order.provider].append((order.pk, order.version))
+                notifications.append(event(
+                    order.provider,
+                    'payment_received',
+                    'Payment Received',
+                    f'Payment of {payment.amount} received for order #{order.id}',
+                    sender=order.client,
+                    related_order=order,
+                    related_service=order.service_id,
+                ))
+            else:
+                payment.error_message = detail
+            publish_on_commit([payment.order.client_id], 'payment', payment_data(payment))
+
+        # bulk_update skips the save signals, which keep the metrics and
+        # the ledger
+        Payment.objects.bulk_update(payments, ['status', 'transaction_id', 'error_message', 'updated_at'])
+        metrics.apply(deltas)
+        ledger.post(entries)
+        for provider, items in paid_orders.items():
+            bulk_transition(provider, items, 'confirmed')
+        dispatch(notifications)
+    return {payment.pk for payment in payments}
+
+
+def reconcile(older_than=STALE_AFTER, chunk_size=CHUNK_SIZE, workers=MAX_WORKERS, dry_run=False, report=None):
+    """
+    Check every stale open payment with its provider and apply what it
+    reports. report(discrepancy) is called for each payment the provider
+    disagrees about or that could not be checked. Returns counts.
+    """
+    summary = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in stale_payments(older_than, chunk_size):
+            outcomes = list(pool.map(check, chunk))
+            changed = set() if dry_run else apply(outcomes)
+            for row, provider_status, detail in outcomes:
+                summary['checked'] += 1
+                summary[provider_status] += 1
+                if provider_status == 'pending':
+                    continue
+                if provider_status == 'error':
+                    action = 'none'
+                elif dry_run:
+                    action = 'would_update'
+                elif row['id'] in changed:
+                    action = 'updated'
+                else:
+                    action = 'skipped'
+                summary[action] += 1
+                if report:
+                    report(_discrepancy(row, provider_status, detail, action))
+    summary['unreferenced'] = unreferenced_count(older_than)
+    logger.info("Reconciled payments: %s", dict(summary))
+    return summary
@@ -4,6 +4,7 @@ from .models import Payment
 class PaymentSerializer(serializers.ModelSerializer):
     order_details = serializers.SerializerMethodField()
     can_refund = serializers.SerializerMethodField()
+    stripe_client_secret = serializers.SerializerMethodField()
 
     class Meta:
         model = Payment
@@ -11,7 +12,7 @@ class PaymentSerializer(serializers.ModelSerializer):
             'id', 'order', 'amount', 'payment_method', 'status',
             'phone_number', 'transaction_id', 'card_last4', 'card_brand',
             'error_message', 'refund_amount', 'metadata',
-            'order_details', 'can_refund',
+            'order_details', 'can_refund', 'stripe_client_secret',
             'created_at', 'updated_at'
         ]
         read_only_fields = ['transaction_id', 'status', 'created_at', 'updated_at', 'card_last4', 'card_brand']
@@ -24,5 +25,21 @@ class PaymentSerializer(serializers.ModelSerializer):
             'client_name': obj.order.client.get_full_name(),
         }
 
+    def _is_payer(self, obj):
+        request = self.context.get('request')
+        return request is not None and request.user.id == obj.order.client_id
+
+    def get_stripe_client_secret(self, obj):
+        # Only the paying client confirms the card payment
+        if obj.payment_method == 'card' and self._is_payer(obj):
+            return (obj.metadata or {}).get('client_secret')
+        return None
+
+    def to_representation(self, obj):
+        data = super().to_representation(obj)
+        if isinstance(data.get('metadata'), dict) and 'client_secret' in data['metadata'] and not self._is_payer(obj):
+            data['metadata'] = {key: value for key, value in data['metadata'].items() if key != 'client_secret'}
+        return data
+
     def get_can_refund(self, obj):
         return obj.status == 'completed' and obj.refund_amount == 0
\ No newline at end of file
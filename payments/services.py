@@ -1,38 +1,201 @@
-from django.conf import settings
-import requests
+"""
+Daraja (M-Pesa) API client.
+
+Every call goes through one pooled keep-alive requests.Session per process,
+with connect and read timeouts and bounded retries, so consecutive calls
+reuse a warm TLS connection. The OAuth access token is cached until shortly
+before it expires: in process memory first, then in the default cache.
+When it has to be renewed, one caller per process takes a thread lock and
+one process takes a cache lock, fetches it and stores it; everyone else
+waits for that token instead of asking Daraja for their own.
+
+Sharing the token and the lock between processes relies on the shared Redis
+cache that settings require outside DEBUG. With the local memory cache used
+in development each process keeps, and renews, its own token.
+"""
 import base64
+import logging
+import os
+import threading
+import time
 from datetime import datetime
-import json
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+TOKEN_CACHE_KEY = 'mpesa:access-token'
+TOKEN_LOCK_KEY = 'mpesa:access-token:lock'
+# Renew this many seconds before Daraja expires the token
+TOKEN_EXPIRY_MARGIN = 60
+# How long a token refresh may hold the lock, and others wait for it
+TOKEN_LOCK_TIMEOUT = 10
+TOKEN_POLL_INTERVAL = 0.05
+
+# (connect, read) seconds; an STK push waits on Safaricom's backend
+TIMEOUT = (3.05, 30)
+POOL_SIZE = 20
+# Connection failures are retried for every method since nothing was sent.
+# Read errors and 5xx responses only for GET: a repeated POST could send the
+# customer a second payment prompt.
+RETRY = Retry(
+    total=3,
+    connect=3,
+    read=2,
+    status=2,
+    backoff_factor=0.3,
+    status_forcelist=(500, 502, 503, 504),
+    allowed_methods=frozenset({'GET'}),
+    raise_on_status=False,
+)
+
+
+class MpesaError(Exception):
+    pass
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    The process's pooled Daraja session. Forked workers (Celery, gunicorn)
+    build their own rather than share the parent's sockets.
+    """
+    global _session, _session_pid
+
+    if _session is None or _session_pid != os.getpid():
+        with _session_lock:
+            if _session is None or _session_pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=RETRY)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session, _session_pid = session, os.getpid()
+    return _session
+
+
+def api_url(path):
+    return f"{settings.MPESA_API_URL.rstrip('/')}{path}"
+
+
+class TokenManager:
+    """
+    The Daraja access token, shared by the threads of a process and, through
+    a shared cache, by every process
+    """
+
+    def __init__(self):
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        token = self._token
+        if token and time.time() < self._expires_at:
+            return token
+        with self._lock:
+            # Another thread may have refreshed it while we waited
+            if self._token and time.time() < self._expires_at:
+                return self._token
+            self._token, self._expires_at = self._shared_token()
+            return self._token
+
+    def invalidate(self, token):
+        """
+        Drop a token Daraja rejected, unless it was already replaced
+        """
+        with self._lock:
+            if self._token == token:
+                self._token, self._expires_at = None, 0
+            cached = cache.get(TOKEN_CACHE_KEY)
+            if cached and cached[0] == token:
+                cache.delete(TOKEN_CACHE_KEY)
+
+    def _shared_token(self):
+        cached = cache.get(TOKEN_CACHE_KEY)
+        if cached and time.time() < cached[1]:
+            return cached
+        if cache.add(TOKEN_LOCK_KEY, os.getpid(), TOKEN_LOCK_TIMEOUT):
+            try:
+                return self._refresh()
+            finally:
+                cache.delete(TOKEN_LOCK_KEY)
+
+        # Another process is refreshing; wait for its token
+        deadline = time.monotonic() + TOKEN_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(TOKEN_POLL_INTERVAL)
+            cached = cache.get(TOKEN_CACHE_KEY)
+            if cached and time.time() < cached[1]:
+                return cached
+            if cache.get(TOKEN_LOCK_KEY) is None:
+                break
+        logger.warning("No shared M-Pesa token appeared; fetching one")
+        return self._refresh()
+
+    def _refresh(self):
+        auth = base64.b64encode(f"{settings.MPESA_CONSUMER_KEY}:{settings.MPESA_CONSUMER_SECRET}".encode()).decode()
+        response = get_session().get(
+            api_url('/oauth/v1/generate'),
+            params={'grant_type': 'client_credentials'},
+            headers={'Authorization': f'Basic {auth}'},
+            timeout=TIMEOUT,
+        )
+        if response.status_code != 200:
+            raise MpesaError(f"Could not get an M-Pesa access token ({response.status_code})")
+        data = response.json()
+        lifetime = int(data.get('expires_in', 3599)) - TOKEN_EXPIRY_MARGIN
+        token = (data['access_token'], time.time() + lifetime)
+        cache.set(TOKEN_CACHE_KEY, token, max(lifetime, 1))
+        return token
+
+
+tokens = TokenManager()
+
 
 class MpesaService:
     def __init__(self):
         self.business_shortcode = settings.MPESA_SHORTCODE
         self.passkey = settings.MPESA_PASSKEY
-        self.consumer_key = settings.MPESA_CONSUMER_KEY
-        self.consumer_secret = settings.MPESA_CONSUMER_SECRET
-        self.access_token = self._get_access_token()
-
-    def _get_access_token(self):
-        url = "https://sandbox.safaricom.co.ke/oauth/v1/generate?grant_type=client_credentials"
-        auth = base64.b64encode(f"{self.consumer_key}:{self.consumer_secret}".encode()).decode()
-        headers = {"Authorization": f"Basic {auth}"}
-        
-        response = requests.get(url, headers=headers)
-        return response.json()["access_token"]
+
+    @property
+    def access_token(self):
+        return tokens.get()
+
+    def _post(self, path, payload):
+        for attempt in range(2):
+            token = tokens.get()
+            response = get_session().post(
+                api_url(path),
+                json=payload,
+                headers={'Authorization': f'Bearer {token}'},
+                timeout=TIMEOUT,
+            )
+            # A token revoked before its expiry is renewed once
+            if response.status_code == 401 and attempt == 0:
+                tokens.invalidate(token)
+                continue
+            break
+        try:
+            return response.json()
+        except ValueError:
+            raise MpesaError(f"Unexpected M-Pesa response ({response.status_code})")
+
+    def _password(self, timestamp):
+        return base64.b64encode(f"{self.business_shortcode}{self.passkey}{timestamp}".encode()).decode()
 
     def stk_push(self, phone_number, amount, order_ref):
-        url = "https://sandbox.safaricom.co.ke/mpesa/stkpush/v1/processrequest"
         timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        password = base64.b64encode(f"{self.business_shortcode}{self.passkey}{timestamp}".encode()).decode()
-        
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-        
         payload = {
             "BusinessShortCode": self.business_shortcode,
-            "Password": password,
+            "Password": self._password(timestamp),
             "Timestamp": timestamp,
             "TransactionType": "CustomerPayBillOnline",
             "Amount": int(amount),
@@ -43,6 +206,18 @@ class MpesaService:
             "AccountReference": f"Order#{order_ref}",
             "TransactionDesc": f"Payment for Order#{order_ref}"
         }
-        
-        response = requests.post(url, json=payload, headers=headers)
-        return response.json()
\ No newline at end of file
+        return self._post('/mpesa/stkpush/v1/processrequest', payload)
+
+    def stk_query(self, checkout_request_id):
+        """
+        The result of an STK push. Daraja answers with an errorCode while
+        the customer has not responded yet.
+        """
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        payload = {
+            "BusinessShortCode": self.business_shortcode,
+            "Password": self._password(timestamp),
+            "Timestamp": timestamp,
+            "CheckoutRequestID": checkout_request_id,
+        }
+        return self._post('/mpesa/stkpushquery/v1/query', payload)
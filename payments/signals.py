@@ -0,0 +1,17 @@
+from django.db.models.signals import post_save, pre_save
+from django.dispatch import receiver
+
+from . import ledger
+from .models import Payment
+
+
+@receiver(pre_save, sender=Payment)
+def remember_ledger_state(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_values', None)
+    instance._ledger_previous = None if instance._state.adding or loaded is None else (
+        loaded.get('status'), loaded.get('refund_amount'))
+
+
+@receiver(post_save, sender=Payment)
+def post_ledger_entries(sender, instance, **kwargs):
+    ledger.post(ledger.payment_entries(instance, instance._ledger_previous))
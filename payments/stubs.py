@@ -0,0 +1,216 @@
+"""
+Local stand-ins for the payment providers' APIs (Daraja and Stripe), for
+tests and benchmarks.
+
+Each stub is an HTTP/1.1 keep-alive server on a thread. latency is added to
+every request and handshake to every new connection, roughly what a TLS
+handshake to the real provider costs, so pooling shows up in benchmarks.
+"""
+import json
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out as separate writes
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.stub.count('connections')
+        time.sleep(self.server.stub.handshake)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, method):
+        stub = self.server.stub
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        time.sleep(stub.latency)
+        stub.count('requests')
+        status, payload = stub.handle(method, url.path, parse_qs(url.query), self.headers, body)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+
+class StubServer:
+    def __init__(self, latency=0.0, handshake=0.0):
+        self.latency = latency
+        self.handshake = handshake
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self.server = None
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def handle(self, method, path, query, headers, body):
+        return 404, {'error': 'not found'}
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class DarajaStub(StubServer):
+    """
+    OAuth, STK push and STK query endpoints of Safaricom's Daraja API.
+    Set stk_results[checkout_request_id] to a ResultCode and ResultDesc
+    for STK queries to report; other pushes are still being processed.
+    """
+    TOKEN_LIFETIME = 3599
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = set()
+        self.stk_results = {}
+
+    def revoke_tokens(self):
+        self.tokens.clear()
+
+    def _authorized(self, headers):
+        authorization = headers.get('Authorization', '')
+        return authorization.startswith('Bearer ') and authorization[7:] in self.tokens
+
+    def handle(self, method, path, query, headers, body):
+        if path == '/oauth/v1/generate' and method == 'GET':
+            self.count('tokens')
+            token = uuid.uuid4().hex
+            self.tokens.add(token)
+            return 200, {'access_token': token, 'expires_in': str(self.TOKEN_LIFETIME)}
+        if not self._authorized(headers):
+            return 401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}
+        if path == '/mpesa/stkpush/v1/processrequest' and method == 'POST':
+            self.count('stk_push')
+            return 200, self.stk_push(json.loads(body or b'{}'))
+        if path == '/mpesa/stkpushquery/v1/query' and method == 'POST':
+            self.count('stk_query')
+            return self.stk_query(json.loads(body or b'{}'))
+        return super().handle(method, path, query, headers, body)
+
+    def stk_push(self, payload):
+        return {
+            'MerchantRequestID': uuid.uuid4().hex,
+            'CheckoutRequestID': f'ws_CO_{uuid.uuid4().hex}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+
+    def stk_query(self, payload):
+        checkout_request_id = payload.get('CheckoutRequestID')
+        if checkout_request_id not in self.stk_results:
+            return 500, {
+                'requestId': uuid.uuid4().hex,
+                'errorCode': '500.001.1001',
+                'errorMessage': 'The transaction is being processed',
+            }
+        result_code, result_desc = self.stk_results[checkout_request_id]
+        return 200, {
+            'ResponseCode': '0',
+            'ResponseDescription': 'The service request has been accepted successsfully',
+            'MerchantRequestID': uuid.uuid4().hex,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': str(result_code),
+            'ResultDesc': result_desc,
+        }
+
+
+class StripeStub(StubServer):
+    """
+    PaymentIntent and Refund endpoints of the Stripe API, honouring
+    Idempotency-Key
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.intents = {}
+        self.idempotent_responses = {}
+
+    def handle(self, method, path, query, headers, body):
+        if not headers.get('Authorization', '').startswith('Bearer '):
+            return 401, {'error': {'type': 'invalid_request_error', 'message': 'No API key provided'}}
+        if path == '/v1/payment_intents' and method == 'POST':
+            return self._create('payment_intents', self.create_intent, headers, body)
+        if path == '/v1/refunds' and method == 'POST':
+            return self._create('refunds', self.create_refund, headers, body)
+        if path.startswith('/v1/payment_intents/') and method == 'GET':
+            intent = self.intents.get(path.rsplit('/', 1)[1])
+            if intent is None:
+                return 404, {'error': {'type': 'invalid_request_error', 'code': 'resource_missing',
+                                       'message': 'No such payment_intent'}}
+            return 200, intent
+        return super().handle(method, path, query, headers, body)
+
+    def _create(self, name, create, headers, body):
+        key = headers.get('Idempotency-Key')
+        if key and key in self.idempotent_responses:
+            return self.idempotent_responses[key]
+        self.count(name)
+        params = {field: values[0] for field, values in parse_qs(body.decode()).items()}
+        response = 200, create(params)
+        if key:
+            self.idempotent_responses[key] = response
+        return response
+
+    def create_intent(self, params):
+        intent_id = f'pi_{uuid.uuid4().hex[:24]}'
+        intent = {
+            'id': intent_id,
+            'object': 'payment_intent',
+            'amount': int(params.get('amount', 0)),
+            'currency': params.get('currency', 'usd'),
+            'client_secret': f'{intent_id}_secret_{uuid.uuid4().hex[:24]}',
+            'status': 'requires_payment_method',
+            'metadata': {
+                name[len('metadata['):-1]: value for name, value in params.items() if name.startswith('metadata[')
+            },
+        }
+        self.intents[intent_id] = intent
+        return intent
+
+    def create_refund(self, params):
+        return {
+            'id': f're_{uuid.uuid4().hex[:24]}',
+            'object': 'refund',
+            'amount': int(params.get('amount', 0)),
+            'payment_intent': params.get('payment_intent'),
+            'status': 'succeeded',
+        }
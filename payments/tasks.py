@@ -0,0 +1,46 @@
+import logging
+
+from celery import shared_task
+
+from . import callbacks, initiation, ledger, reconciliation
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(bind=True, max_retries=5)
+def initiate_payment(self, payment_id):
+    """Call the provider for a pending payment"""
+    try:
+        payment = initiation.initiate(payment_id)
+    except initiation.RetryableError as e:
+        if self.request.retries >= self.max_retries:
+            initiation.fail(payment_id, 'Could not reach the payment provider')
+            return 'failed'
+        raise self.retry(exc=e, countdown=2 ** self.request.retries)
+    return payment.status if payment else None
+
+
+@shared_task(bind=True, max_retries=5)
+def process_payment_event(self, event_id):
+    """Apply a stored provider callback"""
+    try:
+        event = callbacks.process(event_id)
+    except Exception as e:
+        # Left failed for replay_payment_events once retries run out
+        raise self.retry(exc=e, countdown=2 ** self.request.retries * 5)
+    return event.status if event else None
+
+
+@shared_task
+def reconcile_payments():
+    """Settle stale payments whose provider callback never arrived"""
+    summary = reconciliation.reconcile(
+        report=lambda discrepancy: logger.warning("Payment discrepancy: %s", discrepancy)
+    )
+    return dict(summary)
+
+
+@shared_task
+def snapshot_ledger_balances():
+    """Snapshot provider ledger totals so balance reads stay short"""
+    return ledger.take_snapshots()
@@ -1,3 +1,477 @@
-from django.test import TestCase
+import hashlib
+import hmac
+import io
+import json
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from orders.models import Order
+from services.models import Category, Service
+from users import metrics
+from users.signals import record_payment_metrics
+from . import callbacks, initiation, ledger, reconciliation, services
+from .initiation import RetryableError, initiate
+from .models import LedgerEntry, LedgerSnapshot, Payment, PaymentEvent
+from .services import MpesaService
+from .stubs import DarajaStub, StripeStub
+
+User = get_user_model()
+
+
+class MpesaClientTest(TestCase):
+    def setUp(self):
+        self.stub = DarajaStub().start()
+        self.addCleanup(self.stub.stop)
+        settings_override = override_settings(MPESA_API_URL=self.stub.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.delete(services.TOKEN_CACHE_KEY)
+        services.tokens = services.TokenManager()
+
+    def test_token_and_connection_are_reused(self):
+        for _ in range(5):
+            response = MpesaService().stk_push('254700000000', 100, 1)
+            self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(self.stub.counts['tokens'], 1)
+        self.assertEqual(self.stub.counts['connections'], 1)
+
+        # Another worker process finds the token in the shared cache
+        services.tokens = services.TokenManager()
+        MpesaService().stk_push('254700000000', 100, 2)
+        self.assertEqual(self.stub.counts['tokens'], 1)
+
+    def test_concurrent_refresh_fetches_one_token(self):
+        barrier = threading.Barrier(8)
+        results = []
+
+        def push():
+            barrier.wait()
+            results.append(MpesaService().stk_push('254700000000', 100, 1)['ResponseCode'])
+
+        threads = [threading.Thread(target=push) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['0'] * 8)
+        self.assertEqual(self.stub.counts['tokens'], 1)
+
+    def test_rejected_token_is_renewed_once(self):
+        MpesaService().stk_push('254700000000', 100, 1)
+        self.stub.revoke_tokens()
+        response = MpesaService().stk_push('254700000000', 100, 1)
+        self.assertEqual(response['ResponseCode'], '0')
+        self.assertEqual(self.stub.counts['tokens'], 2)
+
+class PaymentInitiationTest(APITestCase):
+    def setUp(self):
+        self.daraja = DarajaStub().start()
+        self.addCleanup(self.daraja.stop)
+        self.stripe = StripeStub().start()
+        self.addCleanup(self.stripe.stop)
+        settings_override = override_settings(
+            MPESA_API_URL=self.daraja.url, STRIPE_API_BASE=self.stripe.url, PAYMENT_INITIATION_ASYNC=True
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.delete(services.TOKEN_CACHE_KEY)
+        services.tokens = services.TokenManager()
+        initiation._stripe_client = None
+        self.addCleanup(setattr, initiation, '_stripe_client', None)
+
+        provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        service = Service.objects.create(
+            provider=provider, category=Category.objects.create(name='HOME', description='Home services'),
+            name='Test Service', description='Test service', price=50, base_price=50,
+            image='services/test.jpg', location='Nairobi'
+        )
+        self.order = Order.objects.create(client=self.client_user, service=service)
+        self.url = reverse('payments:payment-create', args=[self.order.pk])
+        self.client.force_authenticate(user=self.client_user)
+
+    def test_provider_is_called_after_the_response(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(self.url, {'payment_method': 'mpesa', 'phone_number': '254700000000'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['status'], 'pending')
+        self.assertEqual(self.daraja.counts['stk_push'], 0)
+
+        for callback in callbacks:
+            callback()
+        payment = Payment.objects.get(pk=response.data['payment_id'])
+        self.assertEqual(payment.status, 'processing')
+        self.assertTrue(payment.checkout_request_id.startswith('ws_CO_'))
+        self.assertEqual(self.client.get(response.data['status_url']).data['status'], 'processing')
+
+    def test_retried_request_starts_one_payment(self):
+        for _ in range(2):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.post(
+                    self.url, {'payment_method': 'card'}, HTTP_IDEMPOTENCY_KEY='checkout-1'
+                )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['stripe_client_secret'].startswith('pi_'))
+        self.assertEqual(Payment.objects.count(), 1)
+        self.assertEqual(self.stripe.counts['payment_intents'], 1)
+
+        # Stripe sees the same idempotency key if the worker repeats the call
+        payment = Payment.objects.get()
+        initiation._create_intent(payment)
+        self.assertEqual(self.stripe.counts['payment_intents'], 1)
+        self.assertIsNone(initiate(payment.pk))
+
+    def test_unreachable_provider_leaves_payment_pending(self):
+        payment = Payment.objects.create(
+            order=self.order, amount=50, payment_method='mpesa', phone_number='254700000000', idempotency_key='k'
+        )
+        self.daraja.stop()
+        self.addCleanup(self.daraja.start)
+        with self.assertRaises(RetryableError):
+            initiate(payment.pk)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'pending')
+
+    def test_rejected_push_fails_the_payment(self):
+        self.daraja.stk_push = lambda payload: {'ResponseCode': '1', 'ResponseDescription': 'Invalid phone number'}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'payment_method': 'mpesa', 'phone_number': '1'})
+        payment = Payment.objects.get(pk=response.data['payment_id'])
+        self.assertEqual((payment.status, payment.error_message), ('failed', 'Invalid phone number'))
+
+        # A failed payment can be started again
+        del self.daraja.stk_push
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(self.url, {'payment_method': 'mpesa', 'phone_number': '254700000000'})
+        self.assertEqual(response.data['payment_id'], payment.pk)
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'processing')
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET='whsec_test')
+class PaymentCallbackTest(APITestCase):
+    def setUp(self):
+        provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        client = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        service = Service.objects.create(
+            provider=provider, category=Category.objects.create(name='HOME', description='Home services'),
+            name='Test Service', description='Test service', price=50, base_price=50,
+            image='services/test.jpg', location='Nairobi'
+        )
+        self.order = Order.objects.create(client=client, service=service)
+        self.payment = Payment.objects.create(
+            order=self.order, amount=50, phone_number='254700000000', status='processing',
+            checkout_request_id='ws_CO_1', stripe_payment_intent_id='pi_1'
+        )
+
+    def mpesa_callback(self, checkout_request_id='ws_CO_1', result_code=0):
+        data = {'Body': {'stkCallback': {
+            'MerchantRequestID': 'm-1',
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 50},
+                {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+                {'Name': 'PhoneNumber', 'Value': 254700000000},
+            ]},
+        }}}
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('payments:mpesa-callback'), data, format='json')
+
+    def stripe_webhook(self, event):
+        payload = json.dumps(event)
+        timestamp = int(time.time())
+        signature = hmac.new(b'whsec_test', f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(
+                reverse('payments:stripe-webhook'), payload, content_type='application/json',
+                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}'
+            )
+
+    def test_resent_mpesa_callback_is_applied_once(self):
+        for _ in range(2):
+            self.assertEqual(self.mpesa_callback().status_code, status.HTTP_200_OK)
+
+        event = PaymentEvent.objects.get()
+        self.assertEqual((event.status, event.attempts, event.payment), ('processed', 1, self.payment))
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.transaction_id), ('completed', 'NLJ7RT61SV'))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'confirmed')
+
+        # Processing it again changes nothing
+        version = self.order.version
+        self.assertEqual(callbacks.process(event.pk).attempts, 1)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.version, version)
+
+    def test_stripe_webhook(self):
+        event = {'id': 'evt_1', 'object': 'event', 'type': 'payment_intent.payment_failed', 'data': {'object': {
+            'id': 'pi_1', 'object': 'payment_intent', 'last_payment_error': {'message': 'Your card was declined.'},
+        }}}
+        self.assertEqual(self.stripe_webhook(event).status_code, status.HTTP_200_OK)
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.error_message), ('failed', 'Your card was declined.'))
+
+        # The customer retries with another card
+        event = {'id': 'evt_2', 'object': 'event', 'type': 'payment_intent.succeeded', 'data': {'object': {
+            'id': 'pi_1', 'object': 'payment_intent', 'status': 'succeeded',
+        }}}
+        self.stripe_webhook(event)
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.transaction_id), ('completed', 'pi_1'))
+        self.assertEqual(PaymentEvent.objects.filter(status='processed').count(), 2)
+
+        forged = self.client.post(
+            reverse('payments:stripe-webhook'), json.dumps(event), content_type='application/json',
+            HTTP_STRIPE_SIGNATURE='t=1,v1=bad'
+        )
+        self.assertEqual(forged.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_failed_event_is_replayed(self):
+        # The callback beat the worker saving the push's CheckoutRequestID
+        self.assertEqual(self.mpesa_callback('ws_CO_2').status_code, status.HTTP_200_OK)
+        event = PaymentEvent.objects.get()
+        self.assertEqual(event.status, 'failed')
+        self.assertIn('No payment', event.error_message)
+
+        Payment.objects.filter(pk=self.payment.pk).update(checkout_request_id='ws_CO_2')
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('replay_payment_events', stdout=io.StringIO(), stderr=io.StringIO())
+        event.refresh_from_db()
+        self.assertEqual(event.status, 'processed')
+        self.assertEqual(Payment.objects.get(pk=self.payment.pk).status, 'completed')
+
+
+class ReconciliationTest(TestCase):
+    def setUp(self):
+        self.daraja = DarajaStub().start()
+        self.addCleanup(self.daraja.stop)
+        self.stripe = StripeStub().start()
+        self.addCleanup(self.stripe.stop)
+        settings_override = override_settings(MPESA_API_URL=self.daraja.url, STRIPE_API_BASE=self.stripe.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        cache.delete(services.TOKEN_CACHE_KEY)
+        services.tokens = services.TokenManager()
+        initiation._stripe_client = None
+        self.addCleanup(setattr, initiation, '_stripe_client', None)
+
+        provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.service = Service.objects.create(
+            provider=provider, category=Category.objects.create(name='HOME', description='Home services'),
+            name='Test Service', description='Test service', price=50, base_price=50,
+            image='services/test.jpg', location='Nairobi'
+        )
+
+    def payment(self, age=timedelta(hours=1), **fields):
+        order = Order.objects.create(client=self.client_user, service=self.service)
+        payment = Payment.objects.create(order=order, amount=50, status='processing', **fields)
+        Payment.objects.filter(pk=payment.pk).update(updated_at=timezone.now() - age)
+        return payment
+
+    def intent(self, status, error=None):
+        intent = self.stripe.create_intent({'amount': '5000'})
+        intent.update(status=status, last_payment_error=error)
+        return intent['id']
+
+    def test_reconcile(self):
+        paid = self.payment(checkout_request_id='ws_CO_paid')
+        cancelled = self.payment(checkout_request_id='ws_CO_cancelled')
+        waiting = self.payment(checkout_request_id='ws_CO_waiting')
+        recent = self.payment(checkout_request_id='ws_CO_recent', age=timedelta(0))
+        self.daraja.stk_results.update({
+            'ws_CO_paid': (0, 'The service request is processed successfully.'),
+            'ws_CO_cancelled': (1032, 'Request cancelled by user'),
+            'ws_CO_recent': (0, 'The service request is processed successfully.'),
+        })
+        card = self.payment(payment_method='card', stripe_payment_intent_id=self.intent('succeeded'))
+        declined = self.payment(payment_method='card', stripe_payment_intent_id=self.intent(
+            'requires_payment_method', {'message': 'Your card was declined.'}
+        ))
+        missing = self.payment(payment_method='card', stripe_payment_intent_id='pi_missing')
+
+        report = []
+        with self.captureOnCommitCallbacks(execute=True):
+            summary = reconciliation.reconcile(chunk_size=2, workers=4, report=report.append)
+
+        def status_of(payment):
+            return Payment.objects.get(pk=payment.pk).status
+
+        self.assertEqual(
+            [status_of(payment) for payment in (paid, cancelled, waiting, recent, card, declined, missing)],
+            ['completed', 'failed', 'processing', 'processing', 'completed', 'failed', 'processing']
+        )
+        self.assertEqual(Payment.objects.get(pk=card.pk).transaction_id, card.stripe_payment_intent_id)
+        self.assertEqual(Payment.objects.get(pk=declined.pk).error_message, 'Your card was declined.')
+        self.assertEqual(Order.objects.get(pk=paid.order_id).status, 'confirmed')
+        self.assertEqual(metrics.totals(self.service.provider).payments_amount, 100)
+        self.assertEqual(self.daraja.counts['stk_query'], 3)
+
+        self.assertEqual(
+            (summary['checked'], summary['completed'], summary['failed'], summary['pending'], summary['error']),
+            (6, 2, 2, 1, 1)
+        )
+        actions = {row['payment_id']: (row['provider_status'], row['action']) for row in report}
+        self.assertEqual(actions, {
+            paid.pk: ('completed', 'updated'),
+            cancelled.pk: ('failed', 'updated'),
+            card.pk: ('completed', 'updated'),
+            declined.pk: ('failed', 'updated'),
+            missing.pk: ('error', 'none'),
+        })
+
+        # Settled payments are not checked again
+        self.assertEqual(reconciliation.reconcile(report=report.append)['checked'], 2)
+
+    def test_dry_run_command(self):
+        payment = self.payment(checkout_request_id='ws_CO_paid')
+        self.daraja.stk_results['ws_CO_paid'] = (0, 'The service request is processed successfully.')
+        out = io.StringIO()
+        call_command('reconcile_payments', '--dry-run', stdout=out, stderr=io.StringIO())
+        self.assertEqual(json.loads(out.getvalue())['action'], 'would_update')
+        self.assertEqual(Payment.objects.get(pk=payment.pk).status, 'processing')
+
+
+@override_settings(PLATFORM_FEE_RATE=0.1)
+class LedgerTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        client = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        self.service = Service.objects.create(
+            provider=self.provider, category=Category.objects.create(name='HOME', description='Home services'),
+            name='Test Service', description='Test service', price=100, base_price=100,
+            image='services/test.jpg', location='Nairobi'
+        )
+        self.client_user = client
+
+    def paid(self, amount=100):
+        order = Order.objects.create(client=self.client_user, service=self.service)
+        payment = Payment.objects.create(order=order, amount=amount, status='processing')
+        payment.status = 'completed'
+        payment.save()
+        return payment
+
+    def test_charges_fees_and_partial_refunds(self):
+        payment = self.paid()
+        self.client.force_authenticate(user=self.provider)
+        url = reverse('payments:payment-refund', args=[payment.pk])
+        self.assertEqual(self.client.post(url, {'amount': '20'}).status_code, status.HTTP_200_OK)
+        response = self.client.post(url, {'amount': '30'})
+        self.assertEqual(response.data['total_refunded'], Decimal('50'))
+        self.assertEqual(self.client.post(url, {'amount': '60'}).status_code, status.HTTP_400_BAD_REQUEST)
+
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.refund_amount), ('partially_refunded', Decimal('50')))
+        entries = LedgerEntry.objects.filter(payment=payment)
+        self.assertEqual(
+            sorted(entries.filter(account='provider').values_list('entry_type', 'amount')),
+            [('charge', Decimal('-100')), ('fee', Decimal('10')), ('refund', Decimal('20')), ('refund', Decimal('30'))]
+        )
+        # Every posting balances
+        for posting in entries.values_list('posting', flat=True).distinct():
+            self.assertEqual(sum(entries.filter(posting=posting).values_list('amount', flat=True)), 0)
+
+        self.assertEqual(self.client.get(reverse('payments:ledger-balance')).data, {
+            'balance': Decimal('40'), 'charges': Decimal('100'), 'refunds': Decimal('50'), 'fees': Decimal('10'),
+            'snapshot_as_of': None,
+        })
+        with self.assertRaises(ValueError):
+            entries.first().delete()
+
+    def test_saving_again_posts_nothing(self):
+        # The ledger does not rely on other apps' receivers to see the saved state
+        post_save.disconnect(record_payment_metrics, sender=Payment)
+        self.addCleanup(post_save.connect, record_payment_metrics, sender=Payment)
+        payment = self.paid()
+        payment.save()
+        self.assertEqual(LedgerEntry.objects.filter(payment=payment, entry_type='charge').count(), 2)
+
+    def test_retried_card_refund_is_sent_once(self):
+        stripe_stub = StripeStub().start()
+        self.addCleanup(stripe_stub.stop)
+        settings_override = override_settings(STRIPE_API_BASE=stripe_stub.url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        initiation._stripe_client = None
+        self.addCleanup(setattr, initiation, '_stripe_client', None)
+
+        payment = self.paid()
+        payment.payment_method = 'card'
+        payment.stripe_payment_intent_id = 'pi_test'
+        payment.save()
+        Order.objects.filter(pk=payment.order_id).update(status='completed')
+        self.client.force_authenticate(user=self.provider)
+        url = reverse('payments:payment-refund', args=[payment.pk])
+
+        # Stripe refunds, then recording it fails
+        with mock.patch.object(ledger, 'post', side_effect=DatabaseError('lost')):
+            with self.assertRaises(DatabaseError):
+                self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='refund-1')
+        payment.refresh_from_db()
+        self.assertEqual(payment.refund_amount, Decimal('0'))
+
+        # The retry gets the same refund back and records it; later repeats
+        # return it
+        for _ in range(2):
+            response = self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='refund-1')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['refund_amount'], Decimal('100'))
+        self.assertEqual(stripe_stub.counts['refunds'], 1)
+        # A new request finds nothing left to refund
+        self.assertEqual(
+            self.client.post(url, {}, HTTP_IDEMPOTENCY_KEY='refund-2').status_code, status.HTTP_400_BAD_REQUEST
+        )
+        payment.refresh_from_db()
+        self.assertEqual((payment.status, payment.refund_amount), ('refunded', Decimal('100')))
+        self.assertEqual(payment.refunds.get().provider_refund_id, payment.refund_transaction_id)
+        self.assertEqual(LedgerEntry.objects.filter(payment=payment, entry_type='refund', account='provider').count(), 1)
+        self.assertEqual(Order.objects.get(pk=payment.order_id).status, 'refunded')
+
+        # Keys belong to one payment
+        other = self.paid()
+        response = self.client.post(
+            reverse('payments:payment-refund', args=[other.pk]), {}, HTTP_IDEMPOTENCY_KEY='refund-1'
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+    def test_balance_reads_snapshot_and_recent_entries(self):
+        self.paid()
+        as_of = timezone.now()
+        self.assertEqual(ledger.take_snapshots(as_of), 1)
+        # Already taken
+        self.assertEqual(ledger.take_snapshots(as_of), 0)
+
+        self.paid(50)
+        with self.assertNumQueries(2):
+            balance = ledger.balance(self.provider)
+        self.assertEqual((balance['balance'], balance['charges'], balance['fees'], balance['snapshot_as_of']),
+                         (Decimal('135'), Decimal('150'), Decimal('15'), as_of))
+
+        # A later snapshot carries the earlier one forward
+        later = timezone.now()
+        self.assertEqual(ledger.take_snapshots(later), 1)
+        snapshot = LedgerSnapshot.objects.get(provider=self.provider, as_of=later)
+        self.assertEqual((snapshot.balance, snapshot.charges), (Decimal('135'), Decimal('150')))
+        self.assertEqual(ledger.balance(self.provider)['balance'], Decimal('135'))
+
+        # An entry stamped before the snapshot but committed after it
+        payment = Payment.objects.filter(order__service=self.service).first()
+        ledger.post(ledger.refund_entries(payment, Decimal('5'), at=later - timedelta(hours=1)))
+        self.assertEqual(ledger.balance(self.provider)['balance'], Decimal('130'))
+        self.assertEqual(ledger.take_snapshots(), 1)
+        self.assertEqual(ledger.balance(self.provider)['balance'], Decimal('130'))
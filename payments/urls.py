@@ -8,6 +8,8 @@ urlpatterns = [
     path('mpesa-callback/', views.MpesaCallbackView.as_view(), name='mpesa-callback'),
     path('stripe-webhook/', views.StripeWebhookView.as_view(), name='stripe-webhook'),
     path('history/', views.PaymentHistoryView.as_view(), name='payment-history'),
+    path('export/', views.PaymentExportView.as_view(), name='payment-export'),
+    path('balance/', views.LedgerBalanceView.as_view(), name='ledger-balance'),
     path('<int:pk>/', views.PaymentDetailView.as_view(), name='payment-detail'),
     path('<int:payment_id>/refund/', views.PaymentRefundView.as_view(), name='payment-refund'),
 ]
\ No newline at end of file
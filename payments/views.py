@@ -1,144 +1,150 @@
+import json
+from decimal import Decimal, InvalidOperation
+
 from django.shortcuts import render
 from rest_framework import generics, permissions, status
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from .models import Payment
+from .models import Payment, Refund
 from .serializers import PaymentSerializer
 from orders.models import Order
 import stripe
 from django.conf import settings
-from .services import MpesaService
+from django.db import IntegrityError, transaction
+from django.urls import reverse
 from rest_framework.views import APIView
+from service_app.queue import enqueue
+from .initiation import RetryableError, fail, initiate, new_idempotency_key, stripe_client
+from .tasks import initiate_payment, process_payment_event
+from . import callbacks, ledger
+from orders.transitions import can_transition, transition
+from users.permissions import IsProvider
+from service_app.exports import ExportView
+from . import exports as payment_exports
 
 stripe.api_key = settings.STRIPE_SECRET_KEY
 
 class PaymentCreateView(generics.CreateAPIView):
+    """
+    Start paying for an order. The payment is recorded as pending and the
+    provider is called from a Celery worker; the response is 202 with the
+    payment to poll (or wait for its 'payment' event). Send an
+    Idempotency-Key header to make retries of this request return the same
+    payment.
+    """
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, order_id):
         order = get_object_or_404(Order, id=order_id, client=request.user)
         payment_method = request.data.get('payment_method', 'mpesa')
-
-        # Check if payment already exists
-        if hasattr(order, 'payment') and order.payment.status != 'failed':
-            return Response(
-                {'error': 'Payment already exists for this order'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        if payment_method == 'mpesa':
-            return self._create_mpesa_payment(request, order)
-        elif payment_method == 'card':
-            return self._create_card_payment(request, order)
-        else:
+        key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+        if key and len(key) > 64:
+            return Response({'error': 'Idempotency key is too long'}, status=status.HTTP_400_BAD_REQUEST)
+
+        if key:
+            existing = Payment.objects.filter(idempotency_key=key).first()
+            if existing is not None:
+                if existing.order_id != order.id:
+                    return Response(
+                        {'error': 'Idempotency key was used for another order'},
+                        status=status.HTTP_409_CONFLICT
+                    )
+                return self._started(existing)
+
+        if payment_method not in ('mpesa', 'card'):
             return Response(
                 {'error': 'Invalid payment method'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-
-    def _create_mpesa_payment(self, request, order):
         phone_number = request.data.get('phone_number')
-
-        if not phone_number:
+        if payment_method == 'mpesa' and not phone_number:
             return Response(
                 {'error': 'Phone number is required for M-Pesa payments'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
         try:
-            mpesa = MpesaService()
-            response = mpesa.stk_push(
-                phone_number=phone_number,
-                amount=order.total_amount,
-                order_ref=order.id
-            )
-
-            if response.get('ResponseCode') == '0':
-                payment = Payment.objects.create(
-                    order=order,
-                    amount=order.total_amount,
-                    payment_method='mpesa',
-                    phone_number=phone_number,
-                    merchant_request_id=response.get('MerchantRequestID'),
-                    checkout_request_id=response.get('CheckoutRequestID')
-                )
-
-                return Response({
-                    'status': 'success',
-                    'message': 'Please complete the payment on your phone',
-                    'payment_id': payment.id,
-                    'payment_method': 'mpesa'
-                })
-
-            return Response(
-                {'error': response.get('ResponseDescription')},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        except Exception as e:
+            with transaction.atomic():
+                payment = Payment.objects.select_for_update().filter(order=order).first()
+                # Check if payment already exists
+                if payment is not None and payment.status != 'failed':
+                    return Response(
+                        {'error': 'Payment already exists for this order'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                # A failed payment is started again in place
+                payment = payment or Payment(order=order)
+                payment.amount = order.total_amount
+                payment.payment_method = payment_method
+                payment.phone_number = phone_number or ''
+                payment.status = 'pending'
+                payment.error_message = None
+                payment.merchant_request_id = None
+                payment.checkout_request_id = None
+                payment.stripe_payment_intent_id = None
+                payment.idempotency_key = key or new_idempotency_key()
+                payment.save()
+                if settings.PAYMENT_INITIATION_ASYNC:
+                    enqueue(initiate_payment, payment.id)
+        except IntegrityError:
+            # A concurrent request created it first
+            existing = Payment.objects.filter(order=order).first()
+            if key and existing is not None and existing.idempotency_key == key:
+                return self._started(existing)
             return Response(
-                {'error': str(e)},
+                {'error': 'Payment already exists for this order'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-    def _create_card_payment(self, request, order):
-        # For card payments, we'll create a payment record and redirect to Stripe
-        try:
-            # Create Stripe Payment Intent
-            intent = stripe.PaymentIntent.create(
-                amount=int(order.total_amount * 100),  # Convert to cents
-                currency='usd',
-                metadata={'order_id': order.id}
-            )
-
-            payment = Payment.objects.create(
-                order=order,
-                amount=order.total_amount,
-                payment_method='card',
-                stripe_payment_intent_id=intent.id,
-                status='processing'
-            )
-
-            return Response({
-                'status': 'success',
-                'message': 'Redirect to complete card payment',
-                'payment_id': payment.id,
-                'payment_method': 'card',
-                'stripe_client_secret': intent.client_secret,
-                'stripe_publishable_key': settings.STRIPE_PUBLIC_KEY
-            })
-
-        except Exception as e:
-            return Response(
-                {'error': str(e)},
-                status=status.HTTP_400_BAD_REQUEST
-            )
+        if not settings.PAYMENT_INITIATION_ASYNC:
+            try:
+                initiate(payment.id)
+            except RetryableError as e:
+                fail(payment.id, str(e))
+            payment.refresh_from_db()
+            if payment.status == 'failed':
+                return Response({'error': payment.error_message}, status=status.HTTP_400_BAD_REQUEST)
+        return self._started(payment)
+
+    def _started(self, payment):
+        data = {
+            'status': payment.status,
+            'payment_id': payment.id,
+            'payment_method': payment.payment_method,
+            'status_url': reverse('payments:payment-detail', args=[payment.id]),
+        }
+        if payment.status == 'failed':
+            data['error'] = payment.error_message
+        elif payment.payment_method == 'mpesa' and payment.checkout_request_id:
+            data['message'] = 'Please complete the payment on your phone'
+        elif payment.payment_method == 'card' and payment.stripe_payment_intent_id:
+            data['message'] = 'Redirect to complete card payment'
+            data['stripe_client_secret'] = (payment.metadata or {}).get('client_secret')
+            data['stripe_publishable_key'] = settings.STRIPE_PUBLIC_KEY
+        # Still waiting on the provider
+        waiting = payment.status in ('pending', 'processing') and 'message' not in data
+        return Response(data, status=status.HTTP_202_ACCEPTED if waiting else status.HTTP_200_OK)
+
+def _receive(provider, event_id, event_type, payload):
+    with transaction.atomic():
+        event, created = callbacks.record(provider, event_id, event_type, payload)
+        # A resent callback is acknowledged without processing it again
+        if created:
+            enqueue(process_payment_event, event.id)
+    return event
 
 class MpesaCallbackView(APIView):
+    """
+    Store an STK push result for a worker to apply and acknowledge it
+    """
     permission_classes = []  # Allow public access for M-Pesa callbacks
 
     def post(self, request):
-        callback_data = request.data.get('Body', {}).get('stkCallback', {})
-        
-        payment = Payment.objects.filter(
-            checkout_request_id=callback_data.get('CheckoutRequestID')
-        ).first()
-        
-        if payment:
-            if callback_data.get('ResultCode') == 0:
-                payment.status = 'completed'
-                # Get transaction details from callback data
-                payment.transaction_id = callback_data.get('CallbackMetadata', {}).get('Item', [])[1].get('Value')
-                payment.save()
-                
-                # Update order status
-                payment.order.status = 'confirmed'
-                payment.order.save()
-            else:
-                payment.status = 'failed'
-                payment.save()
-        
+        event = callbacks.mpesa_event(request.data)
+        if event is None:
+            return Response({'error': 'Not an STK push callback'}, status=status.HTTP_400_BAD_REQUEST)
+        _receive('mpesa', *event, request.data)
         return Response(status=status.HTTP_200_OK)
 
 class PaymentVerificationView(generics.UpdateAPIView):
@@ -164,6 +170,14 @@ class PaymentHistoryView(generics.ListAPIView):
             return Payment.objects.filter(order__provider=user).select_related('order')
         return Payment.objects.none()
 
+class PaymentExportView(ExportView):
+    """Stream the user's payments as CSV or JSON Lines"""
+    columns = payment_exports.COLUMNS
+    filename = 'payments'
+
+    def get_queryset(self):
+        return payment_exports.exportable(self.request.user)
+
 class PaymentDetailView(generics.RetrieveAPIView):
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -177,7 +191,7 @@ class PaymentDetailView(generics.RetrieveAPIView):
         return Payment.objects.none()
 
 class StripeWebhookView(APIView):
-    """Handle Stripe webhooks"""
+    """Verify a Stripe webhook and store it for a worker to apply"""
     permission_classes = []  # Public access for webhooks
 
     def post(self, request):
@@ -191,105 +205,123 @@ class StripeWebhookView(APIView):
         except (ValueError, stripe.error.SignatureVerificationError):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        if event['type'] == 'payment_intent.succeeded':
-            payment_intent = event['data']['object']
-            self._handle_successful_payment(payment_intent)
-        elif event['type'] == 'payment_intent.payment_failed':
-            payment_intent = event['data']['object']
-            self._handle_failed_payment(payment_intent)
-
+        _receive('stripe', event['id'], event['type'], json.loads(payload))
         return Response(status=status.HTTP_200_OK)
 
-    def _handle_successful_payment(self, payment_intent):
-        payment = Payment.objects.filter(
-            stripe_payment_intent_id=payment_intent['id']
-        ).first()
-
-        if payment:
-            payment.status = 'completed'
-            payment.transaction_id = payment_intent['id']
-            payment.metadata = payment_intent
-            payment.save()
-
-            # Update order status
-            payment.order.status = 'confirmed'
-            payment.order.save()
-
-            # Create notification
-            from orders.models import Notification
-            Notification.objects.create(
-                recipient=payment.order.provider,
-                sender=payment.order.client,
-                notification_type='payment_received',
-                title='Payment Received',
-                message=f'Payment of {payment.amount} received for order #{payment.order.id}',
-                related_order=payment.order,
-                related_service=payment.order.service
-            )
-
-    def _handle_failed_payment(self, payment_intent):
-        payment = Payment.objects.filter(
-            stripe_payment_intent_id=payment_intent['id']
-        ).first()
-
-        if payment:
-            payment.status = 'failed'
-            payment.error_message = payment_intent.get('last_payment_error', {}).get('message', 'Payment failed')
-            payment.save()
-
 class PaymentRefundView(generics.CreateAPIView):
-    """Process payment refunds"""
+    """
+    Refund part or all of what is left of a payment. Each refund is posted
+    to the ledger; refund_amount is the running total.
+
+    Send an Idempotency-Key header to make retries of this request return
+    the same refund. Card refunds are sent to Stripe with that key before
+    the payment row is locked, so a retry after the refund could not be
+    recorded gets the same Stripe refund back, and records it, instead of
+    refunding again.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request, payment_id):
         payment = get_object_or_404(Payment, id=payment_id, order__provider=request.user)
+        key = request.headers.get('Idempotency-Key') or request.data.get('idempotency_key')
+        if key and len(key) > 64:
+            return Response({'error': 'Idempotency key is too long'}, status=status.HTTP_400_BAD_REQUEST)
+        if key:
+            existing = self._existing(payment, key)
+            if existing is not None:
+                return existing
+        key = key or new_idempotency_key()
+
+        refund_amount, error = self._amount(payment, request.data.get('amount'))
+        if error:
+            return error
+
+        refund_id = None
+        if payment.payment_method == 'card' and payment.stripe_payment_intent_id:
+            try:
+                refund = stripe_client().refunds.create(
+                    params={
+                        'payment_intent': payment.stripe_payment_intent_id,
+                        'amount': int(refund_amount * 100),
+                    },
+                    options={'idempotency_key': f'refund-{key}'},
+                )
+            except stripe.StripeError as e:
+                return Response({'error': str(e.user_message or e)}, status=status.HTTP_400_BAD_REQUEST)
+            refund_id = refund.id
+        # For M-Pesa, you'd implement B2C refund logic here
+
+        with transaction.atomic():
+            payment = Payment.objects.select_for_update(of=('self',)).select_related('order').get(pk=payment.pk)
+            # A concurrent repeat of this request recorded it first
+            existing = self._existing(payment, key)
+            if existing is not None:
+                return existing
+            if refund_id is None:
+                # Nothing was sent out, so check again under the lock
+                refund_amount, error = self._amount(payment, request.data.get('amount'))
+                if error:
+                    return error
+            Refund.objects.create(
+                payment=payment, amount=refund_amount, idempotency_key=key, provider_refund_id=refund_id or ''
+            )
+            if refund_id:
+                payment.refund_transaction_id = refund_id
+            payment.refund_amount += refund_amount
+            fully_refunded = payment.refund_amount >= payment.amount
+            payment.status = 'refunded' if fully_refunded else 'partially_refunded'
+            payment.save()
 
-        if payment.status != 'completed':
-            return Response(
+            if fully_refunded:
+                order = payment.order
+                if can_transition(order.status, 'refunded'):
+                    transition(order, 'refunded')
+
+        return self._refunded(refund_amount, payment)
+
+    def _existing(self, payment, key):
+        """The response for a refund already recorded under key, if any"""
+        refund = Refund.objects.filter(idempotency_key=key).first()
+        if refund is None:
+            return None
+        if refund.payment_id != payment.id:
+            return Response({'error': 'Idempotency key was used for another payment'}, status=status.HTTP_409_CONFLICT)
+        return self._refunded(refund.amount, payment)
+
+    def _refunded(self, refund_amount, payment):
+        return Response({
+            'status': 'success',
+            'message': 'Refund processed successfully',
+            'refund_amount': refund_amount,
+            'total_refunded': payment.refund_amount,
+        })
+
+    def _amount(self, payment, value):
+        """(refund amount, None) or (None, error response)"""
+        if payment.status not in ('completed', 'partially_refunded'):
+            return None, Response(
                 {'error': 'Only completed payments can be refunded'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        refund_amount = request.data.get('amount')
-        if not refund_amount:
-            refund_amount = payment.amount
-
+        refundable = payment.amount - payment.refund_amount
         try:
-            if payment.payment_method == 'card' and payment.stripe_payment_intent_id:
-                # Process Stripe refund
-                refund = stripe.Refund.create(
-                    payment_intent=payment.stripe_payment_intent_id,
-                    amount=int(float(refund_amount) * 100)
-                )
-
-                payment.refund_amount = refund_amount
-                payment.refund_transaction_id = refund.id
-                payment.status = 'refunded' if refund_amount >= payment.amount else 'partially_refunded'
-                payment.save()
-
-            elif payment.payment_method == 'mpesa':
-                # For M-Pesa, you'd implement B2C refund logic here
-                # This is a simplified version
-                payment.refund_amount = refund_amount
-                payment.status = 'refunded' if refund_amount >= payment.amount else 'partially_refunded'
-                payment.save()
-
-            # Update order status if fully refunded
-            if refund_amount >= payment.amount:
-                payment.order.status = 'refunded'
-                payment.order.save()
-
-            return Response({
-                'status': 'success',
-                'message': 'Refund processed successfully',
-                'refund_amount': refund_amount
-            })
-
-        except Exception as e:
-            return Response(
-                {'error': str(e)},
+            refund_amount = Decimal(str(value or refundable))
+        except InvalidOperation:
+            return None, Response({'error': 'Invalid refund amount'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 0 < refund_amount <= refundable:
+            return None, Response(
+                {'error': f'Refund amount must be more than 0 and at most {refundable}'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        return refund_amount, None
+
+class LedgerBalanceView(APIView):
+    """The provider's ledger balance and lifetime charges, refunds and fees"""
+    permission_classes = [IsProvider]
+
+    def get(self, request):
+        return Response(ledger.balance(request.user))
 
 class PaymentHistoryView(generics.ListAPIView):
     serializer_class = PaymentSerializer
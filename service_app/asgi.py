@@ -3,6 +3,13 @@ ASGI config for service_app project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Requests for the live event stream (orders.events.STREAM_PATHS) are served
+by orders.events.stream_application directly, outside Django's request
+handling, so idle streams do not hold a thread each; everything else goes to
+Django. The Dockerfile and docker-compose.yml run it with
+``gunicorn service_app.asgi:application -k uvicorn.workers.UvicornWorker``;
+the WSGI application has no stream.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
@@ -13,4 +20,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'service_app.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up
+from orders.events import STREAM_PATHS, stream_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] in STREAM_PATHS:
+        return await stream_application(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,216 @@
+"""
+Streaming exports.
+
+An export walks a queryset in primary key order with .values_list() and
+.iterator(), so rows come from a server-side cursor and are never held as
+model instances, and writes them as CSV or JSON Lines a chunk at a time.
+Memory stays flat however many rows there are.
+
+Exports are resumable: a cursor token names the last id written, and
+resuming from it continues with the next row. With a limit the response
+carries the token to continue from in the X-Export-Next-Cursor header.
+"""
+import base64
+import binascii
+import csv
+import io
+from datetime import datetime, time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework import permissions, status
+from rest_framework.response import Response
+from rest_framework.views import APIView
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+# Rows fetched per round trip and written per yielded chunk
+CHUNK_SIZE = 2000
+MAX_LIMIT = 1000000
+NEXT_CURSOR_HEADER = 'X-Export-Next-Cursor'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(last_id):
+    return base64.urlsafe_b64encode(f'after:{last_id}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Return the id a cursor token resumes after
+    """
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        prefix, _, last_id = base64.urlsafe_b64decode(padded.encode()).decode().partition(':')
+        if prefix != 'after':
+            raise ValueError(cursor)
+        return int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor("Invalid export cursor")
+
+
+def _parse_moment(value, name):
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f"{name} must be a date or an ISO 8601 date and time")
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def options(params):
+    """
+    Parse ?output=csv|jsonl, ?cursor=, ?limit= and ?since= / ?until=
+    (created_at bounds) from query parameters. Raises ValueError.
+    """
+    output = params.get('output', 'csv')
+    if output not in FORMATS:
+        raise ValueError(f"output must be one of {', '.join(FORMATS)}")
+    limit = params.get('limit')
+    if limit:
+        limit = int(limit)
+        if not 1 <= limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return {
+        'output': output,
+        'cursor': params.get('cursor') or None,
+        'limit': limit or None,
+        'since': _parse_moment(params['since'], 'since') if params.get('since') else None,
+        'until': _parse_moment(params['until'], 'until') if params.get('until') else None,
+    }
+
+
+def filter_created(queryset, since=None, until=None, field='created_at'):
+    if since:
+        queryset = queryset.filter(**{f'{field}__gte': since})
+    if until:
+        queryset = queryset.filter(**{f'{field}__lt': until})
+    return queryset
+
+
+def resume(queryset, cursor=None, limit=None):
+    """
+    Order queryset for export and apply a cursor token and row limit.
+    Returns (queryset, next_cursor); next_cursor is None when the limited
+    queryset reaches the end.
+    """
+    queryset = queryset.order_by('pk')
+    if cursor:
+        queryset = queryset.filter(pk__gt=decode_cursor(cursor))
+    if not limit:
+        return queryset, None
+    # An id-only query finds the last row of this part and whether more follow
+    boundary = list(queryset.values_list('pk', flat=True)[limit - 1:limit + 1])
+    if len(boundary) < 2:
+        return queryset[:limit], None
+    return queryset[:limit], encode_cursor(boundary[0])
+
+
+def rows(queryset, fields, chunk_size=CHUNK_SIZE):
+    """
+    Yield one tuple per row, fetched through a server-side cursor
+    """
+    return queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def stream(queryset, fields, output='csv', header=None, chunk_size=CHUNK_SIZE, write_header=True,
+           on_chunk=None):
+    """
+    Yield the export of queryset as encoded chunks of CSV or JSON Lines.
+    fields are values_list() lookups, the first being the id; header names
+    the columns (default: the lookups). on_chunk(last_id, rows) is called
+    once each chunk has been consumed.
+    """
+    header = list(header or fields)
+    buffer = io.StringIO()
+    if output == 'csv':
+        writer = csv.writer(buffer)
+        if write_header:
+            writer.writerow(header)
+
+        def write(row):
+            writer.writerow([_format_value(value) for value in row])
+    elif output == 'jsonl':
+        encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+        def write(row):
+            buffer.write(encoder.encode(dict(zip(header, row))))
+            buffer.write('\n')
+    else:
+        raise ValueError(f"Unknown export format {output}")
+
+    pending = 0
+    row = None
+    for row in rows(queryset, fields, chunk_size):
+        write(row)
+        pending += 1
+        if pending >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            if on_chunk:
+                on_chunk(row[0], pending)
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+        if on_chunk and pending:
+            on_chunk(row[0], pending)
+
+
+def export_response(queryset, fields, output, filename, header=None, next_cursor=None):
+    response = StreamingHttpResponse(stream(queryset, fields, output, header), content_type=FORMATS[output])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{output}"'
+    if next_cursor:
+        response[NEXT_CURSOR_HEADER] = next_cursor
+    return response
+
+
+class ExportView(APIView):
+    """
+    Stream get_queryset() with the given columns, a sequence of (column,
+    values_list lookup) pairs
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    columns = ()
+    filename = 'export'
+
+    def get_queryset(self):
+        raise NotImplementedError
+
+    def perform_content_negotiation(self, request, force=False):
+        # Clients may ask for text/csv; errors are still rendered as JSON
+        return super().perform_content_negotiation(request, force=True)
+
+    def get(self, request):
+        try:
+            params = options(request.query_params)
+            queryset = filter_created(self.get_queryset(), params['since'], params['until'])
+            queryset, next_cursor = resume(queryset, params['cursor'], params['limit'])
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return export_response(
+            queryset,
+            [lookup for _, lookup in self.columns],
+            params['output'],
+            self.filename,
+            header=[column for column, _ in self.columns],
+            next_cursor=next_cursor,
+        )
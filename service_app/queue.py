@@ -0,0 +1,22 @@
+import logging
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(task, *args, **kwargs):
+    """
+    Send a Celery task once the current transaction commits. If the broker
+    is unreachable the task runs inline so the work is not lost; sending is
+    not retried, so that happens within CELERY_BROKER_CONNECTION_TIMEOUT
+    rather than after Celery's retry cycle.
+    """
+    def send():
+        try:
+            task.apply_async(args=args, kwargs=kwargs, retry=False)
+        except Exception:
+            logger.warning("Could not queue %s, running it inline", task.name, exc_info=True)
+            task.apply(args=args, kwargs=kwargs)
+
+    transaction.on_commit(send)
@@ -1,8 +1,11 @@
 import environ
 import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 
+from celery.schedules import crontab
+
 # Base directory of the project
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -77,6 +80,13 @@ WSGI_APPLICATION = "service_app.wsgi.application"
 
 # Database configuration (from .env)
 DATABASES = {"default": env.db("DATABASE_URL", default="sqlite:///db.sqlite3")}
+if DATABASES["default"]["ENGINE"] == "django.db.backends.sqlite3":
+    # SQLite ignores SELECT ... FOR UPDATE; taking the write lock at BEGIN
+    # serializes check-then-write transactions such as bookings instead
+    DATABASES["default"].setdefault("OPTIONS", {}).update({"transaction_mode": "IMMEDIATE", "timeout": 20})
+    # A file, unlike the default in-memory test database, is shared between
+    # connections, so tests can run bookings from several threads
+    DATABASES["default"].setdefault("TEST", {}).setdefault("NAME", str(BASE_DIR / "test_db.sqlite3"))
 
 # Password validators (default best practices)
 AUTH_PASSWORD_VALIDATORS = [
@@ -183,12 +193,28 @@ EMAIL_HOST_USER = env("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = env("EMAIL_HOST_PASSWORD")
 DEFAULT_FROM_EMAIL = env("DEFAULT_FROM_EMAIL")
 
-# Cache config - using local memory cache for development
-CACHES = {
-    "default": {
-        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+# Cache config. The catalogue's response generations (services.cache), the
+# unread notification counters (orders.counters) and the M-Pesa access token
+# and its refresh lock (payments.services) must be seen by every web and
+# Celery worker, so outside DEBUG a shared Redis cache is required; the local
+# memory cache only suits a single development process.
+CACHE_REDIS_URL = env("CACHE_REDIS_URL", default="" if DEBUG else environ.Env.NOTSET)
+if CACHE_REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_REDIS_URL,
+        }
     }
-}
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        }
+    }
+
+# Memory-mapped autocomplete snapshot shared by all workers on a host
+SUGGESTION_INDEX_PATH = env("SUGGESTION_INDEX_PATH", default=str(BASE_DIR / "var" / "suggestions.idx"))
 
 # Basic logging setup
 LOGGING = {
@@ -222,6 +248,13 @@ if not DEBUG:
 STRIPE_PUBLIC_KEY = env("STRIPE_PUBLIC_KEY")
 STRIPE_SECRET_KEY = env("STRIPE_SECRET_KEY")
 STRIPE_WEBHOOK_SECRET = env("STRIPE_WEBHOOK_SECRET")
+STRIPE_API_BASE = env("STRIPE_API_BASE", default="https://api.stripe.com")
+# Share of each payment the platform keeps, posted as a ledger fee
+PLATFORM_FEE_RATE = env.float("PLATFORM_FEE_RATE", default=0.0)
+
+# Call payment providers from a Celery worker instead of the request
+# (see payments.initiation)
+PAYMENT_INITIATION_ASYNC = env.bool("PAYMENT_INITIATION_ASYNC", default=True)
 
 # M-Pesa Integration (Safaricom B2C/B2B)
 MPESA_ENVIRONMENT = env("MPESA_ENVIRONMENT", default="sandbox")
@@ -233,6 +266,10 @@ MPESA_SHORTCODE_TYPE = env("MPESA_SHORTCODE_TYPE", default="paybill")
 MPESA_PASSKEY = env("MPESA_PASSKEY")
 MPESA_INITIATOR_USERNAME = env("MPESA_INITIATOR_USERNAME")
 MPESA_INITIATOR_SECURITY_CREDENTIAL = env("MPESA_INITIATOR_SECURITY_CREDENTIAL")
+MPESA_API_URL = env(
+    "MPESA_API_URL",
+    default="https://api.safaricom.co.ke" if MPESA_ENVIRONMENT == "production" else "https://sandbox.safaricom.co.ke",
+)
 
 # Production-only security settings
 if not DEBUG:
@@ -240,10 +277,52 @@ if not DEBUG:
     SESSION_COOKIE_SECURE = env.bool("SESSION_COOKIE_SECURE", default=True)
     CSRF_COOKIE_SECURE = env.bool("CSRF_COOKIE_SECURE", default=True)
 
+# Pub/sub for the live event stream (orders.events). Events are published by
+# every web and Celery worker, so it defaults to the shared cache's Redis;
+# empty keeps events in process, which only works with a single process
+EVENT_STREAM_REDIS_URL = env("EVENT_STREAM_REDIS_URL", default=CACHE_REDIS_URL)
+
 # Celery configuration for async task queues
 CELERY_BROKER_URL = env("CELERY_BROKER_URL")
 CELERY_RESULT_BACKEND = env("CELERY_RESULT_BACKEND")
+# Tasks are sent from web requests (service_app.queue), which fall back to
+# running them inline, so an unreachable broker has to fail fast
+CELERY_BROKER_CONNECTION_TIMEOUT = env.float("CELERY_BROKER_CONNECTION_TIMEOUT", default=1.0)
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    # Connecting to send is not retried
+    "max_retries": 0,
+    "socket_connect_timeout": CELERY_BROKER_CONNECTION_TIMEOUT,
+}
 CELERY_ACCEPT_CONTENT = ["json"]
 CELERY_TASK_SERIALIZER = "json"
 CELERY_RESULT_SERIALIZER = "json"
 CELERY_TIMEZONE = TIME_ZONE
+# Test runs apply queued tasks in process, so they do not depend on a broker
+TESTING = sys.argv[1:2] == ["test"] or "pytest" in sys.modules
+CELERY_TASK_ALWAYS_EAGER = env.bool("CELERY_TASK_ALWAYS_EAGER", default=TESTING)
+CELERY_BEAT_SCHEDULE = {
+    "extend-availability-horizon": {
+        "task": "services.tasks.extend_availability_horizon",
+        "schedule": crontab(hour=0, minute=5),
+    },
+    "rebuild-suggestion-index": {
+        "task": "services.tasks.rebuild_suggestion_index",
+        "schedule": crontab(hour=3, minute=0),
+    },
+    "rebuild-recommendations": {
+        "task": "services.tasks.rebuild_recommendations",
+        "schedule": crontab(hour=2, minute=30),
+    },
+    "send-reminder-notifications": {
+        "task": "orders.tasks.send_reminder_notifications",
+        "schedule": crontab(hour=18, minute=0),
+    },
+    "reconcile-payments": {
+        "task": "payments.tasks.reconcile_payments",
+        "schedule": crontab(minute="*/15"),
+    },
+    "snapshot-ledger-balances": {
+        "task": "payments.tasks.snapshot_ledger_balances",
+        "schedule": crontab(minute=0),
+    },
+}
@@ -0,0 +1,290 @@
+"""
+Availability engine.
+
+Each provider's free time on a day is stored as a bitmap of SLOT_MINUTES
+slots in ProviderAvailability: the slots covered by their ProviderSchedule
+rows for that day (a date_override replaces the weekly rows for its date)
+minus the slots overlapped by blocking orders. Rows are kept for
+HORIZON_DAYS from today and recomputed incrementally when a schedule or an
+order changes, so "which services are free in this window" is an indexed
+bitwise filter instead of a loop over providers.
+"""
+import datetime
+import math
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+SLOT_MINUTES = 30
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+HORIZON_DAYS = 60
+# Orders in these states hold their time slot
+BLOCKING_STATUSES = ('pending', 'confirmed', 'in_progress')
+# How far before a day an order may start and still run into it
+MAX_BOOKING_SPAN = datetime.timedelta(days=7)
+
+WINDOWS = ('today', 'tomorrow', 'weekend', 'week')
+
+
+def slot_mask(start_minute, end_minute):
+    """
+    Bits of the slots lying entirely within [start_minute, end_minute)
+    """
+    first = -(-max(start_minute, 0) // SLOT_MINUTES)
+    last = min(end_minute, 24 * 60) // SLOT_MINUTES
+    if last <= first:
+        return 0
+    return ((1 << last) - 1) ^ ((1 << first) - 1)
+
+
+def covering_mask(start_minute, end_minute):
+    """
+    Bits of every slot overlapping [start_minute, end_minute)
+    """
+    first = max(start_minute, 0) // SLOT_MINUTES
+    last = -(-min(end_minute, 24 * 60) // SLOT_MINUTES)
+    if last <= first:
+        return 0
+    return ((1 << last) - 1) ^ ((1 << first) - 1)
+
+
+def _minutes(value):
+    return value.hour * 60 + value.minute
+
+
+def _schedule_mask(schedule):
+    end = _minutes(schedule.end_time)
+    # An end time at or before the start runs to midnight
+    if end <= _minutes(schedule.start_time):
+        end = 24 * 60
+    return slot_mask(_minutes(schedule.start_time), end)
+
+
+def _day_bounds(day):
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+def horizon(today=None):
+    today = today or timezone.localdate()
+    return [today + datetime.timedelta(days=offset) for offset in range(HORIZON_DAYS)]
+
+
+def compute_bitmaps(provider_id, days):
+    """
+    Return {day: free slot bitmap} for one provider
+    """
+    from orders.models import Order
+    from .models import ProviderSchedule
+
+    days = sorted(set(days))
+    if not days:
+        return {}
+
+    weekly = defaultdict(int)
+    overrides = {}
+    for schedule in ProviderSchedule.objects.filter(provider_id=provider_id).filter(
+            Q(date_override__isnull=True) | Q(date_override__in=days)):
+        mask = _schedule_mask(schedule) if schedule.is_available else 0
+        if schedule.date_override is None:
+            if schedule.is_available:
+                weekly[schedule.day_of_week] |= mask
+        else:
+            overrides[schedule.date_override] = overrides.get(schedule.date_override, 0) | mask
+
+    bitmaps = {
+        day: overrides[day] if day in overrides else weekly.get(day.weekday(), 0)
+        for day in days
+    }
+
+    window_start, _ = _day_bounds(days[0])
+    _, window_end = _day_bounds(days[-1])
+    orders = Order.objects.filter(
+        provider_id=provider_id,
+        status__in=BLOCKING_STATUSES,
+        scheduled_date__gte=window_start - MAX_BOOKING_SPAN,
+        scheduled_date__lt=window_end,
+    ).values_list('scheduled_date', 'duration_hours')
+    for scheduled, duration_hours in orders:
+        for day, busy in booked_masks(scheduled, duration_hours).items():
+            if day in bitmaps:
+                bitmaps[day] &= ~busy
+    return bitmaps
+
+
+def booked_masks(scheduled, duration_hours):
+    """
+    Return {day: bitmap} of the slots an order occupies
+    """
+    start = timezone.localtime(scheduled)
+    end = start + datetime.timedelta(hours=max(duration_hours, 1))
+    masks = {}
+    day = start.date()
+    while True:
+        day_start, _ = _day_bounds(day)
+        if day_start >= end:
+            break
+        mask = covering_mask(
+            math.floor((start - day_start).total_seconds() / 60),
+            math.ceil((end - day_start).total_seconds() / 60)
+        )
+        if mask:
+            masks[day] = mask
+        day += datetime.timedelta(days=1)
+    return masks
+
+
+def store_bitmaps(provider_id, bitmaps):
+    from .models import ProviderAvailability
+
+    if not bitmaps:
+        return 0
+    ProviderAvailability.objects.bulk_create(
+        [ProviderAvailability(provider_id=provider_id, date=day, free_slots=mask) for day, mask in bitmaps.items()],
+        update_conflicts=True,
+        unique_fields=['provider', 'date'],
+        update_fields=['free_slots', 'updated_at'],
+    )
+    return len(bitmaps)
+
+
+def refresh_provider(provider_id, days=None):
+    """
+    Recompute the stored bitmaps of a provider for the given days (default:
+    the whole horizon). Providers without any schedule have no rows.
+    """
+    from .models import ProviderAvailability, ProviderSchedule
+
+    window = set(horizon())
+    days = window if days is None else window & set(days)
+    with transaction.atomic():
+        if not ProviderSchedule.objects.filter(provider_id=provider_id).exists():
+            ProviderAvailability.objects.filter(provider_id=provider_id).delete()
+            return 0
+        return store_bitmaps(provider_id, compute_bitmaps(provider_id, days))
+
+
+def refresh_order(order):
+    """
+    Recompute the days an order occupies now and occupied when loaded
+    """
+    previous = getattr(order, '_loaded_values', {})
+    affected = defaultdict(set)
+    for provider_id, scheduled, duration_hours in (
+            (previous.get('provider_id'), previous.get('scheduled_date'), previous.get('duration_hours')),
+            (order.provider_id, order.scheduled_date, order.duration_hours)):
+        if provider_id and scheduled:
+            affected[provider_id].update(booked_masks(scheduled, duration_hours or 1))
+    for provider_id, days in affected.items():
+        refresh_provider(provider_id, days)
+
+
+def rebuild(today=None):
+    """
+    Recompute the horizon for every scheduled provider and drop past rows
+    """
+    from .models import ProviderAvailability, ProviderSchedule
+
+    today = today or timezone.localdate()
+    days = horizon(today)
+    count = 0
+    for provider_id in ProviderSchedule.objects.values_list('provider_id', flat=True).distinct().order_by():
+        with transaction.atomic():
+            count += store_bitmaps(provider_id, compute_bitmaps(provider_id, days))
+    ProviderAvailability.objects.filter(date__lt=today).delete()
+    ProviderAvailability.objects.exclude(
+        provider_id__in=ProviderSchedule.objects.values('provider_id')).delete()
+    return count
+
+
+def extend_horizon(today=None):
+    """
+    Daily roll-forward: compute the day entering the horizon and drop the
+    days that left it
+    """
+    from .models import ProviderAvailability, ProviderSchedule
+
+    today = today or timezone.localdate()
+    new_day = horizon(today)[-1]
+    count = 0
+    for provider_id in ProviderSchedule.objects.values_list('provider_id', flat=True).distinct().order_by():
+        count += store_bitmaps(provider_id, compute_bitmaps(provider_id, [new_day]))
+    ProviderAvailability.objects.filter(date__lt=today).delete()
+    return count
+
+
+def resolve_window(availability=None, date=None, time_from=None, time_to=None, now=None):
+    """
+    Turn search parameters into {day: slot mask}. availability is one of
+    WINDOWS; date (YYYY-MM-DD) picks a single day instead; time_from and
+    time_to (HH:MM) narrow the hours. Slots already started today are
+    excluded. Raises ValueError for invalid input.
+    """
+    now = timezone.localtime(now)
+    today = now.date()
+
+    if date:
+        days = [datetime.date.fromisoformat(date)]
+    elif availability == 'today':
+        days = [today]
+    elif availability == 'tomorrow':
+        days = [today + datetime.timedelta(days=1)]
+    elif availability == 'weekend':
+        # The coming (or current) Saturday and Sunday
+        days = [today + datetime.timedelta(days=offset) for offset in range(7)]
+        days = [day for day in days if day.weekday() >= 5][:2]
+    elif availability == 'week':
+        days = [today + datetime.timedelta(days=offset) for offset in range(7)]
+    else:
+        raise ValueError(f"availability must be one of {', '.join(WINDOWS)}")
+
+    start = _minutes(datetime.time.fromisoformat(time_from)) if time_from else 0
+    end = _minutes(datetime.time.fromisoformat(time_to)) if time_to else 24 * 60
+    mask = slot_mask(start, end)
+
+    window = {}
+    for day in days:
+        if day < today:
+            continue
+        day_mask = mask
+        if day == today:
+            elapsed = _minutes(now.time()) + (1 if now.second or now.microsecond else 0)
+            day_mask &= slot_mask(elapsed, 24 * 60)
+        if day_mask:
+            window[day] = day_mask
+    return window
+
+
+def filter_available(services, window):
+    """
+    Restrict a Service queryset to services whose provider has a free slot
+    in window ({day: slot mask}, see resolve_window). Providers without a
+    schedule fall back to the service's availability_type.
+    """
+    from .models import ProviderAvailability, ProviderSchedule
+
+    if not window:
+        return services.none()
+
+    by_mask = defaultdict(list)
+    for day, mask in window.items():
+        by_mask[mask].append(day)
+
+    free = ProviderAvailability.objects.all()
+    condition = Q()
+    for position, (mask, days) in enumerate(by_mask.items()):
+        alias = f'free_{position}'
+        free = free.annotate(**{alias: F('free_slots').bitand(mask)})
+        condition |= Q(date__in=days, **{f'{alias}__gt': 0})
+    free = free.filter(condition).values('provider_id')
+
+    types = ['ALWAYS']
+    if any(day.weekday() < 5 for day in window):
+        types.append('WEEKDAY')
+    if any(day.weekday() >= 5 for day in window):
+        types.append('WEEKEND')
+    unscheduled = ~Exists(ProviderSchedule.objects.filter(provider=OuterRef('provider')))
+
+    return services.filter(Q(provider_id__in=free) | (unscheduled & Q(availability_type__in=types)))
@@ -0,0 +1,220 @@
+"""
+Response cache for the public service catalogue.
+
+Anonymous GET responses are stored under a key made of the view name, the
+current generation of every table the view reads and the normalized query
+string. Saving or deleting a row bumps its table's generation, so every
+response built from the old data stops being addressable at once; the old
+entries simply expire. Invalidation is a single cache.incr and prices are
+never served stale, provided every process shares the cache: generations
+kept in a per-process cache would leave other workers serving old prices
+until their entries expire.
+"""
+import functools
+import hashlib
+import time
+
+from django.core.cache import caches
+from django.http import HttpResponse
+from rest_framework.response import Response
+
+CACHE_ALIAS = 'default'
+KEY_PREFIX = 'catalogue'
+# Entries outlive their generation only until they expire
+RESPONSE_TIMEOUT = 60 * 10
+
+SERVICES = 'services'
+CATEGORIES = 'categories'
+REVIEWS = 'reviews'
+TABLES = (SERVICES, CATEGORIES, REVIEWS)
+
+HITS = 'hits'
+MISSES = 'misses'
+
+
+def _cache():
+    return caches[CACHE_ALIAS]
+
+
+def _generation_key(table):
+    return f'{KEY_PREFIX}:gen:{table}'
+
+
+def _stat_key(name):
+    return f'{KEY_PREFIX}:stats:{name}'
+
+
+def _initial_generation():
+    # Seeded from the clock so that a generation lost to eviction or a
+    # cache restart never comes back with a value that was used before
+    return int(time.time() * 1000)
+
+
+def get_generations(tables):
+    cache = _cache()
+    keys = [_generation_key(table) for table in tables]
+    found = cache.get_many(keys)
+    missing = {key: _initial_generation() for key in keys if key not in found}
+    if missing:
+        for key, value in missing.items():
+            # add() keeps whatever another process may have set meanwhile
+            cache.add(key, value, None)
+        found.update(cache.get_many(list(missing)))
+    return [found.get(key, 0) for key in keys]
+
+
+def bump_generation(table):
+    """
+    Invalidate every cached response that read table
+    """
+    cache = _cache()
+    key = _generation_key(table)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_generation(), None)
+
+
+def _count(name):
+    cache = _cache()
+    key = _stat_key(name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def get_stats():
+    """
+    Return hit/miss counters and the hit ratio since the counters were reset
+    """
+    values = _cache().get_many([_stat_key(HITS), _stat_key(MISSES)])
+    hits = values.get(_stat_key(HITS), 0)
+    misses = values.get(_stat_key(MISSES), 0)
+    total = hits + misses
+    return {
+        HITS: hits,
+        MISSES: misses,
+        'hit_ratio': hits / total if total else 0.0,
+    }
+
+
+def reset_stats():
+    _cache().delete_many([_stat_key(HITS), _stat_key(MISSES)])
+
+
+def normalize_params(query_dict):
+    """
+    Canonical form of a query string: empty values dropped, keys and
+    repeated values sorted, so equivalent URLs share one entry
+    """
+    items = []
+    for key, values in sorted(query_dict.lists()):
+        values = sorted(value for value in values if value != '')
+        if values:
+            items.append((key, values))
+    return items
+
+
+def response_key(view_name, tables, request):
+    generations = '.'.join(str(generation) for generation in get_generations(tables))
+    # Accept picks the renderer (JSON or browsable API) on DRF views
+    params = repr((normalize_params(request.GET), request.META.get('HTTP_ACCEPT', ''))).encode()
+    digest = hashlib.md5(params, usedforsecurity=False).hexdigest()
+    return f'{KEY_PREFIX}:response:{view_name}:{generations}:{digest}'
+
+
+def _is_cacheable_request(request):
+    if request.method not in ('GET', 'HEAD'):
+        return False
+    # Token-authenticated API clients are anonymous to Django's middleware
+    if 'HTTP_AUTHORIZATION' in request.META:
+        return False
+    # Set by DRF's force_authenticate
+    if getattr(request, '_force_auth_user', None) is not None:
+        return False
+    user = getattr(request, 'user', None)
+    return user is None or not user.is_authenticated
+
+
+def _stored_headers(response):
+    # Content-Type is set by whoever renders the replayed response
+    return [(name, value) for name, value in response.items() if name.lower() != 'content-type']
+
+
+def _cached_view(view, view_name, tables, timeout):
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not _is_cacheable_request(request):
+            return view(request, *args, **kwargs)
+
+        cache = _cache()
+        key = response_key(view_name, tables, request)
+        cached = cache.get(key)
+        if cached is not None:
+            _count(HITS)
+            content, content_type, status, headers = cached
+            response = HttpResponse(content, content_type=content_type, status=status)
+            for name, value in headers:
+                response[name] = value
+            response['X-Cache'] = 'HIT'
+            return response
+
+        _count(MISSES)
+        response = view(request, *args, **kwargs)
+        if hasattr(response, 'render') and not response.is_rendered:
+            response.render()
+        if response.status_code == 200 and not response.cookies and not response.streaming:
+            cache.set(
+                key,
+                (response.content, response['Content-Type'], response.status_code, _stored_headers(response)),
+                timeout,
+            )
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def _cached_handler(handler, view_name, tables, timeout):
+    @functools.wraps(handler)
+    def wrapper(self, request, *args, **kwargs):
+        # Authentication, permissions and throttles have run by now
+        if not _is_cacheable_request(request):
+            return handler(self, request, *args, **kwargs)
+
+        cache = _cache()
+        key = response_key(view_name, tables, request)
+        cached = cache.get(key)
+        if cached is not None:
+            _count(HITS)
+            data, status, headers = cached
+            response = Response(data, status=status, headers=dict(headers))
+            response['X-Cache'] = 'HIT'
+            return response
+
+        _count(MISSES)
+        response = handler(self, request, *args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200 and not response.cookies:
+            cache.set(key, (response.data, response.status_code, _stored_headers(response)), timeout)
+        response['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def cache_catalogue_response(view_name, tables, timeout=RESPONSE_TIMEOUT):
+    """
+    Decorator for view functions, or APIView classes, whose anonymous output
+    depends only on the query string and the given tables. view_name
+    namespaces the entries and must be unique per view.
+
+    On an APIView the GET handler is wrapped, so throttles run before the
+    lookup and hits go through finalize_response and the renderer like any
+    other response (Vary, Allow, content negotiation).
+    """
+    def decorator(view):
+        if isinstance(view, type):
+            view.get = _cached_handler(view.get, view_name, tables, timeout)
+            return view
+        return _cached_view(view, view_name, tables, timeout)
+    return decorator
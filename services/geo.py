@@ -0,0 +1,162 @@
+import heapq
+import math
+
+from django.db.models import Q
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE_LAT = 110.574
+KM_PER_DEGREE_LNG = 111.320
+
+GEOHASH_PRECISION = 9
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def encode_geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """
+    Encode a coordinate pair as a geohash string of the given precision
+    """
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(geohash) < precision:
+        rng, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(geohash)
+
+
+def geohash_cell_size(precision):
+    """
+    Return the (lat, lng) size in degrees of a geohash cell
+    """
+    total_bits = precision * 5
+    lat_bits = total_bits // 2
+    lng_bits = total_bits - lat_bits
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lng_bits)
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distance between two points in kilometres
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    dlat = lat2 - lat1
+    dlng = lng2 - lng1
+    a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Return (min_lat, max_lat, lng_ranges) enclosing a circle of radius_km.
+
+    lng_ranges holds one or two (min, max) pairs because the box is split in
+    two when it crosses the antimeridian.
+    """
+    dlat = radius_km / KM_PER_DEGREE_LAT
+    min_lat = max(-90.0, latitude - dlat)
+    max_lat = min(90.0, latitude + dlat)
+
+    # Near the poles every longitude is within reach
+    cos_lat = math.cos(math.radians(latitude))
+    if max_lat >= 90.0 or min_lat <= -90.0 or cos_lat <= 1e-9:
+        return min_lat, max_lat, [(-180.0, 180.0)]
+
+    dlng = radius_km / (KM_PER_DEGREE_LNG * cos_lat)
+    if dlng >= 180.0:
+        return min_lat, max_lat, [(-180.0, 180.0)]
+
+    min_lng = longitude - dlng
+    max_lng = longitude + dlng
+    if min_lng < -180.0:
+        return min_lat, max_lat, [(min_lng + 360.0, 180.0), (-180.0, max_lng)]
+    if max_lng > 180.0:
+        return min_lat, max_lat, [(min_lng, 180.0), (-180.0, max_lng - 360.0)]
+    return min_lat, max_lat, [(min_lng, max_lng)]
+
+
+def covering_geohashes(latitude, longitude, radius_km):
+    """
+    Return the geohash prefixes of the cell containing the point and its
+    eight neighbours, at the finest precision whose cells are still at least
+    radius_km across. Returns an empty list when the radius is too large for
+    a geohash prefilter to be useful.
+    """
+    cos_lat = max(math.cos(math.radians(latitude)), 1e-9)
+    precision = 0
+    for candidate in range(1, GEOHASH_PRECISION + 1):
+        lat_size, lng_size = geohash_cell_size(candidate)
+        if lat_size * KM_PER_DEGREE_LAT < radius_km or lng_size * KM_PER_DEGREE_LNG * cos_lat < radius_km:
+            break
+        precision = candidate
+    if precision == 0:
+        return []
+
+    lat_size, lng_size = geohash_cell_size(precision)
+    cells = set()
+    for dlat in (-lat_size, 0, lat_size):
+        lat = latitude + dlat
+        if lat < -90.0 or lat > 90.0:
+            continue
+        for dlng in (-lng_size, 0, lng_size):
+            lng = (longitude + dlng + 180.0) % 360.0 - 180.0
+            cells.add(encode_geohash(lat, lng, precision))
+    return sorted(cells)
+
+
+def proximity_filter(latitude, longitude, radius_km):
+    """
+    Build an index-friendly Q object that prefilters services to the
+    geohash cells and bounding box around a point
+    """
+    min_lat, max_lat, lng_ranges = bounding_box(latitude, longitude, radius_km)
+    lng_q = Q()
+    for min_lng, max_lng in lng_ranges:
+        lng_q |= Q(longitude__gte=min_lng, longitude__lte=max_lng)
+    query = Q(latitude__gte=min_lat, latitude__lte=max_lat) & lng_q
+
+    cells = covering_geohashes(latitude, longitude, radius_km)
+    if cells:
+        cell_q = Q()
+        for cell in cells:
+            cell_q |= Q(geohash__startswith=cell)
+        query &= cell_q
+    return query
+
+
+def nearest(queryset, latitude, longitude, radius_km, limit):
+    """
+    Return [(service_id, distance_km)] for the closest services in the
+    queryset within radius_km, sorted by distance.
+
+    Only the id and coordinates of the prefiltered candidates are fetched;
+    exact haversine ranking happens in Python on that small set.
+    """
+    candidates = queryset.filter(
+        proximity_filter(latitude, longitude, radius_km)
+    ).values_list('id', 'latitude', 'longitude')
+
+    within = []
+    for service_id, lat, lng in candidates.iterator(chunk_size=2000):
+        distance = haversine_km(latitude, longitude, float(lat), float(lng))
+        if distance <= radius_km:
+            within.append((distance, service_id))
+
+    return [(service_id, distance) for distance, service_id in heapq.nsmallest(limit, within)]
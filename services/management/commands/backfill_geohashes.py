@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from services.geo import encode_geohash
+from services.models import Service
+
+
+class Command(BaseCommand):
+    help = "Populate Service.geohash for services saved before the geohash column existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        services = Service.objects.filter(
+            latitude__isnull=False, longitude__isnull=False
+        ).only('id', 'latitude', 'longitude', 'geohash').order_by('id')
+
+        batch = []
+        updated = 0
+        for service in services.iterator(chunk_size=batch_size):
+            geohash = encode_geohash(service.latitude, service.longitude)
+            if service.geohash != geohash:
+                service.geohash = geohash
+                batch.append(service)
+            if len(batch) >= batch_size:
+                updated += len(batch)
+                Service.objects.bulk_update(batch, ['geohash'])
+                batch = []
+        if batch:
+            updated += len(batch)
+            Service.objects.bulk_update(batch, ['geohash'])
+
+        self.stdout.write(self.style.SUCCESS(f"Updated geohash on {updated} services"))
@@ -0,0 +1,90 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from services.geo import encode_geohash, nearest
+from services.models import Category, Service
+
+User = get_user_model()
+
+# Roughly the extent of Kenya, so density resembles a national catalogue
+LAT_RANGE = (-4.7, 4.6)
+LNG_RANGE = (33.9, 41.9)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure NearbyServicesView lookup latency against synthetic catalogues. "
+        "All rows are created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--radius', type=float, default=10.0)
+        parser.add_argument('--limit', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        sizes = sorted(options['sizes'])
+
+        with transaction.atomic():
+            provider = User.objects.create_user(username='bench-nearby-provider', password=None)
+            category = Category.objects.create(name='HOME', description='Benchmark')
+
+            created = 0
+            for size in sizes:
+                self._populate(provider, category, rng, size - created)
+                created = size
+                self._measure(size, rng, options)
+
+            transaction.set_rollback(True)
+
+    def _populate(self, provider, category, rng, count, batch_size=5000):
+        while count > 0:
+            batch = []
+            for _ in range(min(batch_size, count)):
+                lat = Decimal(f"{rng.uniform(*LAT_RANGE):.6f}")
+                lng = Decimal(f"{rng.uniform(*LNG_RANGE):.6f}")
+                batch.append(Service(
+                    provider=provider,
+                    category=category,
+                    name='Benchmark service',
+                    description='',
+                    price=Decimal('10.00'),
+                    base_price=Decimal('10.00'),
+                    image='services/benchmark.jpg',
+                    location='Benchmark',
+                    latitude=lat,
+                    longitude=lng,
+                    geohash=encode_geohash(lat, lng),
+                ))
+            # bulk_create skips save(), so the geohash is set explicitly above
+            Service.objects.bulk_create(batch)
+            count -= len(batch)
+
+    def _measure(self, size, rng, options):
+        queryset = Service.objects.filter(is_available=True)
+        timings = []
+        found = 0
+        for _ in range(options['queries']):
+            lat = rng.uniform(*LAT_RANGE)
+            lng = rng.uniform(*LNG_RANGE)
+            start = time.perf_counter()
+            results = nearest(queryset, lat, lng, options['radius'], options['limit'])
+            timings.append((time.perf_counter() - start) * 1000)
+            found += len(results)
+
+        timings.sort()
+        p95 = timings[int(len(timings) * 0.95) - 1]
+        p99 = timings[int(len(timings) * 0.99) - 1]
+        self.stdout.write(
+            f"{size:>9} services  p50={statistics.median(timings):.2f}ms  "
+            f"p95={p95:.2f}ms  p99={p99:.2f}ms  avg_results={found / len(timings):.1f}"
+        )
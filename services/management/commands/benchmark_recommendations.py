@@ -0,0 +1,97 @@
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from orders.models import Order
+from services.models import Category, Service
+from services.recommendations import rebuild_neighbors
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the recommendation rebuild against synthetic order histories. "
+        "All rows are created inside a transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--orders', type=int, default=1000000)
+        parser.add_argument('--clients', type=int, default=100000)
+        parser.add_argument('--services', type=int, default=10000)
+        # Clients mostly order within one cluster of related services
+        parser.add_argument('--clusters', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            self._populate(rng, options)
+            self.stdout.write(f"Created {options['orders']} orders in {time.perf_counter() - started:.1f}s")
+
+            started = time.perf_counter()
+            result = rebuild_neighbors()
+            total = time.perf_counter() - started
+            timings = result['timings']
+            self.stdout.write(
+                f"{options['orders']:>9} orders  rebuild={total:.1f}s  load={timings['load']:.1f}s  "
+                f"compute={timings['compute']:.1f}s  store={timings['store']:.1f}s  "
+                f"interactions={result['interactions']}  neighbours={result['neighbors']}"
+            )
+
+            transaction.set_rollback(True)
+
+    def _populate(self, rng, options, batch_size=10000):
+        provider = User.objects.create_user(username='bench-recs-provider', password=None)
+        category = Category.objects.create(name='HOME', description='Benchmark')
+
+        services = Service.objects.bulk_create([
+            Service(
+                provider=provider,
+                category=category,
+                name=f'Benchmark service {i}',
+                description='',
+                price=Decimal('10.00'),
+                base_price=Decimal('10.00'),
+                image='services/benchmark.jpg',
+                location='Benchmark',
+            )
+            for i in range(options['services'])
+        ], batch_size=batch_size)
+        service_ids = np.array([service.pk for service in services])
+
+        clients = User.objects.bulk_create([
+            User(username=f'bench-recs-client-{i}', password='!')
+            for i in range(options['clients'])
+        ], batch_size=batch_size)
+        client_ids = np.array([client.pk for client in clients])
+
+        # Zipf-like popularity inside each cluster, one home cluster per client
+        clusters = options['clusters']
+        home = rng.integers(0, clusters, len(client_ids))
+        per_cluster = len(service_ids) // clusters
+
+        remaining = options['orders']
+        while remaining > 0:
+            count = min(batch_size, remaining)
+            clients_index = rng.integers(0, len(client_ids), count)
+            cluster = np.where(rng.random(count) < 0.8, home[clients_index], rng.integers(0, clusters, count))
+            rank = np.minimum(rng.zipf(1.3, count) - 1, per_cluster - 1)
+            services_index = cluster * per_cluster + rank
+            Order.objects.bulk_create([
+                Order(
+                    client_id=int(client_ids[c]),
+                    service_id=int(service_ids[s]),
+                    provider_id=provider.pk,
+                    status='completed',
+                    total_amount=Decimal('10.00'),
+                )
+                for c, s in zip(clients_index, services_index)
+            ])
+            remaining -= count
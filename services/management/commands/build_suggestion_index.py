@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from services.suggestions import rebuild_index, snapshot_path
+
+
+class Command(BaseCommand):
+    help = "Build the autocomplete snapshot file shared by all workers"
+
+    def handle(self, *args, **options):
+        count = rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} records to {snapshot_path()}"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from services.cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = "Report hit/miss counters of the catalogue response cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help="Zero the counters after reporting them")
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        self.stdout.write(
+            f"hits={stats['hits']} misses={stats['misses']} hit_ratio={stats['hit_ratio']:.1%}"
+        )
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS("Counters reset"))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from services.availability import HORIZON_DAYS, rebuild
+
+
+class Command(BaseCommand):
+    help = f"Recompute provider availability bitmaps for the next {HORIZON_DAYS} days"
+
+    def handle(self, *args, **options):
+        count = rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Stored {count} provider-day bitmaps"))
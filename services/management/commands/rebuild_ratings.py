@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from services.ratings import rebuild_ratings
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized review aggregates of services and providers"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        services, providers = rebuild_ratings(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt ratings of {services} services and {providers} users"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from services.recommendations import BLOCK_SIZE, TOP_N, rebuild_neighbors
+
+
+class Command(BaseCommand):
+    help = "Recompute the top-N similar services of every service"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-n', type=int, default=TOP_N)
+        parser.add_argument('--block-size', type=int, default=BLOCK_SIZE)
+
+    def handle(self, *args, **options):
+        result = rebuild_neighbors(top_n=options['top_n'], block_size=options['block_size'])
+        timings = result['timings']
+        self.stdout.write(self.style.SUCCESS(
+            f"Stored {result['neighbors']} neighbours from {result['interactions']} interactions "
+            f"(load {timings['load']:.1f}s, compute {timings['compute']:.1f}s, store {timings['store']:.1f}s)"
+        ))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from services.models import Service
+from services.search import install_search_index, reindex_services
+
+
+class Command(BaseCommand):
+    help = "Create the full-text index and rebuild the search document of every service"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        install_search_index()
+        count = reindex_services(Service.objects.order_by('id'), batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} services"))
@@ -1,6 +1,10 @@
 from django.db import models
 from django.conf import settings
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.db.models import Exists, F, FloatField, OuterRef, Value
+from django.db.models.functions import Cast
+from .geo import encode_geohash
+from .search import build_search_document, get_backend as get_search_backend
 
 class Category(models.Model):
     CATEGORY_CHOICES = [
@@ -26,6 +30,22 @@ class Category(models.Model):
     def __str__(self):
         return self.get_name_display()
 
+class ServiceQuerySet(models.QuerySet):
+    def for_listing(self, user=None):
+        """
+        Join category/provider and annotate review count, average review
+        rating and the user's favorite flag, so ServiceSerializer renders a
+        page of services without per-row queries
+        """
+        queryset = self.select_related('category', 'provider').annotate(
+            reviews_count=F('rating_count'),
+            review_rating_avg=Cast('rating', FloatField()),
+        )
+        if user is not None and user.is_authenticated:
+            favorites = FavoriteService.objects.filter(service=OuterRef('pk'), user=user)
+            return queryset.annotate(is_bookmarked=Exists(favorites))
+        return queryset.annotate(is_bookmarked=Value(False))
+
 class Service(models.Model):
     AVAILABILITY_CHOICES = [
         ('ALWAYS', '24/7'),
@@ -46,6 +66,8 @@ class Service(models.Model):
     location = models.CharField(max_length=255)
     latitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
     longitude = models.DecimalField(max_digits=9, decimal_places=6, null=True, blank=True)
+    geohash = models.CharField(max_length=12, blank=True, db_index=True, editable=False,
+                               help_text="Geohash of latitude/longitude, maintained on save")
     
     # Availability and scheduling
     is_available = models.BooleanField(default=True)
@@ -62,27 +84,76 @@ class Service(models.Model):
     qualifications = models.TextField(null=True, blank=True)
     languages = models.JSONField(null=True, blank=True, help_text="List of languages spoken")
     
+    # Denormalized name/description/location/category/provider text for search
+    search_document = models.TextField(blank=True, editable=False)
+
     # Metrics
     total_bookings = models.PositiveIntegerField(default=0)
     rating = models.DecimalField(max_digits=3, decimal_places=2, default=0.0, 
                                validators=[MinValueValidator(0.0), MaxValueValidator(5.0)])
+    # Review aggregates, maintained by services.ratings; rating is their average
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
     
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = ServiceQuerySet.as_manager()
+
+    SEARCH_FIELDS = {'name', 'description', 'location', 'category', 'provider'}
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['latitude', 'longitude'], name='service_lat_lng_idx'),
+            # Keyset pagination orderings (see services.pagination)
+            models.Index(fields=['price', 'id'], name='service_price_id_idx'),
+            models.Index(fields=['rating', 'id'], name='service_rating_id_idx'),
+            models.Index(fields=['created_at', 'id'], name='service_created_id_idx'),
+            models.Index(fields=['total_bookings', 'id'], name='service_bookings_id_idx'),
+            models.Index(fields=['rating', 'total_bookings', 'id'], name='service_relevance_id_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember loaded values so signal handlers can see what changed
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+    def save(self, *args, **kwargs):
+        # Keep the geohash cell in sync with the coordinates
+        if self.latitude is not None and self.longitude is not None:
+            self.geohash = encode_geohash(self.latitude, self.longitude)
+        else:
+            self.geohash = ''
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'latitude', 'longitude'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'geohash'}
+
+        # Rebuild the search document unless only unrelated columns are saved
+        reindex = update_fields is None or bool(self.SEARCH_FIELDS & set(update_fields))
+        if reindex:
+            self.search_document = build_search_document(self)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'search_document'}
+
+        super().save(*args, **kwargs)
+
+        if reindex:
+            get_search_backend().index(self.pk, self.search_document)
+
     def get_absolute_url(self):
         from django.urls import reverse
         return reverse('services:service-detail', kwargs={'pk': self.pk})
 
     @property
     def average_rating(self):
-        ratings = self.reviews.all().values_list('rating', flat=True)
-        if ratings:
-            return sum(ratings) / len(ratings)
-        return 0
+        return float(self.rating)
 
 class Review(models.Model):
     service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='reviews')
@@ -167,6 +238,43 @@ class ProviderSchedule(models.Model):
         day_name = dict(self._meta.get_field('day_of_week').choices)[self.day_of_week]
         return f"{self.provider.username} - {day_name}"
 
+class ServiceNeighbor(models.Model):
+    """
+    Precomputed item-item similarity: the top neighbours of each service,
+    rebuilt offline by services.recommendations
+    """
+    service = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='neighbors')
+    neighbor = models.ForeignKey(Service, on_delete=models.CASCADE, related_name='+')
+    score = models.FloatField()
+
+    class Meta:
+        unique_together = ['service', 'neighbor']
+
+    def __str__(self):
+        return f"{self.service_id} -> {self.neighbor_id} ({self.score:.3f})"
+
+class ProviderAvailability(models.Model):
+    """
+    Free time of a provider on one day as a bitmap of SLOT_MINUTES slots
+    (bit i set = slot i is free), derived from ProviderSchedule minus booked
+    orders. Maintained by services.availability.
+    """
+    provider = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='availability')
+    date = models.DateField()
+    free_slots = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Provider Availability'
+        verbose_name_plural = 'Provider Availability'
+        unique_together = ['provider', 'date']
+        indexes = [
+            models.Index(fields=['date', 'provider'], name='availability_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.provider.username} - {self.date}"
+
 class Promotion(models.Model):
     title = models.CharField(max_length=200)
     description = models.TextField()
@@ -0,0 +1,178 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+MAX_PER_PAGE = 100
+DEFAULT_PER_PAGE = 20
+# Row count at which a capped count stops, when the database has no
+# planner estimate to offer
+APPROXIMATE_COUNT_CAP = 10000
+
+# Keyset ordering for every sort_by the search endpoints accept, as
+# (field, descending) pairs. The id tie-breaker is appended automatically.
+SORT_ORDERINGS = {
+    'price_low': [('price', False)],
+    'price_high': [('price', True)],
+    'rating': [('rating', True)],
+    'newest': [('created_at', True)],
+    'popular': [('total_bookings', True)],
+    'relevance': [('rating', True), ('total_bookings', True)],
+    # relevance when a text query annotated the queryset (see search_services)
+    'search': [('relevance', True)],
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _decimal(value):
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise TypeError(value)
+    number = Decimal(str(value))
+    if not number.is_finite():
+        raise ValueError(value)
+    return number
+
+
+def _integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise TypeError(value)
+    return value
+
+
+def _float(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError(value)
+    return float(value)
+
+
+def _datetime(value):
+    moment = parse_datetime(value) if isinstance(value, str) else None
+    if moment is None:
+        raise ValueError(value)
+    return moment
+
+
+# Parsers for the cursor value of each sort field
+FIELD_PARSERS = {
+    'price': _decimal,
+    'rating': _decimal,
+    'total_bookings': _integer,
+    'created_at': _datetime,
+    'relevance': _float,
+    'id': _integer,
+}
+
+
+def parse_per_page(value, default=DEFAULT_PER_PAGE):
+    """
+    Parse a per_page parameter and clamp it to [1, MAX_PER_PAGE]
+    """
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), MAX_PER_PAGE))
+
+
+def _encode_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+class KeysetPaginator:
+    """
+    Seek-based pagination over an ordering of (field, descending) pairs.
+
+    Cursors are opaque tokens holding the sort values and id of the last row
+    of a page, so fetching page N costs the same as fetching page 1 and no
+    COUNT(*) is needed.
+    """
+
+    def __init__(self, sort_key, per_page):
+        if sort_key not in SORT_ORDERINGS:
+            raise ValueError(f"Unknown sort key {sort_key!r}")
+        self.sort_key = sort_key
+        self.per_page = per_page
+        ordering = SORT_ORDERINGS[sort_key]
+        # Break ties on id in the direction of the primary sort
+        self.ordering = ordering + [('id', ordering[0][1])]
+
+    def encode_cursor(self, obj):
+        values = [_encode_value(getattr(obj, field)) for field, _ in self.ordering]
+        payload = json.dumps({'s': self.sort_key, 'v': values}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            values = payload['v']
+            sort_key = payload['s']
+        except (binascii.Error, ValueError, KeyError, TypeError):
+            raise InvalidCursor("Malformed cursor")
+        if sort_key != self.sort_key or not isinstance(values, list) or len(values) != len(self.ordering):
+            raise InvalidCursor("Cursor does not match the requested sort order")
+        # Tampered values must not reach the filters, where they would fail
+        # as a server error
+        try:
+            return [FIELD_PARSERS[field](value) for (field, _), value in zip(self.ordering, values)]
+        except (TypeError, ValueError, InvalidOperation):
+            raise InvalidCursor("Malformed cursor")
+
+    def _after(self, values):
+        # (a, b, id) > (va, vb, vid) expanded into OR-ed prefixes, which
+        # each database can serve from an index on the sort columns
+        condition = Q()
+        for position, (field, descending) in enumerate(self.ordering):
+            lookup = 'lt' if descending else 'gt'
+            clause = Q(**{f'{field}__{lookup}': values[position]})
+            for prior, (prior_field, _) in enumerate(self.ordering[:position]):
+                clause &= Q(**{prior_field: values[prior]})
+            condition |= clause
+        return condition
+
+    def order(self, queryset):
+        return queryset.order_by(*[f"-{field}" if descending else field for field, descending in self.ordering])
+
+    def paginate(self, queryset, cursor=None):
+        """
+        Return (items, next_cursor) for the page following cursor
+        """
+        queryset = self.order(queryset)
+        if cursor:
+            queryset = queryset.filter(self._after(self.decode_cursor(cursor)))
+
+        items = list(queryset[:self.per_page + 1])
+        next_cursor = None
+        if len(items) > self.per_page:
+            items = items[:self.per_page]
+            next_cursor = self.encode_cursor(items[-1])
+        return items, next_cursor
+
+
+def approximate_count(queryset):
+    """
+    Estimate the number of rows in queryset without a full COUNT(*).
+
+    Postgres reports the planner's row estimate; other databases count at
+    most APPROXIMATE_COUNT_CAP rows.
+    """
+    queryset = queryset.order_by()
+    if connection.vendor == 'postgresql':
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", params)
+            plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+    return queryset[:APPROXIMATE_COUNT_CAP].count()
@@ -0,0 +1,126 @@
+"""
+Rating aggregates denormalized onto Service (rating_sum, rating_count,
+rating) and onto providers (rating_sum, rating_count, average_rating).
+
+Review writes apply deltas with F() expressions in a single UPDATE per row,
+from the review signal handlers, so concurrent reviews of the same service
+never overwrite each other. The average is computed in the same statement
+from the old column values plus the delta, which Postgres and SQLite both
+evaluate against the pre-update row.
+
+A full save of a service or user writes back whatever aggregates the
+instance loaded, so restore_ratings() re-derives that row's aggregates from
+its reviews afterwards.
+"""
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Case, Count, F, FloatField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Cast, Coalesce
+
+from . import cache
+
+
+def _delta_update(average_field, sum_delta, count_delta):
+    new_sum = F('rating_sum') + sum_delta
+    new_count = F('rating_count') + count_delta
+    return {
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+        average_field: Case(
+            When(rating_count=-count_delta, then=Value(0.0)),
+            default=Cast(new_sum, FloatField()) / new_count,
+            output_field=FloatField()
+        ),
+    }
+
+
+def _average_expression():
+    return Case(
+        When(rating_count=0, then=Value(0.0)),
+        default=Cast('rating_sum', FloatField()) / F('rating_count'),
+        output_field=FloatField()
+    )
+
+
+def apply_review_change(previous, current):
+    """
+    Move the aggregates from a review's previous (service_id, provider_id,
+    rating) to its current one; either side may be None for a create or
+    delete. Must run inside the review's transaction.
+    """
+    from .models import Service
+
+    deltas = {Service: defaultdict(lambda: [0, 0]), get_user_model(): defaultdict(lambda: [0, 0])}
+    for values, sign in ((previous, -1), (current, 1)):
+        if values is None:
+            continue
+        service_id, provider_id, rating = values
+        for model, pk in ((Service, service_id), (get_user_model(), provider_id)):
+            deltas[model][pk][0] += sign * rating
+            deltas[model][pk][1] += sign
+
+    for model, rows in deltas.items():
+        average_field = 'rating' if model is Service else 'average_rating'
+        for pk, (sum_delta, count_delta) in rows.items():
+            if sum_delta or count_delta:
+                model.objects.filter(pk=pk).update(**_delta_update(average_field, sum_delta, count_delta))
+
+
+def _recompute(rows, average_field, review_field):
+    from .models import Review
+
+    reviews = Review.objects.filter(**{review_field: OuterRef('pk')}).order_by().values(review_field)
+    review_sum = reviews.annotate(total=Sum('rating')).values('total')
+    review_count = reviews.annotate(total=Count('id')).values('total')
+    rows.update(
+        rating_sum=Coalesce(Subquery(review_sum), 0),
+        rating_count=Coalesce(Subquery(review_count), 0),
+    )
+    rows.update(**{average_field: _average_expression()})
+
+
+def restore_ratings(instance):
+    """Recompute a service's or provider's aggregates from its reviews"""
+    from .models import Service
+
+    if isinstance(instance, Service):
+        average_field, review_field = 'rating', 'service'
+    else:
+        average_field, review_field = 'average_rating', 'provider'
+    with transaction.atomic():
+        _recompute(type(instance).objects.filter(pk=instance.pk), average_field, review_field)
+
+
+def rebuild_ratings(batch_size=1000):
+    """
+    Recompute every service and provider aggregate from the reviews table,
+    one id range per transaction. Returns (services, providers) updated.
+    """
+    from .models import Service
+
+    targets = (
+        (Service, 'rating', 'service'),
+        (get_user_model(), 'average_rating', 'provider'),
+    )
+    totals = []
+    for model, average_field, review_field in targets:
+        updated = 0
+        ids = model.objects.order_by('pk').values_list('pk', flat=True)
+        last_id = None
+        while True:
+            chunk = ids.filter(pk__gt=last_id) if last_id is not None else ids
+            chunk = list(chunk[:batch_size])
+            if not chunk:
+                break
+            last_id = chunk[-1]
+            with transaction.atomic():
+                _recompute(model.objects.filter(pk__gte=chunk[0], pk__lte=last_id), average_field, review_field)
+            updated += len(chunk)
+        totals.append(updated)
+
+    # Bulk updates bypass the signals that invalidate cached listings
+    cache.bump_generation(cache.SERVICES)
+    cache.bump_generation(cache.REVIEWS)
+    return tuple(totals)
@@ -0,0 +1,177 @@
+"""
+Item-item recommendations.
+
+Nightly, completed orders, reviews and favorites are loaded into a sparse
+client x service matrix, columns are L2-normalized and the cosine
+similarity between services is computed block by block. The TOP_N most
+similar services of each service are stored in ServiceNeighbor. Serving a
+user is then a single indexed aggregate over the neighbours of the services
+they interacted with.
+"""
+import logging
+import time
+
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+
+logger = logging.getLogger(__name__)
+
+TOP_N = 20
+# Items per similarity block; bounds the memory of one sparse product
+BLOCK_SIZE = 1024
+# Interaction weights: log-scaled completed orders, star ratings scaled to
+# [0, REVIEW_WEIGHT], and a flat weight per favorite
+ORDER_WEIGHT = 1.0
+REVIEW_WEIGHT = 1.0
+FAVORITE_WEIGHT = 0.5
+
+
+def load_interactions():
+    """
+    Return (client_ids, service_ids, weights) arrays; a pair may occur once
+    per source and is summed when the matrix is built
+    """
+    from orders.models import Order
+    from .models import FavoriteService, Review
+
+    clients, services, weights = [], [], []
+
+    orders = Order.objects.filter(status='completed').order_by().values_list(
+        'client_id', 'service_id').annotate(n=Count('id'))
+    for client_id, service_id, count in orders.iterator(chunk_size=10000):
+        clients.append(client_id)
+        services.append(service_id)
+        weights.append(ORDER_WEIGHT * np.log1p(count))
+
+    for client_id, service_id, rating in Review.objects.order_by().values_list(
+            'client_id', 'service_id', 'rating').iterator(chunk_size=10000):
+        clients.append(client_id)
+        services.append(service_id)
+        weights.append(REVIEW_WEIGHT * rating / 5)
+
+    for client_id, service_id in FavoriteService.objects.order_by().values_list(
+            'user_id', 'service_id').iterator(chunk_size=10000):
+        clients.append(client_id)
+        services.append(service_id)
+        weights.append(FAVORITE_WEIGHT)
+
+    return (
+        np.asarray(clients, dtype=np.int64),
+        np.asarray(services, dtype=np.int64),
+        np.asarray(weights, dtype=np.float64),
+    )
+
+
+def build_matrix(client_ids, service_ids, weights):
+    """
+    Return (matrix, service_ids) where matrix is a clients x services CSC
+    matrix with unit-length columns and service_ids maps columns to ids
+    """
+    client_keys, rows = np.unique(client_ids, return_inverse=True)
+    service_keys, columns = np.unique(service_ids, return_inverse=True)
+    matrix = sparse.csc_matrix(
+        (weights, (rows, columns)), shape=(len(client_keys), len(service_keys))
+    )
+    matrix.sum_duplicates()
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+    norms[norms == 0] = 1.0
+    return matrix @ sparse.diags(1.0 / norms), service_keys
+
+
+def top_neighbors(matrix, top_n=TOP_N, block_size=BLOCK_SIZE):
+    """
+    Yield (column, neighbor_columns, scores) with the top_n cosine
+    neighbours of every column of a column-normalized matrix
+    """
+    matrix = sparse.csc_matrix(matrix)
+    transposed = matrix.T.tocsr()
+    count = matrix.shape[1]
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        similarity = (transposed[start:stop] @ matrix).tocsr()
+        # Drop each service's similarity to itself
+        similarity.setdiag(0, k=start)
+        similarity.eliminate_zeros()
+        for offset in range(stop - start):
+            row_start, row_end = similarity.indptr[offset], similarity.indptr[offset + 1]
+            if row_start == row_end:
+                continue
+            scores = similarity.data[row_start:row_end]
+            columns = similarity.indices[row_start:row_end]
+            if len(scores) > top_n:
+                best = np.argpartition(-scores, top_n)[:top_n]
+                scores, columns = scores[best], columns[best]
+            order = np.argsort(-scores, kind='stable')
+            yield start + offset, columns[order], scores[order]
+
+
+def rebuild_neighbors(top_n=TOP_N, block_size=BLOCK_SIZE, batch_size=5000):
+    """
+    Recompute ServiceNeighbor from scratch and return phase timings
+    """
+    from .models import ServiceNeighbor
+
+    timings = {}
+    started = time.perf_counter()
+    client_ids, service_ids, weights = load_interactions()
+    timings['load'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    rows = []
+    if len(weights):
+        matrix, service_keys = build_matrix(client_ids, service_ids, weights)
+        for column, neighbors, scores in top_neighbors(matrix, top_n, block_size):
+            service_id = int(service_keys[column])
+            rows.extend(
+                ServiceNeighbor(service_id=service_id, neighbor_id=int(neighbor_id), score=float(score))
+                for neighbor_id, score in zip(service_keys[neighbors], scores)
+            )
+    timings['compute'] = time.perf_counter() - started
+
+    # Swap the whole table in one transaction so readers never see a
+    # half-built set of neighbours
+    started = time.perf_counter()
+    with transaction.atomic():
+        ServiceNeighbor.objects.all().delete()
+        ServiceNeighbor.objects.bulk_create(rows, batch_size=batch_size)
+    timings['store'] = time.perf_counter() - started
+
+    logger.info(
+        "Rebuilt %s service neighbours from %s interactions (load %.1fs, compute %.1fs, store %.1fs)",
+        len(rows), len(weights), timings['load'], timings['compute'], timings['store']
+    )
+    return {'interactions': len(weights), 'neighbors': len(rows), 'timings': timings}
+
+
+def interacted_filter(user, field):
+    """
+    Q matching rows whose field holds a service the user completed an order
+    for, reviewed or favorited
+    """
+    from orders.models import Order
+    from .models import FavoriteService, Review
+
+    return (
+        Q(**{f'{field}__in': Order.objects.filter(client=user, status='completed').values('service_id')})
+        | Q(**{f'{field}__in': Review.objects.filter(client=user).values('service_id')})
+        | Q(**{f'{field}__in': FavoriteService.objects.filter(user=user).values('service_id')})
+    )
+
+
+def recommend(user, limit=10):
+    """
+    Return [(service_id, score)] for user, best first, from the stored
+    neighbours of every service they interacted with
+    """
+    from .models import ServiceNeighbor
+
+    scores = ServiceNeighbor.objects.filter(
+        interacted_filter(user, 'service_id'), neighbor__is_available=True
+    ).exclude(interacted_filter(user, 'neighbor_id')).values('neighbor_id').annotate(
+        total=Sum('score')
+    ).order_by('-total', 'neighbor_id')[:limit]
+    return [(row['neighbor_id'], row['total']) for row in scores]
@@ -0,0 +1,264 @@
+import logging
+import math
+import re
+
+from django.db import DatabaseError, connection
+from django.db.models import Case, ExpressionWrapper, F, FloatField, Q, Value, When
+from django.db.models.functions import Cast, Least, Ln
+
+logger = logging.getLogger(__name__)
+
+# How many text matches are ranked before the blended relevance sort. The
+# backends only match services in the filtered queryset, so filters never
+# cut into this.
+MAX_CANDIDATES = 1000
+
+# Weights of the blended relevance score; each component is in [0, 1]
+TEXT_WEIGHT = 0.6
+RATING_WEIGHT = 0.25
+POPULARITY_WEIGHT = 0.15
+# Bookings at which the popularity component saturates
+POPULARITY_CEILING = 1000
+_POPULARITY_SCALE = math.log(POPULARITY_CEILING + 1)
+
+
+def build_search_document(service):
+    """
+    Denormalize the searchable text of a service into a single string
+    """
+    provider = service.provider
+    parts = [
+        service.name,
+        service.description,
+        service.location,
+        service.category.get_name_display(),
+        provider.get_full_name() or provider.username,
+    ]
+    return '\n'.join(part for part in parts if part)
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class BaseSearchBackend:
+    def install(self):
+        pass
+
+    def index(self, service_id, document):
+        pass
+
+    def index_many(self, rows):
+        for service_id, document in rows:
+            self.index(service_id, document)
+
+    def remove(self, service_id):
+        pass
+
+    def match(self, tokens, limit, candidates=None):
+        """
+        Return [(service_id, score)] for the best matching services, where
+        higher scores are better. candidates, a queryset of service ids,
+        restricts the match to those services.
+        """
+        raise NotImplementedError
+
+
+def _restrict(column, candidates):
+    """SQL and params limiting column to the ids of candidates"""
+    if candidates is None:
+        return '', []
+    sql, params = candidates.query.sql_with_params()
+    return f" AND {column} IN ({sql})", list(params)
+
+
+class SQLiteSearchBackend(BaseSearchBackend):
+    """FTS5 virtual table keyed on the service id"""
+    table = 'services_service_fts'
+
+    def install(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {self.table} "
+                f"USING fts5(document, tokenize='porter unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+
+    def index(self, service_id, document):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [service_id])
+            cursor.execute(f"INSERT INTO {self.table} (rowid, document) VALUES (%s, %s)", [service_id, document])
+
+    def index_many(self, rows):
+        rows = list(rows)
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {self.table} WHERE rowid = %s", [(service_id,) for service_id, _ in rows])
+            cursor.executemany(f"INSERT INTO {self.table} (rowid, document) VALUES (%s, %s)", rows)
+
+    def remove(self, service_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {self.table} WHERE rowid = %s", [service_id])
+
+    def match(self, tokens, limit, candidates=None):
+        # Every token must match; the last one as a prefix for search-as-you-type
+        terms = [f'"{token}"' for token in tokens[:-1]] + [f'"{tokens[-1]}"*']
+        restriction, params = _restrict('rowid', candidates)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid, -bm25({self.table}) FROM {self.table} "
+                f"WHERE {self.table} MATCH %s{restriction} ORDER BY bm25({self.table}) LIMIT %s",
+                [' '.join(terms), *params, limit]
+            )
+            return cursor.fetchall()
+
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """GIN expression index over to_tsvector(search_document)"""
+    index_name = 'services_service_search_gin'
+    vector = "to_tsvector('english', search_document)"
+
+    def install(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.index_name} "
+                f"ON services_service USING GIN ({self.vector})"
+            )
+
+    def match(self, tokens, limit, candidates=None):
+        # search_document is a column on the service row, so index()/remove()
+        # have nothing to do; the expression index follows the row.
+        ts_query = ' & '.join(f'{token}:*' for token in tokens)
+        restriction, params = _restrict('id', candidates)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id, ts_rank_cd({self.vector}, query) AS rank "
+                f"FROM services_service, to_tsquery('english', %s) query "
+                f"WHERE {self.vector} @@ query{restriction} ORDER BY rank DESC LIMIT %s",
+                [ts_query, *params, limit]
+            )
+            return cursor.fetchall()
+
+
+class FallbackSearchBackend(BaseSearchBackend):
+    """Substring matching for databases without a full-text engine"""
+
+    def match(self, tokens, limit, candidates=None):
+        from .models import Service
+
+        condition = Q()
+        for token in tokens:
+            condition &= Q(search_document__icontains=token)
+        services = Service.objects.filter(condition)
+        if candidates is not None:
+            services = services.filter(id__in=candidates)
+        ids = services.values_list('id', flat=True)[:limit]
+        return [(service_id, 1.0) for service_id in ids]
+
+
+_backend = None
+
+
+def _sqlite_has_fts5():
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def get_backend():
+    """
+    The backend for the database. Every process decides for itself, so
+    they all fall back together on SQLite builds without FTS5.
+    """
+    global _backend
+    if _backend is None:
+        if connection.vendor == 'postgresql':
+            _backend = PostgresSearchBackend()
+        elif connection.vendor == 'sqlite' and _sqlite_has_fts5():
+            _backend = SQLiteSearchBackend()
+        else:
+            if connection.vendor == 'sqlite':
+                logger.warning("SQLite was built without FTS5, using substring search")
+            _backend = FallbackSearchBackend()
+    return _backend
+
+
+def install_search_index(**kwargs):
+    """
+    Create the full-text structures; connected to post_migrate
+    """
+    global _backend
+    backend = get_backend()
+    try:
+        backend.install()
+    except DatabaseError:
+        # e.g. SQLite compiled without FTS5
+        logger.warning("Full-text index unavailable on %s, using substring search", connection.vendor)
+        _backend = FallbackSearchBackend()
+
+
+def search_services(queryset, query):
+    """
+    Restrict queryset to services matching query and annotate them with
+    text_rank and a blended relevance score (text match, rating and
+    bookings). Order by '-relevance' to rank results. Apply every other
+    filter to queryset first: only services it holds are matched.
+    """
+    tokens = tokenize(query)
+    if not tokens:
+        return queryset.annotate(text_rank=Value(0.0), relevance=Value(0.0))
+
+    candidates = queryset.order_by().values('id')
+    try:
+        matches = get_backend().match(tokens, MAX_CANDIDATES, candidates)
+    except DatabaseError:
+        logger.exception("Full-text search failed, falling back to substring search")
+        matches = FallbackSearchBackend().match(tokens, MAX_CANDIDATES, candidates)
+
+    if not matches:
+        return queryset.none().annotate(text_rank=Value(0.0), relevance=Value(0.0))
+
+    best = max(score for _, score in matches) or 1.0
+    text_rank = Case(
+        *[When(id=service_id, then=Value(score / best)) for service_id, score in matches],
+        default=Value(0.0),
+        output_field=FloatField()
+    )
+    popularity = Least(
+        Ln(Cast('total_bookings', FloatField()) + 1.0) / _POPULARITY_SCALE,
+        Value(1.0),
+        output_field=FloatField()
+    )
+    return queryset.filter(id__in=[service_id for service_id, _ in matches]).annotate(
+        text_rank=text_rank,
+        relevance=ExpressionWrapper(
+            TEXT_WEIGHT * F('text_rank')
+            + RATING_WEIGHT * Cast('rating', FloatField()) / 5.0
+            + POPULARITY_WEIGHT * popularity,
+            output_field=FloatField()
+        ),
+    )
+
+
+def reindex_services(queryset, batch_size=500):
+    """
+    Rebuild the search document of every service in queryset
+    """
+    from .models import Service
+
+    backend = get_backend()
+    batch = []
+    count = 0
+    for service in queryset.select_related('category', 'provider').iterator(chunk_size=batch_size):
+        service.search_document = build_search_document(service)
+        batch.append(service)
+        if len(batch) >= batch_size:
+            count += _flush(Service, backend, batch)
+            batch = []
+    if batch:
+        count += _flush(Service, backend, batch)
+    return count
+
+
+def _flush(model, backend, services):
+    model.objects.bulk_update(services, ['search_document'])
+    backend.index_many([(service.pk, service.search_document) for service in services])
+    return len(services)
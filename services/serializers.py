@@ -29,16 +29,24 @@ class ServiceSerializer(serializers.ModelSerializer):
         ]
         read_only_fields = ['total_bookings', 'rating', 'created_at', 'updated_at']
 
+    # The listing annotations come from Service.objects.for_listing(); fall
+    # back to per-object queries for instances loaded any other way.
     def get_provider_rating(self, obj):
+        if hasattr(obj, 'review_rating_avg'):
+            return obj.review_rating_avg
         return obj.average_rating
 
     def get_reviews_count(self, obj):
+        if hasattr(obj, 'reviews_count'):
+            return obj.reviews_count
         return obj.reviews.count()
 
     def get_is_bookmarked(self, obj):
+        if hasattr(obj, 'is_bookmarked'):
+            return obj.is_bookmarked
         request = self.context.get('request')
         if request and request.user.is_authenticated:
-            return request.user in [review.client for review in obj.reviews.all()]
+            return obj.favorited_by.filter(user=request.user).exists()
         return False
 
 class ServicePackageSerializer(serializers.ModelSerializer):
@@ -0,0 +1,177 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from service_app.queue import enqueue
+from . import availability, cache
+from .models import Category, ProviderSchedule, Review, Service
+from .ratings import apply_review_change, restore_ratings
+from .search import get_backend, reindex_services
+from .tasks import refresh_suggestion_terms
+
+# Columns that decide which terms the suggestion index holds. Booking counts
+# only move term weights, which the nightly rebuild picks up.
+SUGGESTION_FIELDS = {'name', 'location', 'provider', 'provider_id', 'is_available'}
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def invalidate_service_responses(sender, **kwargs):
+    cache.bump_generation(cache.SERVICES)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_responses(sender, **kwargs):
+    cache.bump_generation(cache.CATEGORIES)
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_review_responses(sender, **kwargs):
+    cache.bump_generation(cache.REVIEWS)
+
+
+def _stored_rating(review):
+    queryset = Review.objects.filter(pk=review.pk)
+    # Lock the row so concurrent edits see each other's ratings
+    if transaction.get_connection().in_atomic_block:
+        queryset = queryset.select_for_update()
+    return queryset.values_list('service_id', 'provider_id', 'rating').first()
+
+
+@receiver(pre_save, sender=Review)
+def read_review_before_save(sender, instance, raw, **kwargs):
+    instance._stored_rating = None if raw or instance._state.adding else _stored_rating(instance)
+
+
+@receiver(post_save, sender=Review)
+def add_review_to_ratings(sender, instance, raw, **kwargs):
+    if not raw:
+        apply_review_change(
+            getattr(instance, '_stored_rating', None),
+            (instance.service_id, instance.provider_id, instance.rating),
+        )
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def restore_rating_aggregates(sender, instance, created, update_fields, raw, **kwargs):
+    # A full save wrote back the aggregates the instance loaded, which
+    # reviews may have moved since
+    if not created and not raw and update_fields is None:
+        restore_ratings(instance)
+
+
+@receiver(pre_delete, sender=Review)
+def lock_review_before_delete(sender, instance, **kwargs):
+    # Read the stored rating under a row lock; the instance may be stale
+    instance._stored_rating = _stored_rating(instance)
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_from_ratings(sender, instance, **kwargs):
+    # Runs inside the delete's transaction, cascades included
+    previous = getattr(instance, '_stored_rating', None)
+    if previous is not None:
+        apply_review_change(previous, None)
+
+
+@receiver(post_delete, sender=Service)
+def remove_service_from_search(sender, instance, **kwargs):
+    get_backend().remove(instance.pk)
+
+
+def _suggestion_terms(instance):
+    previous = getattr(instance, '_loaded_values', {})
+    names = {instance.name, previous.get('name')}
+    locations = {instance.location, previous.get('location')}
+    provider_ids = {instance.provider_id, previous.get('provider_id')}
+    return {
+        'names': sorted(name for name in names if name),
+        'locations': sorted(location for location in locations if location),
+        'provider_ids': sorted(provider_id for provider_id in provider_ids if provider_id),
+    }
+
+
+def _suggestions_changed(instance, created, update_fields):
+    if created:
+        return True
+    if update_fields is not None and not SUGGESTION_FIELDS & set(update_fields):
+        return False
+    previous = getattr(instance, '_loaded_values', None)
+    if previous is None:
+        return True
+    return any(
+        previous[field] != getattr(instance, field)
+        for field in ('name', 'location', 'provider_id', 'is_available') if field in previous
+    )
+
+
+@receiver(post_save, sender=Service)
+def refresh_suggestions_on_save(sender, instance, created, update_fields=None, **kwargs):
+    if not _suggestions_changed(instance, created, update_fields):
+        return
+    enqueue(refresh_suggestion_terms, **_suggestion_terms(instance))
+    instance._loaded_values = {
+        **getattr(instance, '_loaded_values', {}),
+        'name': instance.name,
+        'location': instance.location,
+        'provider_id': instance.provider_id,
+        'is_available': instance.is_available,
+    }
+
+
+@receiver(post_delete, sender=Service)
+def refresh_suggestions_on_delete(sender, instance, **kwargs):
+    enqueue(refresh_suggestion_terms, **_suggestion_terms(instance))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_services(sender, instance, created, **kwargs):
+    if not created:
+        reindex_services(instance.services.all())
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def reindex_provider_services(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only touch last_login; skip anything that can't change the name
+    if created or (update_fields is not None and not {'first_name', 'last_name', 'username'} & set(update_fields)):
+        return
+    reindex_services(Service.objects.filter(provider=instance))
+    # Listings show the provider's name
+    cache.bump_generation(cache.SERVICES)
+
+
+@receiver(post_save, sender=ProviderSchedule)
+def refresh_schedule_availability(sender, instance, **kwargs):
+    availability.refresh_provider(instance.provider_id)
+
+
+@receiver(post_delete, sender=ProviderSchedule)
+def release_schedule_availability(sender, instance, **kwargs):
+    # After commit, so a provider deleted with its schedule gets no new rows
+    transaction.on_commit(lambda: availability.refresh_provider(instance.provider_id))
+
+
+# Lazy sender: orders.models imports services.models
+AVAILABILITY_FIELDS = {'provider', 'provider_id', 'status', 'scheduled_date', 'duration_hours'}
+
+
+@receiver(post_save, sender='orders.Order')
+def refresh_order_availability(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and not AVAILABILITY_FIELDS & set(update_fields):
+        return
+    availability.refresh_order(instance)
+    instance._loaded_values = {
+        **getattr(instance, '_loaded_values', {}),
+        'provider_id': instance.provider_id,
+        'scheduled_date': instance.scheduled_date,
+        'duration_hours': instance.duration_hours,
+    }
+
+
+@receiver(post_delete, sender='orders.Order')
+def release_order_availability(sender, instance, **kwargs):
+    transaction.on_commit(lambda: availability.refresh_order(instance))
@@ -0,0 +1,372 @@
+"""
+Autocomplete index for SearchSuggestionsView.
+
+The index is a sorted array of (key, display, kind, weight) records written
+to a snapshot file. Every gunicorn worker memory-maps the same file, so the
+page cache holds one copy and lookups are a binary search plus a short scan
+instead of LIKE queries. Keys are every word-start suffix of the display
+text ("house cleaning" is indexed under "house cleaning" and "cleaning").
+
+File layout (little endian):
+    header   MAGIC, record count (uint32), meta length (uint32)
+    offsets  record count x uint32, relative to the start of the records
+    records  key_len (uint16), display_len (uint16), kind (uint8),
+             weight (uint32), key bytes, display bytes
+    meta     JSON: top suggestions for every short prefix, popular categories
+"""
+import bisect
+import fcntl
+import heapq
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Count, Sum
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SUGGIDX1'
+HEADER = struct.Struct('<8sII')
+OFFSET = struct.Struct('<I')
+RECORD = struct.Struct('<HHBI')
+
+KINDS = ('services', 'locations', 'providers', 'categories')
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+
+RESULTS_PER_KIND = 5
+POPULAR_CATEGORIES = 8
+# Prefixes up to this length have their answers precomputed in the meta
+# block, because their ranges in the sorted array are too wide to scan
+PRECOMPUTED_PREFIX_LENGTH = 2
+# Upper bound on records scanned for longer prefixes
+MAX_SCAN = 5000
+# How often a worker checks whether a newer snapshot has been written
+RELOAD_INTERVAL = 1.0
+# How often a worker asks for a missing snapshot to be built
+REBUILD_REQUEST_INTERVAL = 60.0
+
+MAX_WEIGHT = 2 ** 32 - 1
+
+
+def normalize(text):
+    return ' '.join(re.findall(r'\w+', text.lower()))
+
+
+def index_keys(display):
+    words = normalize(display).split()
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+def snapshot_path():
+    return str(settings.SUGGESTION_INDEX_PATH)
+
+
+@contextmanager
+def write_lock(path=None):
+    """
+    Hold the snapshot's lock file, so concurrent rebuilds and refreshes in
+    any process on the host apply one after another
+    """
+    path = path or snapshot_path()
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(f'{path}.lock', 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def collect_terms(names=None, locations=None, provider_ids=None):
+    """
+    Return {(kind, display): weight} from the database, optionally limited
+    to the given service names, locations and providers. A term's weight is
+    the number of available services using it plus their bookings.
+    """
+    from .models import Category, Service
+
+    available = Service.objects.filter(is_available=True).order_by()
+    terms = {}
+
+    if names is None or names:
+        rows = available.filter(name__in=names) if names is not None else available
+        for row in rows.values('name').annotate(n=Count('id'), b=Sum('total_bookings')):
+            terms[('services', row['name'])] = row['n'] + (row['b'] or 0)
+
+    if locations is None or locations:
+        rows = available.filter(location__in=locations) if locations is not None else available
+        for row in rows.values('location').annotate(n=Count('id'), b=Sum('total_bookings')):
+            terms[('locations', row['location'])] = row['n'] + (row['b'] or 0)
+
+    if provider_ids is None or provider_ids:
+        rows = available.filter(provider_id__in=provider_ids) if provider_ids is not None else available
+        for row in rows.values('provider_id', 'provider__first_name', 'provider__last_name').annotate(
+                n=Count('id'), b=Sum('total_bookings')):
+            display = f"{row['provider__first_name']} {row['provider__last_name']}".strip()
+            if display:
+                key = ('providers', display)
+                terms[key] = terms.get(key, 0) + row['n'] + (row['b'] or 0)
+
+    if names is None and locations is None and provider_ids is None:
+        counts = dict(available.values_list('category__name').annotate(n=Count('id')))
+        for category in Category.objects.values_list('name', flat=True):
+            terms[('categories', category)] = counts.get(category, 0)
+
+    return terms
+
+
+def build_records(terms):
+    from .models import Category
+
+    labels = dict(Category.CATEGORY_CHOICES)
+    records = []
+    for (kind, display), weight in terms.items():
+        if not display:
+            continue
+        search_text = display
+        if kind == 'categories':
+            # Category codes are also found by their labels, e.g. "beauty"
+            search_text = f"{display} {labels.get(display, '')}"
+        for key in index_keys(search_text):
+            records.append((key, display, KIND_CODES[kind], min(weight, MAX_WEIGHT)))
+    records.sort()
+    return records
+
+
+def build_meta(records):
+    top = defaultdict(lambda: defaultdict(list))
+    for key, display, kind, weight in records:
+        for length in range(1, PRECOMPUTED_PREFIX_LENGTH + 1):
+            if len(key) >= length:
+                top[key[:length]][kind].append((weight, display))
+
+    prefixes = {}
+    for prefix, by_kind in top.items():
+        prefixes[prefix] = {
+            KINDS[kind]: _top_displays(candidates, RESULTS_PER_KIND)
+            for kind, candidates in by_kind.items()
+        }
+
+    categories = [(weight, display) for _, display, kind, weight in records if kind == KIND_CODES['categories']]
+    return {
+        'prefixes': prefixes,
+        'popular_categories': _top_displays(categories, POPULAR_CATEGORIES),
+    }
+
+
+def _top_displays(candidates, limit):
+    best = {}
+    for weight, display in candidates:
+        best[display] = max(weight, best.get(display, 0))
+    ranked = heapq.nsmallest(limit, best.items(), key=lambda item: (-item[1], item[0]))
+    return [display for display, _ in ranked]
+
+
+def write_snapshot(records, path=None):
+    """
+    Atomically replace the snapshot file with the given sorted records
+    """
+    path = path or snapshot_path()
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+
+    meta = json.dumps(build_meta(records), separators=(',', ':')).encode()
+    offsets = []
+    body = bytearray()
+    for key, display, kind, weight in records:
+        key_bytes = key.encode()
+        display_bytes = display.encode()
+        offsets.append(len(body))
+        body += RECORD.pack(len(key_bytes), len(display_bytes), kind, weight)
+        body += key_bytes + display_bytes
+
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.suggestions-')
+    try:
+        with os.fdopen(fd, 'wb') as handle:
+            handle.write(HEADER.pack(MAGIC, len(records), len(meta)))
+            for offset in offsets:
+                handle.write(OFFSET.pack(offset))
+            handle.write(body)
+            handle.write(meta)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+    # Make this process pick up the new file on its next lookup; other
+    # workers notice it within RELOAD_INTERVAL
+    global _checked_at
+    _checked_at = 0.0
+    return len(records)
+
+
+class SuggestionSnapshot:
+    """Read-only view over a memory-mapped snapshot file"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as handle:
+            stat = os.fstat(handle.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, meta_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a suggestion snapshot")
+        self._offsets_start = HEADER.size
+        self._records_start = self._offsets_start + self.count * OFFSET.size
+        meta_start = len(self._map) - meta_length
+        self.meta = json.loads(self._map[meta_start:])
+        self._keys = _KeyView(self)
+
+    def record(self, index):
+        offset = self._records_start + OFFSET.unpack_from(self._map, self._offsets_start + index * OFFSET.size)[0]
+        key_len, display_len, kind, weight = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        key = self._map[start:start + key_len].decode()
+        display = self._map[start + key_len:start + key_len + display_len].decode()
+        return key, display, kind, weight
+
+    def records(self):
+        for index in range(self.count):
+            yield self.record(index)
+
+    def lookup(self, query, limit=RESULTS_PER_KIND):
+        prefix = normalize(query)
+        results = {kind: [] for kind in KINDS}
+        if not prefix:
+            return results
+
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH:
+            for kind, displays in self.meta['prefixes'].get(prefix, {}).items():
+                results[kind] = displays[:limit]
+            return results
+
+        candidates = defaultdict(list)
+        index = bisect.bisect_left(self._keys, prefix)
+        end = min(self.count, index + MAX_SCAN)
+        while index < end:
+            key, display, kind, weight = self.record(index)
+            if not key.startswith(prefix):
+                break
+            candidates[kind].append((weight, display))
+            index += 1
+
+        for kind, kind_candidates in candidates.items():
+            results[KINDS[kind]] = _top_displays(kind_candidates, limit)
+        return results
+
+    def close(self):
+        self._map.close()
+
+
+class _KeyView:
+    """Sequence of record keys, so bisect can search the mapped file"""
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def __len__(self):
+        return self.snapshot.count
+
+    def __getitem__(self, index):
+        return self.snapshot.record(index)[0]
+
+
+_lock = threading.Lock()
+_snapshot = None
+_checked_at = 0.0
+_rebuild_requested_at = None
+
+
+def _request_rebuild():
+    global _rebuild_requested_at
+    from service_app.queue import enqueue
+    from .tasks import rebuild_suggestion_index
+
+    now = time.monotonic()
+    if _rebuild_requested_at is None or now - _rebuild_requested_at >= REBUILD_REQUEST_INTERVAL:
+        _rebuild_requested_at = now
+        enqueue(rebuild_suggestion_index)
+
+
+def get_index():
+    """
+    Return this process's mapping of the current snapshot, re-mapping it
+    when another process has replaced the file. Returns None while there is
+    no snapshot yet, after asking a worker to build one.
+    """
+    global _snapshot, _checked_at
+
+    now = time.monotonic()
+    current = _snapshot
+    if current is not None and current.path == snapshot_path() and now - _checked_at < RELOAD_INTERVAL:
+        return current
+
+    with _lock:
+        path = snapshot_path()
+        if not os.path.exists(path):
+            _request_rebuild()
+            return None
+        stat = os.stat(path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if _snapshot is None or _snapshot.path != path or _snapshot.identity != identity:
+            _snapshot = SuggestionSnapshot(path)
+        _checked_at = now
+        return _snapshot
+
+
+def rebuild_index(path=None):
+    """
+    Build a complete snapshot from the database
+    """
+    started = time.perf_counter()
+    records = build_records(collect_terms())
+    with write_lock(path):
+        count = write_snapshot(records, path)
+    logger.info("Built suggestion index with %s records in %.2fs", count, time.perf_counter() - started)
+    return count
+
+
+def refresh_terms(names=(), locations=(), provider_ids=()):
+    """
+    Recompute the weights of the given terms and merge them into the
+    existing snapshot, leaving every other record untouched
+    """
+    from django.contrib.auth import get_user_model
+
+    path = snapshot_path()
+    names, locations, provider_ids = set(names), set(locations), set(provider_ids)
+    fresh = collect_terms(names=names, locations=locations, provider_ids=provider_ids)
+
+    # Every requested term is replaced, including terms that no longer have
+    # any available service and therefore drop out of the index
+    stale = {('services', name) for name in names} | {('locations', location) for location in locations}
+    for first_name, last_name in get_user_model().objects.filter(
+            id__in=provider_ids).values_list('first_name', 'last_name'):
+        stale.add(('providers', f"{first_name} {last_name}".strip()))
+    stale |= set(fresh)
+
+    # Read, merge and replace under the lock, or a concurrent refresh's
+    # changes would be lost when the last rename wins
+    with write_lock(path):
+        if not os.path.exists(path):
+            return write_snapshot(build_records(collect_terms()), path)
+        snapshot = SuggestionSnapshot(path)
+        try:
+            kept = [
+                record for record in snapshot.records()
+                if (KINDS[record[2]], record[1]) not in stale
+            ]
+        finally:
+            snapshot.close()
+        return write_snapshot(sorted(kept + build_records(fresh)), path)
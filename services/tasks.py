@@ -0,0 +1,34 @@
+from celery import shared_task
+
+from . import availability, recommendations, suggestions
+
+
+@shared_task
+def refresh_suggestion_terms(names=(), locations=(), provider_ids=()):
+    """Merge changed service names, locations and providers into the suggestion index"""
+    return suggestions.refresh_terms(names=names, locations=locations, provider_ids=provider_ids)
+
+
+@shared_task
+def rebuild_suggestion_index():
+    """Rebuild the suggestion index snapshot from scratch"""
+    return suggestions.rebuild_index()
+
+
+@shared_task
+def extend_availability_horizon():
+    """Compute the availability bitmaps of the day entering the horizon"""
+    return availability.extend_horizon()
+
+
+@shared_task
+def rebuild_availability():
+    """Recompute every provider's availability bitmaps"""
+    return availability.rebuild()
+
+
+@shared_task
+def rebuild_recommendations():
+    """Recompute the item-item neighbours behind ServiceRecommendationsView"""
+    result = recommendations.rebuild_neighbors()
+    return {'interactions': result['interactions'], 'neighbors': result['neighbors']}
@@ -1,9 +1,29 @@
-from django.test import TestCase
+import base64
+import datetime
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase, override_settings
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase
 from rest_framework import status
+from rest_framework.throttling import AnonRateThrottle
 from django.urls import reverse
-from .models import Service, Category, Review
+from django.utils import timezone
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .cache import get_stats as get_cache_stats
+from orders.models import Order
+from .models import Service, Category, Review, FavoriteService, ProviderAvailability, ProviderSchedule, ServiceNeighbor
+from . import suggestions
+from .recommendations import rebuild_neighbors
+from .suggestions import SuggestionSnapshot, rebuild_index as rebuild_suggestion_index
 
 User = get_user_model()
 
@@ -148,3 +168,754 @@ class ServiceAPITest(APITestCase):
         }
         response = self.client.post(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+class NearbyServicesAPITest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.category = Category.objects.create(
+            name='HOME',
+            description='Home services'
+        )
+        # Nairobi CBD, Westlands (~4km), Thika (~40km) and Mombasa (~440km)
+        self.cbd = self._create_service('CBD Cleaning', '-1.286389', '36.817223')
+        self.westlands = self._create_service('Westlands Cleaning', '-1.267500', '36.807700')
+        self.thika = self._create_service('Thika Cleaning', '-1.033300', '37.069300')
+        self.mombasa = self._create_service('Mombasa Cleaning', '-4.043500', '39.668200')
+        self._create_service('Remote Cleaning', None, None)
+
+    def _create_service(self, name, latitude, longitude):
+        return Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name=name,
+            description='Cleaning',
+            price=20.00,
+            base_price=20.00,
+            image='services/test.jpg',
+            location='Kenya',
+            latitude=latitude,
+            longitude=longitude
+        )
+
+    def test_geohash_maintained_on_save(self):
+        self.assertEqual(self.cbd.geohash, 'kzf0tvc6p')
+        self.cbd.latitude = None
+        self.cbd.save()
+        self.assertEqual(self.cbd.geohash, '')
+
+    def test_results_within_radius_sorted_by_distance(self):
+        url = reverse('services:nearby-services')
+        response = self.client.get(url, {'lat': '-1.2864', 'lng': '36.8172', 'radius': 50})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item['id'] for item in response.data],
+            [self.cbd.id, self.westlands.id, self.thika.id]
+        )
+        distances = [item['distance_km'] for item in response.data]
+        self.assertEqual(distances, sorted(distances))
+        self.assertLess(distances[0], 0.1)
+        self.assertAlmostEqual(distances[1], 2.4, delta=0.5)
+
+    def test_small_radius_excludes_far_services(self):
+        url = reverse('services:nearby-services')
+        response = self.client.get(url, {'lat': '-1.2864', 'lng': '36.8172', 'radius': 1})
+        self.assertEqual([item['id'] for item in response.data], [self.cbd.id])
+
+    def test_limit(self):
+        url = reverse('services:nearby-services')
+        response = self.client.get(url, {'lat': '-1.2864', 'lng': '36.8172', 'radius': 500, 'limit': 2})
+        self.assertEqual([item['id'] for item in response.data], [self.cbd.id, self.westlands.id])
+
+    def test_invalid_coordinates(self):
+        url = reverse('services:nearby-services')
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'lat': 'abc', 'lng': '36.8'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(url, {'lat': '95', 'lng': '36.8'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ServiceListQueryCountTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.client_user = User.objects.create_user(
+            username='client',
+            email='client@test.com',
+            password='testpass123',
+            account_type='client'
+        )
+        self.category = Category.objects.create(
+            name='HOME',
+            description='Home services'
+        )
+
+    def _create_services(self, count):
+        for i in range(count):
+            service = Service.objects.create(
+                provider=self.provider,
+                category=self.category,
+                name=f'Service {i}',
+                description='Test service',
+                price=10 + i,
+                base_price=10 + i,
+                image='services/test.jpg',
+                location='Nairobi'
+            )
+            Review.objects.create(service=service, client=self.client_user, rating=4)
+            if i % 2:
+                FavoriteService.objects.create(user=self.client_user, service=service)
+
+    def _count_queries(self, url, params=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries), response
+
+    def test_list_query_count_independent_of_page_size(self):
+        self.client.force_authenticate(user=self.client_user)
+        url = reverse('services:service-list-create')
+
+        self._create_services(5)
+        small, _ = self._count_queries(url)
+        self._create_services(20)
+        large, response = self._count_queries(url)
+
+        self.assertEqual(len(response.data), 25)
+        self.assertEqual(small, large)
+        self.assertEqual(large, 1)
+
+    def test_advanced_search_query_count_independent_of_page_size(self):
+        self.client.force_authenticate(user=self.client_user)
+        url = reverse('services:advanced-search')
+        self._create_services(20)
+
+        small, _ = self._count_queries(url, {'per_page': 5})
+        large, response = self._count_queries(url, {'per_page': 20})
+
+        self.assertEqual(len(response.data['results']), 20)
+        self.assertEqual(small, large)
+
+    def test_listing_annotations(self):
+        self.client.force_authenticate(user=self.client_user)
+        self._create_services(2)
+        url = reverse('services:service-list-create')
+        response = self.client.get(url, {'ordering': 'price'})
+
+        first, second = response.data
+        self.assertEqual(first['reviews_count'], 1)
+        self.assertEqual(first['provider_rating'], 4.0)
+        self.assertFalse(first['is_bookmarked'])
+        self.assertTrue(second['is_bookmarked'])
+
+        self.client.force_authenticate(user=None)
+        response = self.client.get(url, {'ordering': 'price'})
+        self.assertFalse(response.data[1]['is_bookmarked'])
+
+class ServiceSearchTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider',
+            first_name='Wanjiru',
+            last_name='Kamau'
+        )
+        self.home = Category.objects.create(name='HOME', description='Home services')
+        self.beauty = Category.objects.create(name='BEAUTY', description='Beauty services')
+        self.cleaning = self._create_service('Deep House Cleaning', self.home, rating=3, location='Westlands')
+        self.windows = self._create_service('Window Cleaning', self.home, rating=5, total_bookings=200)
+        self.manicure = self._create_service('Manicure', self.beauty, location='Kilimani')
+
+    def _create_service(self, name, category, rating=0, total_bookings=0, location='Nairobi'):
+        return Service.objects.create(
+            provider=self.provider,
+            category=category,
+            name=name,
+            description='Professional service',
+            price=20.00,
+            base_price=20.00,
+            image='services/test.jpg',
+            location=location,
+            rating=rating,
+            total_bookings=total_bookings
+        )
+
+    def _search(self, query, **params):
+        url = reverse('services:service-search')
+        response = self.client.get(url, {'q': query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item['id'] for item in response.data]
+
+    def test_search_document_built_on_save(self):
+        self.assertIn('Home & Personal Services', self.cleaning.search_document)
+        self.assertIn('Wanjiru Kamau', self.cleaning.search_document)
+
+    def test_prefix_and_stemmed_matches(self):
+        self.assertEqual(set(self._search('clean')), {self.cleaning.id, self.windows.id})
+        self.assertEqual(self._search('house clean'), [self.cleaning.id])
+        self.assertEqual(self._search('manic'), [self.manicure.id])
+
+    def test_matches_location_category_and_provider(self):
+        self.assertEqual(self._search('kilimani'), [self.manicure.id])
+        self.assertEqual(self._search('beauty wellness'), [self.manicure.id])
+        self.assertEqual(len(self._search('wanjiru')), 3)
+
+    def test_filters_apply_before_the_candidate_limit(self):
+        with mock.patch('services.search.MAX_CANDIDATES', 1):
+            self.assertEqual(self._search('cleaning', location='Westlands'), [self.cleaning.id])
+            self.assertEqual(self._search('cleaning', min_rating=4), [self.windows.id])
+
+    def test_relevance_blends_rating_and_bookings(self):
+        # Both match "cleaning" equally well; the better rated, more booked one wins
+        self.assertEqual(self._search('cleaning'), [self.windows.id, self.cleaning.id])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.cleaning.name = 'Carpet Shampooing'
+        self.cleaning.save()
+        self.assertEqual(self._search('shampoo'), [self.cleaning.id])
+        self.assertEqual(self._search('house'), [])
+
+        self.provider.first_name = 'Achieng'
+        self.provider.save()
+        self.assertEqual(len(self._search('achieng')), 3)
+
+        self.manicure.delete()
+        self.assertEqual(self._search('manicure'), [])
+
+    def test_advanced_search_relevance(self):
+        url = reverse('services:advanced-search')
+        response = self.client.get(url, {'q': 'cleaning', 'sort_by': 'relevance'})
+        self.assertEqual(
+            [item['id'] for item in response.data['results']],
+            [self.windows.id, self.cleaning.id]
+        )
+        self.assertEqual(response.data['total_count'], 2)
+
+class SearchSuggestionsTest(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        settings_override = override_settings(
+            SUGGESTION_INDEX_PATH=os.path.join(self.tmpdir.name, 'suggestions.idx')
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider',
+            first_name='Wanjiru',
+            last_name='Kamau'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        Category.objects.create(name='BEAUTY', description='Beauty services')
+        self._create_service('House Cleaning', 'Westlands', total_bookings=3)
+        self._create_service('Deep House Cleaning', 'Westgate', total_bookings=50)
+        self._create_service('Plumbing', 'Kilimani')
+        rebuild_suggestion_index()
+
+    def _create_service(self, name, location, total_bookings=0):
+        return Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name=name,
+            description='Professional service',
+            price=20.00,
+            base_price=20.00,
+            image='services/test.jpg',
+            location=location,
+            total_bookings=total_bookings
+        )
+
+    def _suggest(self, query):
+        url = reverse('services:search-suggestions')
+        response = self.client.get(url, {'q': query})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_missing_index_is_built_by_a_task(self):
+        os.unlink(settings.SUGGESTION_INDEX_PATH)
+        suggestions._rebuild_requested_at = None
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self._suggest('west')['locations'], [])
+        data = self._suggest('west')
+        self.assertEqual(data['locations'], ['Westgate', 'Westlands'])
+        self.assertEqual(data['categories'], ['HOME', 'BEAUTY'])
+
+    def test_booking_counts_do_not_rewrite_the_snapshot(self):
+        modified = os.stat(settings.SUGGESTION_INDEX_PATH).st_mtime_ns
+        service = Service.objects.get(name='Plumbing')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            service.total_bookings += 1
+            service.save()
+            Service.objects.get(pk=service.pk).save(update_fields=['total_bookings'])
+        self.assertEqual(callbacks, [])
+        self.assertEqual(os.stat(settings.SUGGESTION_INDEX_PATH).st_mtime_ns, modified)
+
+    def test_word_prefix_matches_ranked_by_popularity(self):
+        data = self._suggest('clea')
+        self.assertEqual(data['services'], ['Deep House Cleaning', 'House Cleaning'])
+        self.assertEqual(self._suggest('kam')['providers'], ['Wanjiru Kamau'])
+
+    def test_short_prefixes_use_precomputed_answers(self):
+        self.assertEqual(self._suggest('h')['services'], ['Deep House Cleaning', 'House Cleaning'])
+        self.assertEqual(self._suggest('pl')['services'], ['Plumbing'])
+
+    def test_snapshot_round_trip(self):
+        rebuild_suggestion_index()
+        snapshot = SuggestionSnapshot(settings.SUGGESTION_INDEX_PATH)
+        keys = [record[0] for record in snapshot.records()]
+        snapshot.close()
+        self.assertEqual(keys, sorted(keys))
+        self.assertIn('house cleaning', keys)
+        self.assertIn('cleaning', keys)
+
+    def test_incremental_refresh_on_change(self):
+        self._suggest('plumb')
+        service = Service.objects.get(name='Plumbing')
+        with self.captureOnCommitCallbacks(execute=True):
+            service.name = 'Electrical Repairs'
+            service.save()
+        self.assertEqual(self._suggest('plumb')['services'], [])
+        self.assertEqual(self._suggest('elec')['services'], ['Electrical Repairs'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            service.delete()
+        self.assertEqual(self._suggest('elec')['services'], [])
+        self.assertEqual(self._suggest('kilim')['locations'], [])
+
+class AdvancedSearchCursorTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        # Repeated prices, ratings and bookings exercise the id tie-breaker
+        for i in range(11):
+            Service.objects.create(
+                provider=self.provider,
+                category=self.category,
+                name=f'Cleaning {i}',
+                description='Professional cleaning',
+                price=10 + i % 4,
+                base_price=10 + i % 4,
+                image='services/test.jpg',
+                location='Nairobi',
+                rating=i % 3,
+                total_bookings=i % 5
+            )
+        self.url = reverse('services:advanced-search')
+
+    def _walk(self, **params):
+        ids = []
+        cursor = ''
+        while cursor is not None:
+            response = self.client.get(self.url, {'cursor': cursor, 'per_page': 3, **params})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids.extend(item['id'] for item in response.data['results'])
+            cursor = response.data['next_cursor']
+        return ids
+
+    def test_cursor_pages_cover_every_sort_order(self):
+        orderings = {
+            'price_low': ['price', 'id'],
+            'price_high': ['-price', '-id'],
+            'rating': ['-rating', '-id'],
+            'newest': ['-created_at', '-id'],
+            'popular': ['-total_bookings', '-id'],
+            'relevance': ['-rating', '-total_bookings', '-id'],
+        }
+        for sort_by, ordering in orderings.items():
+            with self.subTest(sort_by=sort_by):
+                expected = list(Service.objects.order_by(*ordering).values_list('id', flat=True))
+                self.assertEqual(self._walk(sort_by=sort_by), expected)
+
+    def test_cursor_pages_for_text_relevance(self):
+        ids = self._walk(q='cleaning')
+        self.assertEqual(sorted(ids), sorted(Service.objects.values_list('id', flat=True)))
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_per_page_ceiling(self):
+        response = self.client.get(self.url, {'per_page': 100000})
+        self.assertEqual(response.data['per_page'], 100)
+        response = self.client.get(self.url, {'per_page': 'lots'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_or_mismatched_cursor(self):
+        response = self.client.get(self.url, {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        first = self.client.get(self.url, {'cursor': '', 'per_page': 3, 'sort_by': 'price_low'})
+        response = self.client.get(self.url, {'cursor': first.data['next_cursor'], 'sort_by': 'rating'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_tampered_cursor_values(self):
+        def cursor(sort_key, values):
+            payload = json.dumps({'s': sort_key, 'v': values})
+            return base64.urlsafe_b64encode(payload.encode()).decode()
+
+        for sort_key, values in [
+            ('price_low', ['abc', 1]),
+            ('price_low', [{'x': 1}, 1]),
+            ('price_low', ['NaN', 1]),
+            ('newest', ['yesterday', 1]),
+            ('popular', ['ten', 1]),
+            ('popular', [10, None]),
+            ('popular', {'a': 1, 'b': 2}),
+        ]:
+            response = self.client.get(self.url, {'cursor': cursor(sort_key, values), 'sort_by': sort_key})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, values)
+
+    def test_optional_totals(self):
+        response = self.client.get(self.url, {'cursor': '', 'per_page': 3})
+        self.assertNotIn('total_count', response.data)
+        response = self.client.get(self.url, {'cursor': '', 'total': 'approximate'})
+        self.assertEqual(response.data['total_count'], 11)
+        self.assertTrue(response.data['total_count_is_approximate'])
+        response = self.client.get(self.url, {'cursor': '', 'total': 'exact'})
+        self.assertEqual(response.data['total_count'], 11)
+
+class CatalogueResponseCacheTest(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.client_user = User.objects.create_user(
+            username='client',
+            email='client@test.com',
+            password='testpass123',
+            account_type='client'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name='House Cleaning',
+            description='Professional cleaning',
+            price=50,
+            base_price=50,
+            image='services/test.jpg',
+            location='Nairobi'
+        )
+        self.url = reverse('services:service-search')
+
+    def test_repeated_anonymous_request_is_served_from_cache(self):
+        first = self.client.get(self.url, {'location': 'Nairobi', 'q': 'cleaning'})
+        self.assertEqual(first['X-Cache'], 'MISS')
+
+        with CaptureQueriesContext(connection) as queries:
+            # Parameter order and empty values do not change the cache key
+            second = self.client.get(f'{self.url}?q=cleaning&category=&location=Nairobi')
+        self.assertEqual(second['X-Cache'], 'HIT')
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(second.content, first.content)
+
+        self.assertEqual(get_cache_stats()['hits'], 1)
+        self.assertEqual(get_cache_stats()['misses'], 1)
+
+    def test_writes_invalidate_cached_responses(self):
+        self.client.get(self.url)
+        self.service.price = 75
+        self.service.save()
+
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()[0]['price'], '75.00')
+
+        Review.objects.create(service=self.service, client=self.client_user, rating=5)
+        response = self.client.get(self.url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.json()[0]['reviews_count'], 1)
+
+        categories_url = reverse('services:category-list')
+        self.client.get(categories_url)
+        self.assertEqual(self.client.get(categories_url)['X-Cache'], 'HIT')
+        Category.objects.create(name='BEAUTY', description='Beauty services')
+        response = self.client.get(categories_url)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(len(response.json()), 2)
+
+    def test_hits_keep_headers_and_are_throttled(self):
+        url = reverse('services:service-list-api')
+        with mock.patch.dict(AnonRateThrottle.THROTTLE_RATES, {'anon': '2/hour'}):
+            first = self.client.get(url)
+            second = self.client.get(url)
+            self.assertEqual(second['X-Cache'], 'HIT')
+            self.assertEqual(second['Vary'], first['Vary'])
+            self.assertEqual(second['Content-Type'], first['Content-Type'])
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_authenticated_requests_bypass_cache(self):
+        self.client.get(self.url)
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.get(self.url)
+        self.assertNotIn('X-Cache', response)
+
+class RatingAggregateTest(TestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.clients = [
+            User.objects.create_user(username=f'client{i}', email=f'client{i}@test.com', password='testpass123')
+            for i in range(3)
+        ]
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = self._create_service('Cleaning')
+        self.other_service = self._create_service('Plumbing')
+
+    def _create_service(self, name):
+        return Service.objects.create(
+            provider=self.provider,
+            category=self.category,
+            name=name,
+            description='Test service',
+            price=30,
+            base_price=30,
+            image='services/test.jpg',
+            location='Nairobi'
+        )
+
+    def assertAggregates(self, obj, rating_sum, rating_count, average, average_field='rating'):
+        obj.refresh_from_db()
+        self.assertEqual(obj.rating_sum, rating_sum)
+        self.assertEqual(obj.rating_count, rating_count)
+        self.assertAlmostEqual(float(getattr(obj, average_field)), average, places=2)
+
+    def test_create_update_delete(self):
+        first = Review.objects.create(service=self.service, client=self.clients[0], rating=5)
+        Review.objects.create(service=self.service, client=self.clients[1], rating=2)
+        self.assertAggregates(self.service, 7, 2, 3.5)
+        self.assertAggregates(self.provider, 7, 2, 3.5, 'average_rating')
+
+        first.rating = 3
+        first.save()
+        self.assertAggregates(self.service, 5, 2, 2.5)
+
+        first.service = self.other_service
+        first.save()
+        self.assertAggregates(self.service, 2, 1, 2.0)
+        self.assertAggregates(self.other_service, 3, 1, 3.0)
+        self.assertAggregates(self.provider, 5, 2, 2.5, 'average_rating')
+
+        first.delete()
+        self.assertAggregates(self.other_service, 0, 0, 0.0)
+        Review.objects.filter(service=self.service).delete()
+        self.assertAggregates(self.service, 0, 0, 0.0)
+        self.assertAggregates(self.provider, 0, 0, 0.0, 'average_rating')
+
+    def test_stale_instances_do_not_overwrite_aggregates(self):
+        stale_service = Service.objects.get(pk=self.service.pk)
+        stale_provider = User.objects.get(pk=self.provider.pk)
+        Review.objects.create(service=self.service, client=self.clients[0], rating=4)
+
+        stale_service.price = 45
+        stale_service.save()
+        stale_provider.bio = 'Updated bio'
+        stale_provider.save()
+
+        self.assertAggregates(self.service, 4, 1, 4.0)
+        self.assertEqual(self.service.price, 45)
+        self.assertAggregates(self.provider, 4, 1, 4.0, 'average_rating')
+
+    def test_full_save_of_a_missing_row_inserts_it(self):
+        service = Service.objects.get(pk=self.service.pk)
+        Service.objects.filter(pk=service.pk).delete()
+        service.save()
+        self.assertTrue(Service.objects.filter(pk=service.pk).exists())
+
+    def test_rebuild_command(self):
+        for client, rating in zip(self.clients, [5, 4, 4]):
+            Review.objects.create(service=self.service, client=client, rating=rating)
+        Service.objects.update(rating_sum=0, rating_count=0, rating=0)
+        User.objects.update(rating_sum=99, rating_count=1, average_rating=5)
+
+        call_command('rebuild_ratings', batch_size=1, stdout=StringIO())
+
+        self.assertAggregates(self.service, 13, 3, 4.33)
+        self.assertAggregates(self.other_service, 0, 0, 0.0)
+        self.assertAggregates(self.provider, 13, 3, 4.33, 'average_rating')
+        self.assertAggregates(self.clients[0], 0, 0, 0.0, 'average_rating')
+
+class AvailabilityEngineTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.client_user = User.objects.create_user(
+            username='client',
+            email='client@test.com',
+            password='testpass123',
+            account_type='client'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.service = self._create_service(self.provider, 'Scheduled Cleaning', 'CUSTOM')
+        self.day = timezone.localdate() + datetime.timedelta(days=2)
+        ProviderSchedule.objects.create(
+            provider=self.provider,
+            day_of_week=self.day.weekday(),
+            start_time=datetime.time(9, 0),
+            end_time=datetime.time(17, 0)
+        )
+        self.url = reverse('services:advanced-search')
+
+    def _create_service(self, provider, name, availability_type):
+        return Service.objects.create(
+            provider=provider,
+            category=self.category,
+            name=name,
+            description='Test service',
+            price=30,
+            base_price=30,
+            image='services/test.jpg',
+            location='Nairobi',
+            availability_type=availability_type
+        )
+
+    def _bitmap(self, day=None):
+        return ProviderAvailability.objects.get(provider=self.provider, date=day or self.day).free_slots
+
+    def _book(self, hour, duration_hours=2):
+        scheduled = timezone.make_aware(datetime.datetime.combine(self.day, datetime.time(hour, 0)))
+        return Order.objects.create(
+            client=self.client_user,
+            service=self.service,
+            scheduled_date=scheduled,
+            duration_hours=duration_hours
+        )
+
+    def _search_ids(self, **params):
+        response = self.client.get(self.url, {'available_date': self.day.isoformat(), **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {item['id'] for item in response.data['results']}
+
+    def test_schedule_expands_to_bitmap(self):
+        # 09:00-17:00 in 30 minute slots is slots 18..33
+        self.assertEqual(self._bitmap(), sum(1 << slot for slot in range(18, 34)))
+        other_day = self.day + datetime.timedelta(days=1)
+        self.assertEqual(self._bitmap(other_day), 0)
+
+    def test_orders_and_overrides_update_bitmap(self):
+        order = self._book(10)
+        self.assertEqual(self._bitmap() & (0b1111 << 20), 0)
+        self.assertTrue(self._bitmap() & (1 << 24))
+
+        order.status = 'cancelled'
+        order.save()
+        self.assertEqual(self._bitmap(), sum(1 << slot for slot in range(18, 34)))
+
+        ProviderSchedule.objects.create(
+            provider=self.provider,
+            day_of_week=self.day.weekday(),
+            start_time=datetime.time(9, 0),
+            end_time=datetime.time(17, 0),
+            is_available=False,
+            date_override=self.day
+        )
+        self.assertEqual(self._bitmap(), 0)
+
+    def test_search_filters_by_free_slots(self):
+        unscheduled = User.objects.create_user(
+            username='always', email='always@test.com', password='testpass123', account_type='provider'
+        )
+        always = self._create_service(unscheduled, 'Anytime Cleaning', 'ALWAYS')
+
+        self.assertEqual(self._search_ids(time_from='10:00', time_to='12:00'), {self.service.id, always.id})
+        self.assertEqual(self._search_ids(time_from='18:00', time_to='20:00'), {always.id})
+
+        self._book(10)
+        self.assertEqual(self._search_ids(time_from='10:00', time_to='12:00'), {always.id})
+        self.assertEqual(self._search_ids(time_from='12:00', time_to='13:00'), {self.service.id, always.id})
+
+    def test_invalid_window(self):
+        response = self.client.get(self.url, {'availability': 'someday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(self.url, {'available_date': 'not-a-date'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+class ServiceRecommendationsTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(
+            username='provider',
+            email='provider@test.com',
+            password='testpass123',
+            account_type='provider'
+        )
+        self.category = Category.objects.create(name='HOME', description='Home services')
+        self.services = {
+            name: Service.objects.create(
+                provider=self.provider,
+                category=self.category,
+                name=name,
+                description='Test service',
+                price=30,
+                base_price=30,
+                image='services/test.jpg',
+                location='Nairobi',
+                rating=rating
+            )
+            for name, rating in [('cleaning', 3), ('laundry', 3), ('ironing', 3), ('catering', 5)]
+        }
+        self.users = {
+            name: User.objects.create_user(username=name, email=f'{name}@test.com', password='testpass123')
+            for name in ['alice', 'bob', 'carol', 'dave', 'erin']
+        }
+        # Clients who had cleaning done also used laundry; ironing less often
+        self._complete('alice', 'cleaning', 'laundry')
+        self._complete('bob', 'cleaning', 'laundry', 'ironing')
+        self._complete('carol', 'catering')
+        self._complete('dave', 'cleaning')
+        self.url = reverse('services:service-recommendations')
+
+    def _complete(self, user, *services):
+        for name in services:
+            Order.objects.create(client=self.users[user], service=self.services[name], status='completed')
+
+    def test_rebuild_stores_top_neighbours(self):
+        result = rebuild_neighbors(top_n=1)
+        self.assertEqual(result['neighbors'], 3)
+        neighbors = dict(ServiceNeighbor.objects.values_list('service__name', 'neighbor__name'))
+        self.assertEqual(neighbors['cleaning'], 'laundry')
+        self.assertEqual(neighbors['ironing'], 'laundry')
+        self.assertNotIn('catering', neighbors)
+
+    def test_recommendations_follow_neighbours(self):
+        rebuild_neighbors()
+        self.client.force_authenticate(user=self.users['dave'])
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        names = [item['name'] for item in response.data]
+        # Neighbours by similarity, then highly rated services; never cleaning
+        self.assertEqual(names, ['laundry', 'ironing', 'catering'])
+
+    def test_new_user_gets_highly_rated_services(self):
+        rebuild_neighbors()
+        self.client.force_authenticate(user=self.users['erin'])
+        response = self.client.get(self.url)
+        self.assertEqual([item['name'] for item in response.data], ['catering'])
@@ -3,14 +3,25 @@ from rest_framework import generics, permissions, status
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.decorators import action
-from django.db.models import Q, Avg, Count
+from django.db.models import Avg
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import filters
 from rest_framework.renderers import JSONRenderer
 from .models import Service, Category, ServicePackage, FavoriteService, ProviderSchedule, Promotion
 from .serializers import ServiceSerializer, CategorySerializer, ServicePackageSerializer, FavoriteServiceSerializer, ProviderScheduleSerializer, PromotionSerializer
 from users.permissions import IsProvider, CanManageService
-
+from .availability import filter_available, resolve_window
+from .cache import CATEGORIES, REVIEWS, SERVICES, cache_catalogue_response
+from .geo import nearest
+from .pagination import KeysetPaginator, InvalidCursor, SORT_ORDERINGS, approximate_count, parse_per_page
+from .recommendations import interacted_filter, recommend
+from .search import search_services
+from .suggestions import get_index as get_suggestion_index
+
+# Services are serialized with their category and review aggregates
+CATALOGUE_TABLES = (SERVICES, CATEGORIES, REVIEWS)
+
+@cache_catalogue_response('service-list-api', CATALOGUE_TABLES)
 class ServiceListView(generics.ListAPIView):
     """List services for web interface"""
     queryset = Service.objects.filter(is_available=True)
@@ -23,7 +34,7 @@ class ServiceListView(generics.ListAPIView):
     ordering = ['-rating', '-created_at']
 
     def get_queryset(self):
-        queryset = Service.objects.filter(is_available=True)
+        queryset = Service.objects.for_listing(self.request.user).filter(is_available=True)
 
         # Filter by price range
         min_price = self.request.query_params.get('min_price')
@@ -45,12 +56,13 @@ class ServiceListView(generics.ListAPIView):
 
         return queryset
 
+@cache_catalogue_response('service-list', CATALOGUE_TABLES)
 def services_list(request):
     """Template view for services list page"""
     from django.core.paginator import Paginator
 
     # Get services with filters
-    services = Service.objects.filter(is_available=True).order_by('-rating', '-created_at')
+    services = Service.objects.for_listing(request.user).filter(is_available=True).order_by('-rating', '-created_at')
 
     # Apply filters from request
     category = request.GET.get('category')
@@ -59,6 +71,7 @@ def services_list(request):
     max_price = request.GET.get('max_price')
     min_rating = request.GET.get('min_rating')
     sort_by = request.GET.get('sort_by', 'relevance')
+    query = request.GET.get('q')
 
     if category:
         # Filter by category name instead of ID
@@ -71,6 +84,9 @@ def services_list(request):
         services = services.filter(price__lte=max_price)
     if min_rating:
         services = services.filter(rating__gte=min_rating)
+    # Last, so the text match only ranks services that pass the filters
+    if query:
+        services = search_services(services, query)
 
     # Apply sorting
     if sort_by == 'price_low':
@@ -83,23 +99,38 @@ def services_list(request):
         services = services.order_by('-created_at')
     elif sort_by == 'popular':
         services = services.order_by('-total_bookings')
+    elif query:
+        services = services.order_by('-relevance', '-id')
     # else: relevance (default ordering)
 
-    # Pagination
-    paginator = Paginator(services, 12)  # 12 services per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-
     # Get categories for filter
     from .models import Category
     categories = Category.objects.all()
 
     context = {
-        'services': page_obj,
         'categories': categories,
         'request': request,
     }
 
+    # Cursor pagination skips the COUNT(*) and OFFSET of page numbers
+    cursor = request.GET.get('cursor')
+    if cursor is not None:
+        if sort_by not in SORT_ORDERINGS or sort_by == 'search':
+            sort_by = 'relevance'
+        sort_key = 'search' if sort_by == 'relevance' and query else sort_by
+        try:
+            per_page = parse_per_page(request.GET.get('per_page'), default=12)
+            services_page, next_cursor = KeysetPaginator(sort_key, per_page).paginate(services, cursor or None)
+        except (ValueError, InvalidCursor):
+            services_page, next_cursor = [], None
+        context.update({'services': services_page, 'next_cursor': next_cursor})
+        return render(request, 'services/service_list.html', context)
+
+    # Pagination
+    paginator = Paginator(services, 12)  # 12 services per page
+    page_number = request.GET.get('page')
+    context['services'] = paginator.get_page(page_number)
+
     return render(request, 'services/service_list.html', context)
 
 class ServiceListCreateView(generics.ListCreateAPIView):
@@ -114,7 +145,7 @@ class ServiceListCreateView(generics.ListCreateAPIView):
     renderer_classes = [JSONRenderer]  # Force JSON response only
 
     def get_queryset(self):
-        queryset = Service.objects.filter(is_available=True)
+        queryset = Service.objects.for_listing(self.request.user).filter(is_available=True)
 
         # Filter by price range
         min_price = self.request.query_params.get('min_price')
@@ -202,6 +233,9 @@ class ServiceDetailView(generics.RetrieveUpdateDestroyAPIView):
     serializer_class = ServiceSerializer
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
 
+    def get_queryset(self):
+        return Service.objects.for_listing(self.request.user)
+
     def get_permissions(self):
         if self.request.method in ['PUT', 'PATCH', 'DELETE']:
             return [CanManageService()]
@@ -216,6 +250,7 @@ class ServiceDetailView(generics.RetrieveUpdateDestroyAPIView):
         service = self.get_object()
         return render(request, 'services/service_detail.html', {'service': service})
 
+@cache_catalogue_response('category-list', (CATEGORIES,))
 class CategoryListView(generics.ListCreateAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
@@ -228,6 +263,7 @@ class CategoryDetailView(generics.RetrieveUpdateDestroyAPIView):
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     renderer_classes = [JSONRenderer]  # Force JSON response only
 
+@cache_catalogue_response('service-search', CATALOGUE_TABLES)
 class ServiceSearchView(APIView):
     """Advanced service search with multiple filters"""
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
@@ -241,14 +277,7 @@ class ServiceSearchView(APIView):
         max_price = request.query_params.get('max_price')
         min_rating = request.query_params.get('min_rating')
 
-        services = Service.objects.filter(is_available=True)
-
-        if query:
-            services = services.filter(
-                Q(name__icontains=query) |
-                Q(description__icontains=query) |
-                Q(location__icontains=query)
-            )
+        services = Service.objects.for_listing(request.user).filter(is_available=True)
 
         if category:
             # Filter by category name instead of ID
@@ -266,8 +295,15 @@ class ServiceSearchView(APIView):
         if min_rating:
             services = services.filter(rating__gte=min_rating)
 
-        # Order by rating and relevance
-        services = services.order_by('-rating', '-total_bookings')
+        # Last, so the text match only ranks services that pass the filters
+        if query:
+            services = search_services(services, query)
+
+        # Order by blended relevance when searching, otherwise by rating
+        if query:
+            services = services.order_by('-relevance', '-id')
+        else:
+            services = services.order_by('-rating', '-total_bookings')
 
         serializer = ServiceSerializer(services, many=True, context={'request': request})
         return Response(serializer.data)
@@ -280,17 +316,18 @@ class ProviderServicesView(generics.ListAPIView):
 
     def get_queryset(self):
         provider_id = self.kwargs['provider_id']
-        return Service.objects.filter(provider_id=provider_id, is_available=True)
+        return Service.objects.for_listing(self.request.user).filter(provider_id=provider_id, is_available=True)
 
 class NearbyServicesView(APIView):
-    """Find services near a location"""
+    """Find services near a location, sorted by distance"""
     permission_classes = [permissions.IsAuthenticatedOrReadOnly]
     renderer_classes = [JSONRenderer]  # Force JSON response only
+    max_radius_km = 500
+    max_results = 100
 
     def get(self, request):
         latitude = request.query_params.get('lat')
         longitude = request.query_params.get('lng')
-        radius = request.query_params.get('radius', 10)  # km
 
         if not latitude or not longitude:
             return Response(
@@ -298,17 +335,36 @@ class NearbyServicesView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Simple distance calculation (you might want to use a proper GIS library)
-        services = Service.objects.filter(
-            is_available=True,
-            latitude__isnull=False,
-            longitude__isnull=False
-        )
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+            radius = float(request.query_params.get('radius', 10))  # km
+            limit = int(request.query_params.get('limit', 20))
+        except ValueError:
+            return Response(
+                {'error': 'lat, lng, radius and limit must be numbers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        # For demo purposes, just return services with location data
-        # In production, implement proper distance calculation
-        serializer = ServiceSerializer(services[:20], many=True, context={'request': request})
-        return Response(serializer.data)
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or radius <= 0:
+            return Response(
+                {'error': 'Coordinates or radius out of range'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        radius = min(radius, self.max_radius_km)
+        limit = max(1, min(limit, self.max_results))
+
+        # Geohash/bounding-box prefilter, then exact haversine ranking
+        ranked = nearest(Service.objects.filter(is_available=True), latitude, longitude, radius, limit)
+        services = Service.objects.for_listing(request.user).in_bulk([service_id for service_id, _ in ranked])
+
+        data = []
+        for service_id, distance in ranked:
+            item = ServiceSerializer(services[service_id], context={'request': request}).data
+            item['distance_km'] = round(distance, 3)
+            data.append(item)
+        return Response(data)
 
 class ServicePackageListCreateView(generics.ListCreateAPIView):
     """List and create service packages"""
@@ -407,17 +463,7 @@ class AdvancedSearchView(APIView):
         languages = request.query_params.get('languages')
         sort_by = request.query_params.get('sort_by', 'relevance')
 
-        services = Service.objects.filter(is_available=True)
-
-        # Text search
-        if query:
-            services = services.filter(
-                Q(name__icontains=query) |
-                Q(description__icontains=query) |
-                Q(location__icontains=query) |
-                Q(provider__first_name__icontains=query) |
-                Q(provider__last_name__icontains=query)
-            )
+        services = Service.objects.for_listing(request.user).filter(is_available=True)
 
         # Category filter
         if category:
@@ -438,13 +484,19 @@ class AdvancedSearchView(APIView):
         if min_rating:
             services = services.filter(rating__gte=min_rating)
 
-        # Availability filter
-        if availability:
-            if availability == 'today':
-                # Filter services available today
-                services = services.filter(availability_type__in=['ALWAYS', 'WEEKDAY'])
-            elif availability == 'weekend':
-                services = services.filter(availability_type__in=['ALWAYS', 'WEEKEND'])
+        # Availability filter: providers with a free slot in the window
+        available_date = request.query_params.get('available_date')
+        if availability or available_date:
+            try:
+                window = resolve_window(
+                    availability,
+                    date=available_date,
+                    time_from=request.query_params.get('time_from'),
+                    time_to=request.query_params.get('time_to'),
+                )
+            except ValueError as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            services = filter_available(services, window)
 
         # Experience filter
         if experience_min:
@@ -455,6 +507,11 @@ class AdvancedSearchView(APIView):
             language_list = languages.split(',')
             services = services.filter(languages__overlap=language_list)
 
+        # Text search (the search document includes the provider name),
+        # last so it only ranks services that pass the filters
+        if query:
+            services = search_services(services, query)
+
         # Sorting
         if sort_by == 'price_low':
             services = services.order_by('price')
@@ -466,12 +523,48 @@ class AdvancedSearchView(APIView):
             services = services.order_by('-created_at')
         elif sort_by == 'popular':
             services = services.order_by('-total_bookings')
-        else:  # relevance
+        elif query:  # relevance
+            services = services.order_by('-relevance', '-id')
+        else:
             services = services.order_by('-rating', '-total_bookings')
 
         # Get pagination parameters
-        page = int(request.query_params.get('page', 1))
-        per_page = int(request.query_params.get('per_page', 20))
+        try:
+            page = int(request.query_params.get('page', 1))
+            per_page = parse_per_page(request.query_params.get('per_page'))
+        except ValueError:
+            return Response(
+                {'error': 'page and per_page must be integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # Cursor mode: keyset pagination, no COUNT(*) unless a total is asked for
+        cursor = request.query_params.get('cursor')
+        if cursor is not None or request.query_params.get('pagination') == 'cursor':
+            if sort_by not in SORT_ORDERINGS or sort_by == 'search':
+                sort_by = 'relevance'
+            sort_key = 'search' if sort_by == 'relevance' and query else sort_by
+            paginator = KeysetPaginator(sort_key, per_page)
+            try:
+                services_page, next_cursor = paginator.paginate(services, cursor or None)
+            except InvalidCursor as e:
+                return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+            serializer = ServiceSerializer(services_page, many=True, context={'request': request})
+            data = {
+                'results': serializer.data,
+                'next_cursor': next_cursor,
+                'per_page': per_page,
+            }
+            total = request.query_params.get('total')
+            if total == 'approximate':
+                data['total_count'] = approximate_count(services)
+                data['total_count_is_approximate'] = True
+            elif total == 'exact':
+                data['total_count'] = services.count()
+            return Response(data)
+
+        page = max(page, 1)
         start = (page - 1) * per_page
         end = start + per_page
 
@@ -497,42 +590,15 @@ class SearchSuggestionsView(APIView):
     def get(self, request):
         query = request.query_params.get('q', '')
 
-        suggestions = {
-            'services': [],
-            'locations': [],
-            'categories': [],
-            'providers': []
-        }
-
-        if query:
-            # Service name suggestions
-            service_suggestions = Service.objects.filter(
-                name__icontains=query,
-                is_available=True
-            ).values('name')[:5]
-            suggestions['services'] = [s['name'] for s in service_suggestions]
-
-            # Location suggestions
-            location_suggestions = Service.objects.filter(
-                location__icontains=query,
-                is_available=True
-            ).values('location')[:5]
-            suggestions['locations'] = list(set([s['location'] for s in location_suggestions]))
-
-            # Provider suggestions
-            provider_suggestions = Service.objects.filter(
-                Q(provider__first_name__icontains=query) |
-                Q(provider__last_name__icontains=query),
-                is_available=True
-            ).values('provider__first_name', 'provider__last_name')[:5]
-            suggestions['providers'] = [
-                f"{p['provider__first_name']} {p['provider__last_name']}"
-                for p in provider_suggestions
-            ]
+        # Served from the memory-mapped suggestion index, not the database
+        index = get_suggestion_index()
+        if index is None:
+            # A worker is building the first snapshot
+            return Response({'services': [], 'locations': [], 'providers': [], 'categories': []})
+        suggestions = index.lookup(query)
 
         # Category suggestions (always show popular categories)
-        popular_categories = Category.objects.all().values('name')[:8]
-        suggestions['categories'] = [c['name'] for c in popular_categories]
+        suggestions['categories'] = index.meta['popular_categories']
 
         return Response(suggestions)
 
@@ -543,29 +609,22 @@ class ServiceRecommendationsView(APIView):
 
     def get(self, request):
         user = request.user
+        limit = 10
+
+        # Neighbours of the services the user interacted with, precomputed
+        # nightly by services.recommendations
+        scores = dict(recommend(user, limit))
+        services = Service.objects.for_listing(user).filter(is_available=True)
+        recommendations = sorted(
+            services.filter(id__in=scores), key=lambda service: (-scores[service.id], service.id)
+        )
 
-        # Get user's order history to find preferences
-        user_orders = Order.objects.filter(client=user, status='completed')
-        preferred_categories = user_orders.values('service__category').annotate(
-            count=Count('id')
-        ).order_by('-count')[:3]
-
-        recommendations = Service.objects.filter(is_available=True)
-
-        if preferred_categories:
-            # Recommend services from preferred categories
-            category_ids = [cat['service__category'] for cat in preferred_categories]
-            recommendations = recommendations.filter(category_id__in=category_ids)
-
-        # Also recommend highly rated services
-        recommendations = recommendations.filter(rating__gte=4.0)
-
-        # Exclude services user already ordered
-        ordered_service_ids = user_orders.values('service_id')
-        recommendations = recommendations.exclude(id__in=ordered_service_ids)
-
-        # Order by rating and limit results
-        recommendations = recommendations.order_by('-rating')[:10]
+        # Top up with highly rated services for new users and new catalogues
+        if len(recommendations) < limit:
+            popular = services.filter(rating__gte=4.0).exclude(
+                interacted_filter(user, 'id')
+            ).exclude(id__in=scores).order_by('-rating', '-total_bookings')
+            recommendations += list(popular[:limit - len(recommendations)])
 
         serializer = ServiceSerializer(recommendations, many=True, context={'request': request})
         return Response(serializer.data)
@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from users.metrics import backfill
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily and lifetime dashboard metrics from order, payment and review history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        rows = backfill(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Wrote {rows} daily metric rows in {time.perf_counter() - started:.1f}s"
+        ))
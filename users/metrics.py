@@ -0,0 +1,222 @@
+"""
+Dashboard metrics.
+
+Order, payment and review changes are turned into deltas per user and role
+and added to two rows: the user's lifetime totals (UserMetrics), which the
+dashboards read, and the day's DailyMetrics row, which feeds the
+time-series endpoint. Deltas are applied with F() updates inside the
+writer's transaction, so concurrent changes add up and a rolled back change
+leaves no trace. backfill() rebuilds both tables from history.
+"""
+import logging
+from collections import Counter, defaultdict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import DailyMetrics, UserMetrics
+
+logger = logging.getLogger(__name__)
+
+COUNT_FIELDS = (
+    'orders_placed', 'orders_confirmed', 'orders_completed', 'orders_cancelled', 'orders_refunded',
+    'open_orders', 'reviews',
+)
+AMOUNT_FIELDS = ('completed_amount', 'payments_amount', 'refunds_amount')
+FIELDS = COUNT_FIELDS + AMOUNT_FIELDS
+
+STATUS_FIELDS = {
+    'confirmed': 'orders_confirmed',
+    'completed': 'orders_completed',
+    'cancelled': 'orders_cancelled',
+    'refunded': 'orders_refunded',
+}
+# Counted as open on the dashboards
+OPEN_STATUSES = ('pending', 'confirmed')
+PAID_STATUSES = ('completed', 'refunded', 'partially_refunded')
+
+# Longest time series served in one response
+MAX_SERIES_DAYS = 366
+
+
+def new_deltas():
+    """{(user_id, role): Counter of field deltas}"""
+    return defaultdict(Counter)
+
+
+def role_for(user):
+    return 'client' if user.account_type == 'client' else 'provider'
+
+
+def order_deltas(order, old_status, new_status, deltas=None):
+    """
+    Deltas for an order moving from old_status (None when it was just
+    placed) to new_status, for both its provider and its client
+    """
+    deltas = new_deltas() if deltas is None else deltas
+    if old_status == new_status:
+        return deltas
+    for user_id, role in ((order.provider_id, 'provider'), (order.client_id, 'client')):
+        row = deltas[(user_id, role)]
+        if old_status is None:
+            row['orders_placed'] += 1
+        if new_status in STATUS_FIELDS:
+            row[STATUS_FIELDS[new_status]] += 1
+        if new_status == 'completed':
+            row['completed_amount'] += order.total_amount
+        row['open_orders'] += (new_status in OPEN_STATUSES) - (old_status in OPEN_STATUSES)
+    return deltas
+
+
+def payment_deltas(payment, previous, deltas=None):
+    """
+    Deltas for a payment whose (status, refund_amount) was previous, or
+    None when it was just created
+    """
+    deltas = new_deltas() if deltas is None else deltas
+    old_status, old_refund = previous or (None, Decimal(0))
+    paid = (payment.status in PAID_STATUSES) - (old_status in PAID_STATUSES)
+    refunded = Decimal(payment.refund_amount or 0) - Decimal(old_refund or 0)
+    if not paid and not refunded:
+        return deltas
+    order = payment.order
+    for user_id, role in ((order.provider_id, 'provider'), (order.client_id, 'client')):
+        row = deltas[(user_id, role)]
+        row['payments_amount'] += paid * payment.amount
+        row['refunds_amount'] += refunded
+    return deltas
+
+
+def review_deltas(provider_id, client_id, sign, deltas=None):
+    deltas = new_deltas() if deltas is None else deltas
+    deltas[(provider_id, 'provider')]['reviews'] += sign
+    deltas[(client_id, 'client')]['reviews'] += sign
+    return deltas
+
+
+def _add(model, key, changes):
+    updated = model.objects.filter(**key).update(**{field: F(field) + value for field, value in changes.items()})
+    if updated:
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**key, **changes)
+    except IntegrityError:
+        # Created by a concurrent writer since the update
+        model.objects.filter(**key).update(**{field: F(field) + value for field, value in changes.items()})
+
+
+def apply(deltas, day=None):
+    """
+    Add deltas to the totals and to day's row (default today). Call inside
+    the transaction making the change.
+    """
+    day = day or timezone.localdate()
+    for (user_id, role), changes in deltas.items():
+        changes = {field: value for field, value in changes.items() if value}
+        if not user_id or not changes:
+            continue
+        _add(UserMetrics, {'user_id': user_id, 'role': role}, changes)
+        _add(DailyMetrics, {'user_id': user_id, 'role': role, 'date': day}, changes)
+
+
+def totals(user, role=None):
+    """
+    The user's lifetime metrics; an unsaved zero row when they have none
+    """
+    role = role or role_for(user)
+    return UserMetrics.objects.filter(user=user, role=role).first() or UserMetrics(user=user, role=role)
+
+
+def as_dict(row):
+    return {field: getattr(row, field) for field in FIELDS}
+
+
+def series(user, role, start, end):
+    """
+    One dict per day from start to end inclusive, zero filled
+    """
+    rows = {
+        row['date']: row
+        for row in DailyMetrics.objects.filter(user=user, role=role, date__range=(start, end)).values('date', *FIELDS)
+    }
+    days = []
+    day = start
+    while day <= end:
+        row = rows.get(day) or dict.fromkeys(FIELDS, 0)
+        days.append({'date': day, **{field: row[field] for field in FIELDS}})
+        day += timedelta(days=1)
+    return days
+
+
+def _rollup(rows, queryset, date_field, fields, sides=(('provider_id', 'provider'), ('client_id', 'client'))):
+    """
+    Add per-day aggregates of queryset to rows for both sides of each order.
+    fields maps metric fields to aggregates.
+    """
+    for user_field, role in sides:
+        grouped = queryset.annotate(day=TruncDate(date_field)).order_by().values(user_field, 'day').annotate(**fields)
+        for row in grouped.iterator(chunk_size=10000):
+            if row['day'] is None:
+                continue
+            counter = rows[(row[user_field], role, row['day'])]
+            for field in fields:
+                counter[field] += row[field] or 0
+
+
+def backfill(batch_size=5000):
+    """
+    Rebuild DailyMetrics and UserMetrics from orders, payments and reviews.
+    Status change days come from the status timestamps; cancellations and
+    refunds, which have none, are dated by the order's last update. Days
+    carry no open_orders change; the totals get the current open count.
+    Returns the number of daily rows written.
+    """
+    from orders.models import Order
+    from payments.models import Payment
+    from services.models import Review
+
+    rows = defaultdict(Counter)
+    orders = Order.objects.all()
+    _rollup(rows, orders, 'created_at', {'orders_placed': Count('id')})
+    _rollup(rows, orders.filter(confirmed_at__isnull=False), 'confirmed_at', {'orders_confirmed': Count('id')})
+    _rollup(rows, orders.filter(completed_at__isnull=False), 'completed_at', {
+        'orders_completed': Count('id'), 'completed_amount': Sum('total_amount'),
+    })
+    _rollup(rows, orders.filter(status='cancelled'), 'updated_at', {'orders_cancelled': Count('id')})
+    _rollup(rows, orders.filter(status='refunded'), 'updated_at', {'orders_refunded': Count('id')})
+
+    payments = Payment.objects.filter(status__in=PAID_STATUSES)
+    payment_sides = (('order__provider_id', 'provider'), ('order__client_id', 'client'))
+    _rollup(rows, payments, 'updated_at', {'payments_amount': Sum('amount')}, payment_sides)
+    _rollup(rows, payments.filter(refund_amount__gt=0), 'updated_at', {'refunds_amount': Sum('refund_amount')},
+            payment_sides)
+
+    _rollup(rows, Review.objects.all(), 'created_at', {'reviews': Count('id')})
+
+    lifetime = defaultdict(Counter)
+    for (user_id, role, day), counter in rows.items():
+        lifetime[(user_id, role)].update(counter)
+    for user_field, role in (('provider_id', 'provider'), ('client_id', 'client')):
+        for user_id, count in orders.filter(status__in=OPEN_STATUSES).order_by().values_list(
+                user_field).annotate(total=Count('id')):
+            lifetime[(user_id, role)]['open_orders'] = count
+
+    with transaction.atomic():
+        DailyMetrics.objects.all().delete()
+        UserMetrics.objects.all().delete()
+        DailyMetrics.objects.bulk_create(
+            (DailyMetrics(user_id=user_id, role=role, date=day, **counter)
+             for (user_id, role, day), counter in rows.items()),
+            batch_size=batch_size
+        )
+        UserMetrics.objects.bulk_create(
+            (UserMetrics(user_id=user_id, role=role, **counter) for (user_id, role), counter in lifetime.items()),
+            batch_size=batch_size
+        )
+    logger.info("Backfilled %s daily metric rows for %s users", len(rows), len(lifetime))
+    return len(rows)
@@ -15,6 +15,11 @@ class User(AbstractUser):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # Aggregates of received reviews, maintained by services.ratings
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    rating_count = models.PositiveIntegerField(default=0, editable=False)
+    average_rating = models.DecimalField(max_digits=3, decimal_places=2, default=0, editable=False)
+
     def __str__(self):
         return self.email
 
@@ -51,3 +56,50 @@ class BusinessProfile(models.Model):
 
     def is_verified(self):
         return self.verification_status == 'verified'
+
+class MetricCounts(models.Model):
+    """
+    Counters kept per user and role (see users.metrics). For a provider the
+    amounts are earnings and payments received, for a client spend and
+    payments made.
+    """
+    ROLES = (
+        ('provider', 'Provider'),
+        ('client', 'Client'),
+    )
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    role = models.CharField(max_length=10, choices=ROLES)
+
+    orders_placed = models.IntegerField(default=0)
+    orders_confirmed = models.IntegerField(default=0)
+    orders_completed = models.IntegerField(default=0)
+    orders_cancelled = models.IntegerField(default=0)
+    orders_refunded = models.IntegerField(default=0)
+    # Orders still pending or confirmed; a day's row holds the net change
+    open_orders = models.IntegerField(default=0)
+    completed_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    payments_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    refunds_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    # Reviews received by a provider, written by a client
+    reviews = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+
+class UserMetrics(MetricCounts):
+    """Lifetime totals; one row per user and role"""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'role'], name='user_metrics_unique'),
+        ]
+
+class DailyMetrics(MetricCounts):
+    """What happened on one day, for charts"""
+    date = models.DateField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'role', 'date'], name='daily_metrics_unique'),
+        ]
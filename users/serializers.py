@@ -57,14 +57,12 @@ class UserProfileSerializer(serializers.ModelSerializer):
 
     def get_reviews_count(self, obj):
         if obj.account_type in ['provider', 'business']:
-            return obj.received_reviews.count()
+            return obj.rating_count
         return 0
 
     def get_average_rating(self, obj):
         if obj.account_type in ['provider', 'business']:
-            reviews = obj.received_reviews.all()
-            if reviews:
-                return sum(review.rating for review in reviews) / len(reviews)
+            return float(obj.average_rating)
         return 0
 
 class UserProfileUpdateSerializer(serializers.ModelSerializer):
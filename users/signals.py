@@ -0,0 +1,45 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import metrics
+
+# Lazy senders: users is imported by the apps it watches
+
+
+@receiver(pre_save, sender='orders.Order')
+def remember_order_status(sender, instance, update_fields=None, **kwargs):
+    if instance._state.adding:
+        instance._metrics_previous = None
+    elif update_fields is None or 'status' in update_fields:
+        instance._metrics_previous = getattr(instance, '_loaded_values', {}).get('status', instance.status)
+    else:
+        instance._metrics_previous = instance.status
+
+
+@receiver(post_save, sender='orders.Order')
+def record_order_metrics(sender, instance, **kwargs):
+    # Orders moved by orders.transitions record their own deltas
+    metrics.apply(metrics.order_deltas(instance, instance._metrics_previous, instance.status))
+
+
+@receiver(pre_save, sender='payments.Payment')
+def remember_payment_state(sender, instance, **kwargs):
+    loaded = getattr(instance, '_loaded_values', None)
+    instance._metrics_previous = None if instance._state.adding or loaded is None else (
+        loaded.get('status'), loaded.get('refund_amount'))
+
+
+@receiver(post_save, sender='payments.Payment')
+def record_payment_metrics(sender, instance, **kwargs):
+    metrics.apply(metrics.payment_deltas(instance, instance._metrics_previous))
+
+
+@receiver(post_save, sender='services.Review')
+def record_review_metrics(sender, instance, created, **kwargs):
+    if created:
+        metrics.apply(metrics.review_deltas(instance.provider_id, instance.client_id, 1))
+
+
+@receiver(post_delete, sender='services.Review')
+def remove_review_metrics(sender, instance, **kwargs):
+    metrics.apply(metrics.review_deltas(instance.provider_id, instance.client_id, -1))
@@ -1,3 +1,97 @@
-from django.test import TestCase
+from datetime import timedelta
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+
+from orders.models import Order
+from orders.transitions import bulk_transition, transition
+from payments.models import Payment
+from services.models import Category, Review, Service
+from . import metrics
+from .models import DailyMetrics, UserMetrics
+
+User = get_user_model()
+
+class MetricsTest(APITestCase):
+    def setUp(self):
+        self.provider = User.objects.create_user(username='provider', password='testpass123', account_type='provider')
+        self.client_user = User.objects.create_user(username='client', password='testpass123', account_type='client')
+        category = Category.objects.create(name='HOME', description='Home services')
+        self.service = Service.objects.create(
+            provider=self.provider, category=category, name='Test Service', description='Test service',
+            price=50, base_price=50, image='services/test.jpg', location='Nairobi'
+        )
+
+    def place_orders(self, count):
+        return [Order.objects.create(client=self.client_user, service=self.service) for _ in range(count)]
+
+    def snapshot(self):
+        return {
+            (row.user_id, row.role): metrics.as_dict(row) for row in UserMetrics.objects.all()
+        }
+
+    def test_transitions_and_payments_update_totals(self):
+        first, second, third = self.place_orders(3)
+        transition(first, 'confirmed', notify=False)
+        transition(first, 'completed', notify=False)
+        bulk_transition(self.provider, [(second.pk, None), (third.pk, None)], 'cancelled')
+        payment = Payment.objects.create(order=first, amount=50)
+        payment = Payment.objects.get(pk=payment.pk)
+        payment.status = 'completed'
+        payment.save()
+        payment.refund_amount = 20
+        payment.status = 'partially_refunded'
+        payment.save()
+        Review.objects.create(service=self.service, client=self.client_user, rating=4)
+
+        provider = metrics.totals(self.provider)
+        self.assertEqual(
+            (provider.orders_placed, provider.orders_confirmed, provider.orders_completed,
+             provider.orders_cancelled, provider.open_orders),
+            (3, 1, 1, 2, 0)
+        )
+        self.assertEqual(
+            (provider.completed_amount, provider.payments_amount, provider.refunds_amount, provider.reviews),
+            (50, 50, 20, 1)
+        )
+        self.assertEqual(metrics.totals(self.client_user).completed_amount, 50)
+        self.assertEqual(DailyMetrics.objects.get(user=self.provider, role='provider').orders_placed, 3)
+
+        # The backfill arrives at the same totals
+        incremental = self.snapshot()
+        metrics.backfill()
+        self.assertEqual(self.snapshot(), incremental)
+
+    def test_dashboard_reads_totals(self):
+        for order in self.place_orders(3):
+            transition(order, 'confirmed', notify=False)
+            if order.pk % 2:
+                transition(order, 'completed', notify=False)
+        self.client.force_authenticate(user=self.client_user)
+        response = self.client.get(reverse('users:client-dashboard'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        completed = Order.objects.filter(status='completed').count()
+        self.assertEqual(response.context['completed_orders'], completed)
+        self.assertEqual(response.context['total_spent'], 50 * completed)
+        self.assertEqual(response.context['pending_orders'], 3 - completed)
+
+    def test_time_series_is_zero_filled(self):
+        self.place_orders(2)
+        self.client.force_authenticate(user=self.provider)
+        response = self.client.get(reverse('users:metrics'), {'days': 7})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['role'], 'provider')
+        self.assertEqual(len(response.data['days']), 7)
+        self.assertEqual(response.data['days'][-1]['date'], timezone.localdate())
+        self.assertEqual([day['orders_placed'] for day in response.data['days']], [0] * 6 + [2])
+
+        start = timezone.localdate() - timedelta(days=metrics.MAX_SERIES_DAYS)
+        response = self.client.get(reverse('users:metrics'), {'start': start.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        for days in ('1000000', '10' * 20, 'x'):
+            response = self.client.get(reverse('users:metrics'), {'days': days})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
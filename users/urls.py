@@ -14,5 +14,6 @@ urlpatterns = [
     path('switch-account-type/', views.switch_account_type, name='switch-account-type'),
     path('provider/dashboard/', views.ProviderDashboardView.as_view(), name='provider-dashboard'),
     path('client/dashboard/', views.ClientDashboardView.as_view(), name='client-dashboard'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
     path('business-profile/', views.BusinessProfileView.as_view(), name='business-profile'),
 ]
\ No newline at end of file
@@ -7,6 +7,12 @@ from django.shortcuts import get_object_or_404
 from django.contrib.auth import get_user_model, login, logout
 from django.contrib.auth.views import LoginView, LogoutView
 from django.urls import reverse_lazy
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+from datetime import timedelta
+from payments import ledger
+from . import metrics
+from .models import UserMetrics
 from .serializers import UserRegistrationSerializer, UserProfileSerializer, UserProfileUpdateSerializer, BusinessProfileSerializer
 from .permissions import IsProvider, IsClient, IsBusiness, IsOwnerOrAdmin
 
@@ -58,16 +64,18 @@ class UserProfileView(generics.RetrieveAPIView):
         user = self.get_object()
         # Calculate statistics based on user type
         if user.account_type == 'client':
+            totals = metrics.totals(user, 'client')
             services_count = 0
-            orders_count = user.orders.count()
-            completed_orders = user.orders.filter(status='completed').count()
+            orders_count = totals.orders_placed
+            completed_orders = totals.orders_completed
             reviews_count = 0
             average_rating = 0
         elif user.account_type in ['provider', 'business']:
+            totals = metrics.totals(user, 'provider')
             services_count = user.services.count()
-            orders_count = user.provided_orders.count()
-            completed_orders = user.provided_orders.filter(status='completed').count()
-            reviews_count = user.received_reviews.count()
+            orders_count = totals.orders_placed
+            completed_orders = totals.orders_completed
+            reviews_count = user.rating_count
             average_rating = user.average_rating
         else:
             services_count = 0
@@ -157,19 +165,18 @@ class ProviderDashboardView(APIView):
     def get(self, request):
         user = request.user
 
-        # Get provider statistics
+        # Get provider statistics from the pre-aggregated totals
+        totals = metrics.totals(user, 'provider')
         services_count = user.services.count()
-        orders_count = user.provided_orders.count()
-        completed_orders = user.provided_orders.filter(status='completed').count()
-        total_earnings = sum(order.total_amount for order in user.provided_orders.filter(status='completed'))
         recent_orders = user.provided_orders.all()[:5]
 
         context = {
             'user': user,
             'services_count': services_count,
-            'orders_count': orders_count,
-            'completed_orders': completed_orders,
-            'total_earnings': total_earnings,
+            'orders_count': totals.orders_placed,
+            'completed_orders': totals.orders_completed,
+            'total_earnings': totals.completed_amount,
+            'balance': ledger.balance(user)['balance'],
             'recent_orders': recent_orders,
         }
 
@@ -182,26 +189,62 @@ class ClientDashboardView(APIView):
     def get(self, request):
         user = request.user
 
-        # Get client statistics
-        orders_count = user.orders.count()
-        completed_orders = user.orders.filter(status='completed').count()
-        pending_orders = user.orders.filter(status__in=['pending', 'confirmed']).count()
-        total_spent = sum(order.total_amount for order in user.orders.filter(status='completed'))
+        # Get client statistics from the pre-aggregated totals
+        totals = metrics.totals(user, 'client')
 
         # Get recent orders
         recent_orders = user.orders.all()[:5]
 
         context = {
             'user': user,
-            'orders_count': orders_count,
-            'completed_orders': completed_orders,
-            'pending_orders': pending_orders,
-            'total_spent': total_spent,
+            'orders_count': totals.orders_placed,
+            'completed_orders': totals.orders_completed,
+            'pending_orders': totals.open_orders,
+            'total_spent': totals.completed_amount,
             'recent_orders': recent_orders,
         }
 
         return render(request, 'users/client_dashboard.html', context)
 
+class MetricsView(APIView):
+    """
+    Daily metrics for charts: ?days=30 (or ?start=&end=, YYYY-MM-DD) and
+    ?role=provider|client, defaulting to the user's account type
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request):
+        user = request.user
+        role = request.query_params.get('role') or metrics.role_for(user)
+        if role not in dict(UserMetrics.ROLES):
+            return Response({'error': 'role must be provider or client'}, status=status.HTTP_400_BAD_REQUEST)
+
+        end = timezone.localdate()
+        try:
+            if 'start' in request.query_params:
+                start = parse_date(request.query_params['start'])
+                end = parse_date(request.query_params.get('end', '')) or end
+            else:
+                start = end - timedelta(days=int(request.query_params.get('days', 30)) - 1)
+        except (ValueError, OverflowError):
+            # OverflowError: a days value beyond what a date can go back
+            start = None
+        if start is None or start > end:
+            return Response({'error': 'Invalid date range'}, status=status.HTTP_400_BAD_REQUEST)
+        if (end - start).days >= metrics.MAX_SERIES_DAYS:
+            return Response(
+                {'error': f'At most {metrics.MAX_SERIES_DAYS} days can be requested at once'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response({
+            'role': role,
+            'start': start,
+            'end': end,
+            'totals': metrics.as_dict(metrics.totals(user, role)),
+            'days': metrics.series(user, role, start, end),
+        })
+
 class BusinessProfileView(generics.RetrieveUpdateAPIView):
     """View for managing business profiles"""
     serializer_class = BusinessProfileSerializer